@@ -0,0 +1,3 @@
+"""
+Micro-benchmarks for the pairing, draw and rendering hot paths. Run with `python -m bench`.
+"""
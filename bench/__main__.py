@@ -0,0 +1,173 @@
+"""
+Runs the benchmarks and optionally compares them with a saved baseline.
+
+    python -m bench [--scales 10,100,1000] [--database URL] [--save FILE] [--compare FILE]
+
+Each result records the best time over its repetitions, the SQL statements one run issues
+and the peak memory Python allocated during one run. Against a baseline, a result regresses
+if it got slower or used more memory by more than the tolerance, or issued more statements.
+The exit status is 1 when anything regressed.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+
+import hatch.metrics as metrics
+import hatch.migrations as migrations
+from bench.cases import CASES
+from hatch.database import Database
+
+DEFAULT_SCALES = (10, 100, 1000, 10000, 100000)
+DEFAULT_TOLERANCE = 0.25
+# Differences smaller than these are noise, whatever the ratio
+TIME_FLOOR = 0.001
+MEMORY_FLOOR = 64 * 1024
+
+
+def repetitions(scale):
+    if scale <= 1000:
+        return 5
+    if scale <= 10000:
+        return 3
+    return 1
+
+
+class Bench:
+    """
+    This class holds what the cases share: a database, an event loop and a seeded random generator.
+    """
+    def __init__(self, url, seed):
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.guild_id = 1
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.engine = create_engine(url)
+        migrations.upgrade(self.engine)
+        metrics.instrument_engine(self.engine)
+        self.db = Database(self.engine, max_workers=1)
+
+    def run_db(self, func, *args):
+        """ Runs database work the way the cogs do, and waits for it """
+        return self.loop.run_until_complete(self.db.run(func, *args))
+
+    def measure(self, case, scale, density):
+        """ Returns the best time, statement count and peak memory of a case """
+        best = None
+        usage = None
+        for _ in range(repetitions(scale)):
+            run = case(self, scale, density)
+            token = metrics.current.set(metrics.Usage())
+            started = time.perf_counter()
+            try:
+                run()
+            finally:
+                elapsed = time.perf_counter() - started
+                usage = metrics.current.get()
+                metrics.current.reset(token)
+            best = elapsed if best is None else min(best, elapsed)
+
+        run = case(self, scale, density)
+        tracemalloc.start()
+        try:
+            run()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return dict(seconds=best, queries=usage.statements, peak_bytes=peak)
+
+
+def result_key(name, scale, density):
+    return f"{name}[n={scale},d={density}]"
+
+
+def run_all(bench, scales, only):
+    results = dict()
+    for name, case, uses_db, densities in CASES:
+        if only and not any(name.startswith(prefix) for prefix in only):
+            continue
+        for scale in scales:
+            for density in densities:
+                key = result_key(name, scale, density)
+                result = bench.measure(case, scale, density)
+                results[key] = result
+                print(f"{key:<48} {result['seconds'] * 1000:>10.2f}ms {result['queries']:>6} queries "
+                      f"{result['peak_bytes'] / 1024:>10.0f}KiB", flush=True)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ Returns a description of every result that regressed against the baseline """
+    regressions = list()
+    for key, result in results.items():
+        before = baseline.get(key)
+        if before is None:
+            continue
+        if result["seconds"] > before["seconds"] * (1 + tolerance) \
+                and result["seconds"] - before["seconds"] > TIME_FLOOR:
+            regressions.append(f"{key}: {before['seconds'] * 1000:.2f}ms -> {result['seconds'] * 1000:.2f}ms")
+        if result["queries"] > before["queries"]:
+            regressions.append(f"{key}: {before['queries']} -> {result['queries']} queries")
+        if result["peak_bytes"] > before["peak_bytes"] * (1 + tolerance) \
+                and result["peak_bytes"] - before["peak_bytes"] > MEMORY_FLOOR:
+            regressions.append(f"{key}: {before['peak_bytes'] // 1024}KiB -> {result['peak_bytes'] // 1024}KiB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Benchmark Hatchling's hot paths.")
+    parser.add_argument("--scales", default=",".join(str(scale) for scale in DEFAULT_SCALES),
+                        help="comma separated participant counts")
+    parser.add_argument("--only", default="", help="comma separated case name prefixes to run")
+    parser.add_argument("--database", help="database URL, defaulting to a temporary SQLite file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument("--compare", help="compare the results with this saved baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="fraction a time or peak memory may grow by before it counts as a regression")
+    args = parser.parse_args()
+
+    scales = [int(scale) for scale in args.scales.split(",")]
+    only = [prefix for prefix in args.only.split(",") if prefix]
+    directory = None
+    url = args.database
+    if url is None:
+        directory = tempfile.TemporaryDirectory()
+        url = "sqlite:///" + os.path.join(directory.name, "bench.db")
+
+    bench = Bench(url, args.seed)
+    try:
+        results = run_all(bench, scales, only)
+    finally:
+        bench.db.close()
+        if directory is not None:
+            directory.cleanup()
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(dict(python=platform.python_version(), database=bench.engine.dialect.name,
+                           results=results), file, indent=2, sort_keys=True)
+        print(f"Saved {len(results)} results to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+The benchmarked code paths.
+
+Each case is a function taking (bench, scale, density) that does its setup and returns a
+function which runs the path being measured once. Cases are prepared again before every
+repetition, so paths that change the database always start from the same state.
+"""
+import itertools
+import random
+
+import hatch.contest as contest
+import hatch.outbox as outbox
+import hatch.paging as paging
+import hatch.prohibitions as prohibitions
+import hatch.santa as santa
+from hatch.members import MemberResolver
+from hatch.pairing import find_pairing, make_circular_pairs, PairingError
+
+# Winners drawn by the partial draw case
+DRAW_COUNT = 10
+
+# Unique names for the contests and exchanges created by database cases
+serial = itertools.count(1)
+
+
+class FakeMember:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.display_name = f"Member {user_id}"
+
+
+class FakeGuild:
+    """
+    This class stands in for a discord.py guild whose members are not cached, so every name
+    is looked up with a member query, as it is in production.
+    """
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+    def get_member(self, user_id):
+        return None
+
+    async def query_members(self, user_ids, limit, cache):
+        return [FakeMember(user_id) for user_id in user_ids]
+
+
+def participants(scale):
+    # Realistic snowflakes, so ids hash and compare as they do in production
+    return [10 ** 17 + user_id for user_id in range(scale)]
+
+
+def prohibited_pairs(rng, users, density):
+    """ Returns about density random prohibitions per participant """
+    count = int(len(users) * density)
+    pairs = set()
+    while len(pairs) < min(count, len(users) * (len(users) - 1) // 2):
+        first, second = rng.sample(users, 2)
+        pairs.add(prohibitions.canonical(first, second))
+    return pairs
+
+
+def pairing(bench, scale, density):
+    users = participants(scale)
+    prohibited = prohibited_pairs(bench.rng, users, density)
+    rng = random.Random(bench.seed)
+
+    def run():
+        try:
+            find_pairing(users, prohibited, rng=rng)
+        except PairingError:
+            pass
+    return run
+
+
+def circular_pairs(bench, scale, density):
+    users = participants(scale)
+    return lambda: list(make_circular_pairs(users))
+
+
+def prohibition_check(bench, scale, density):
+    users = participants(scale)
+    scopes = {prohibitions.ALL_EXCHANGES: prohibited_pairs(bench.rng, users, density)}
+    matches = list(make_circular_pairs(users))
+
+    def run():
+        pairs = prohibitions.pairs_for(scopes, "bench")
+        return [match for match in matches if prohibitions.is_prohibited(pairs, *match)]
+    return run
+
+
+def add_entries(session, cid, entrants):
+    session.execute(contest.Entry.__table__.insert(),
+                    [dict(contest=cid, user_id=user_id, win_rank=None, tickets=tickets) for user_id, tickets in entrants])
+
+
+def weighted_entrants(rng, scale, weighted):
+    """ Returns (user_id, tickets) entrants, with 1 to 10 tickets each if weighted """
+    return [(user_id, rng.randint(1, 10) if weighted else 1) for user_id in participants(scale)]
+
+
+def contest_draw(count, weighted=False):
+    """ Returns a case drawing count winners, or every entry if count is None """
+    def case(bench, scale, density):
+        name = f"bench{next(serial)}"
+        cid = bench.run_db(contest.create_contest, bench.guild_id, 1, name)
+        bench.run_db(add_entries, cid, weighted_entrants(bench.rng, scale, weighted))
+
+        def run():
+            bench.run_db(contest.draw_winners, cid, count, f"bench{next(serial)}")
+            bench.run_db(contest.get_winners, cid, 0, paging.PAGE_SIZE + 1)
+        return run
+    return case
+
+
+def weighted_order(bench, scale, density):
+    entrants = weighted_entrants(bench.rng, scale, True)
+    rng = random.Random(bench.seed)
+    return lambda: contest.weighted_order(entrants, DRAW_COUNT, rng)
+
+
+def santa_close(bench, scale, density):
+    name = f"bench{next(serial)}"
+    users = participants(scale)
+    prohibited = prohibited_pairs(bench.rng, users, density)
+    bench.run_db(santa.create_exchange, bench.guild_id, 1, name)
+    bench.run_db(santa.join_exchange, bench.guild_id, name, users)
+    rng = random.Random(bench.seed)
+
+    def run():
+        registrants = bench.run_db(santa.get_registrant_ids, bench.guild_id, name)
+        try:
+            matches = find_pairing(registrants, prohibited, rng=rng)
+        except PairingError:
+            return
+        assignments = [outbox.outbox_message(f"bench:{name}:{santa_id}", santa_id,
+                                             santa.assignment_message(name, f"Member {target_id}"), batch=name)
+                       for santa_id, target_id in matches]
+        bench.run_db(santa.record_pairs, bench.guild_id, name, matches, assignments)
+    return run
+
+
+def assignment_messages(bench, scale, density):
+    names = [f"Member {user_id}" for user_id in participants(scale)]
+    return lambda: [santa.assignment_message("bench", name) for name in names]
+
+
+def listing(bench, scale, density):
+    names = [f"Member {user_id}" for user_id in participants(scale)]
+    return lambda: paging.split_message("The registered Santas for bench are: " + ", ".join(names))
+
+
+def resolve_names(bench, scale, density):
+    users = participants(scale)
+    guild = FakeGuild(bench.guild_id)
+    resolver = MemberResolver(None)
+
+    def run():
+        # Every repetition starts cold, so it measures the batched queries rather than cache hits
+        resolver.names.clear()
+        bench.loop.run_until_complete(resolver.resolve(guild, users))
+    return run
+
+
+# (name, case, uses the database, prohibition densities)
+CASES = [
+    ("pairing.find_pairing", pairing, False, (0, 0.1, 1)),
+    ("pairing.make_circular_pairs", circular_pairs, False, (0,)),
+    ("prohibitions.check", prohibition_check, False, (0.1, 1)),
+    ("contest.draw", contest_draw(DRAW_COUNT), True, (0,)),
+    ("contest.draw_all", contest_draw(None), True, (0,)),
+    ("contest.draw_weighted", contest_draw(DRAW_COUNT, weighted=True), True, (0,)),
+    ("contest.weighted_order", weighted_order, False, (0,)),
+    ("santa.close", santa_close, True, (0, 1)),
+    ("render.assignment_messages", assignment_messages, False, (0,)),
+    ("render.listing", listing, False, (0,)),
+    ("members.resolve", resolve_names, False, (0,)),
+]
@@ -0,0 +1,485 @@
+"""
+Replays command traffic against the Contests and SecretSanta cogs, without Discord.
+
+    python -m bench.loadgen [--guilds 2] [--users 500] [--concurrency 50] [--rate 0]
+    python -m bench.loadgen --write stream.jsonl     # save the synthetic stream
+    python -m bench.loadgen --replay stream.jsonl    # replay a saved or recorded one
+
+The cogs run against fake guilds, members and channels, and a temporary SQLite database or the
+one given with --database. Every Discord call the fakes stand in for waits --api-latency
+milliseconds. A stream is one JSON object per line, either
+{"command": "santa join", "user": 1, "guild": 1, "args": ["name"], "kwargs": {}}, with a null
+guild for direct messages, or {"barrier": true}, which waits for everything before it to finish.
+
+Each command's p50/p95/p99 latency, throughput and error rate are reported. A command errors
+if it raises, or if a reply mentions an error.
+
+Before the stream, --burst members of a guild of their own enter a contest all at once, while
+a task measures how late the event loop wakes it. The run exits with status 1 if the loop fell
+further behind than --lag-threshold milliseconds during the burst.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+
+import hatch.metrics as metrics
+import hatch.migrations as migrations
+from hatch.contest import Contests
+from hatch.database import Database
+from hatch.dispatch import Dispatcher, TokenBucket
+from hatch.members import MemberResolver
+from hatch.outbox import Outbox
+from hatch.santa import SecretSanta
+
+# Users in one guild have ids starting at guild id * this
+GUILD_STRIDE = 10 ** 6
+# Winners drawn by each synthetic draw
+DRAW_COUNT = 10
+# Share of Santas who send a message, and of targets who reply, after an exchange closes
+RELAY_SHARE = 0.2
+
+snowflakes = itertools.count(10 ** 17)
+
+
+class FakeMessage:
+    def __init__(self, channel, author=None, guild=None, content=""):
+        self.id = next(snowflakes)
+        self.channel = channel
+        self.author = author
+        self.guild = guild
+        self.content = content
+        self.attachments = []
+
+    async def add_reaction(self, emoji):
+        await self.channel.harness.call_api()
+
+    async def remove_reaction(self, emoji, member):
+        await self.channel.harness.call_api()
+
+    async def clear_reactions(self):
+        await self.channel.harness.call_api()
+
+    async def edit(self, **fields):
+        await self.channel.harness.call_api()
+
+
+class FakeChannel:
+    def __init__(self, harness, channel_id):
+        self.harness = harness
+        self.id = channel_id
+
+    async def send(self, content=None, embed=None, **options):
+        await self.harness.call_api()
+        return FakeMessage(self, content=content or "")
+
+
+class FakeUser:
+    def __init__(self, harness, user_id):
+        self.harness = harness
+        self.id = user_id
+        self.display_name = f"Member {user_id}"
+        self.bot = False
+        self.guild_permissions = type("Permissions", (), {"manage_guild": False})()
+
+    async def send(self, content=None, **options):
+        await self.harness.call_api()
+        self.harness.direct_messages += 1
+
+
+class FakeGuild:
+    """
+    This class stands in for a guild whose members are not cached, so names are looked up
+    with member queries as they are in production.
+    """
+    def __init__(self, harness, guild_id):
+        self.harness = harness
+        self.id = guild_id
+
+    def get_member(self, user_id):
+        return None
+
+    async def query_members(self, user_ids, limit, cache):
+        await self.harness.call_api()
+        return [self.harness.user(user_id) for user_id in user_ids]
+
+
+class FakeContext:
+    def __init__(self, harness, author, guild, channel):
+        self.bot = harness
+        self.message = FakeMessage(channel, author, guild)
+        self.invoked_subcommand = None
+        self.replies = list()
+
+    async def send(self, content=None, embed=None, **options):
+        self.replies.append(content or "")
+        return await self.message.channel.send(content, embed=embed, **options)
+
+
+class Harness:
+    """
+    This class plays the part of the discord.py bot for the cogs: it hands out fake users,
+    guilds and channels, and makes every API call take a fixed time.
+    """
+    def __init__(self, api_latency):
+        self.api_latency = api_latency
+        self.users = dict()
+        self.guild_objects = dict()
+        self.channels = dict()
+        self.direct_messages = 0
+
+    async def call_api(self):
+        if self.api_latency > 0:
+            started = time.perf_counter()
+            await asyncio.sleep(self.api_latency)
+            # Counted as Discord time, as the HTTP client hook would in production
+            usage = metrics.current.get()
+            if usage is not None:
+                usage.add_request(time.perf_counter() - started)
+
+    def user(self, user_id):
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = FakeUser(self, user_id)
+        return user
+
+    @property
+    def guilds(self):
+        return list(self.guild_objects.values())
+
+    def get_user(self, user_id):
+        return self.user(user_id)
+
+    async def fetch_user(self, user_id):
+        await self.call_api()
+        return self.user(user_id)
+
+    def get_guild(self, guild_id):
+        guild = self.guild_objects.get(guild_id)
+        if guild is None:
+            guild = self.guild_objects[guild_id] = FakeGuild(self, guild_id)
+        return guild
+
+    def get_channel(self, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = FakeChannel(self, channel_id)
+        return channel
+
+    async def wait_for(self, event, check=None, timeout=None):
+        # Nobody turns the pages of a paged listing
+        raise asyncio.TimeoutError()
+
+    def dispatch(self, event, *args):
+        pass
+
+    def context(self, user_id, guild_id):
+        if guild_id is None:
+            return FakeContext(self, self.user(user_id), None, self.get_channel(user_id))
+        return FakeContext(self, self.user(user_id), self.get_guild(guild_id), self.get_channel(guild_id))
+
+
+def step(command, user, guild, *args, **kwargs):
+    return dict(command=command, user=user, guild=guild, args=list(args), kwargs=kwargs)
+
+
+BARRIER = dict(barrier=True)
+
+
+def synthetic_stream(guilds, users, seed):
+    """
+    Returns a holiday event for each guild: a contest that everyone enters and that is drawn,
+    and a Secret Santa exchange that everyone joins, that closes, and whose Santas and targets
+    then message each other
+    """
+    rng = random.Random(seed)
+    members = {guild_id: [guild_id * GUILD_STRIDE + index for index in range(1, users + 1)]
+               for guild_id in range(1, guilds + 1)}
+
+    def interleave(per_guild):
+        steps = [entry for steps in per_guild for entry in steps]
+        rng.shuffle(steps)
+        return steps
+
+    stream = list()
+    for guild_id, user_ids in members.items():
+        owner = user_ids[0]
+        stream.append(step("contest open", owner, guild_id, "holiday"))
+        stream.append(step("santa create", owner, guild_id, "holiday"))
+    stream.append(BARRIER)
+
+    stream.extend(interleave(
+        [step("contest enter", user_id, guild_id, "holiday") for user_id in user_ids] +
+        [step("santa join", user_id, guild_id, "holiday") for user_id in user_ids]
+        for guild_id, user_ids in members.items()))
+    stream.append(BARRIER)
+
+    for guild_id, user_ids in members.items():
+        owner = user_ids[0]
+        stream.append(step("contest list", owner, guild_id, "holiday"))
+        stream.append(step("santa list", owner, guild_id, "holiday"))
+    stream.append(BARRIER)
+
+    for guild_id, user_ids in members.items():
+        owner = user_ids[0]
+        stream.append(step("contest draw", owner, guild_id, "holiday", str(DRAW_COUNT)))
+        stream.append(step("santa close", owner, guild_id, "holiday"))
+    stream.append(BARRIER)
+
+    for guild_id, user_ids in members.items():
+        owner = user_ids[0]
+        stream.append(step("contest winners", owner, guild_id, "holiday"))
+        stream.append(step("contest close", owner, guild_id, "holiday"))
+    stream.extend(interleave(
+        [step("santa message", user_id, None, "holiday", santa_message="Happy holidays!")
+         for user_id in rng.sample(user_ids, int(len(user_ids) * RELAY_SHARE))] +
+        [step("santa reply", user_id, None, "holiday", target_message="Thank you!")
+         for user_id in rng.sample(user_ids, int(len(user_ids) * RELAY_SHARE))]
+        for guild_id, user_ids in members.items()))
+    return stream
+
+
+def read_stream(path):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def write_stream(path, stream):
+    with open(path, "w") as file:
+        for entry in stream:
+            file.write(json.dumps(entry) + "\n")
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0
+
+
+class LagSampler:
+    """
+    This class measures event loop lag: how late the loop wakes a task that sleeps for interval
+    seconds, which is how long a gateway heartbeat would have been held up at that moment.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.lags = list()
+        self.task = None
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            due = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - due))
+
+    def start(self):
+        self.lags.clear()
+        self.task = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+
+    def report(self, during, threshold):
+        return (f"Event loop lag during {during}: p99 {percentile(self.lags, 0.99) * 1000:.1f}ms, "
+                f"max {max(self.lags, default=0) * 1000:.1f}ms over {len(self.lags)} samples, "
+                f"threshold {threshold * 1000:.0f}ms")
+
+
+class LoadGenerator:
+    """
+    This class replays a stream of commands against the cogs, keeping up to concurrency
+    commands in flight and starting at most rate of them a second.
+    """
+    def __init__(self, harness, cogs, concurrency, rate):
+        self.harness = harness
+        self.cogs = cogs
+        self.concurrency = concurrency
+        self.rate = rate
+        self.latencies = dict()
+        self.errors = dict()
+
+    async def run_step(self, entry):
+        group, name = entry["command"].split()
+        cog = self.cogs[group]
+        command = getattr(cog, name)
+        ctx = self.harness.context(entry["user"], entry.get("guild"))
+
+        usage = metrics.Usage()
+        metrics.current.set(usage)
+        failed = False
+        started = time.perf_counter()
+        try:
+            await command.callback(cog, ctx, *entry.get("args", ()), **entry.get("kwargs", {}))
+            failed = any("error" in reply.lower() for reply in ctx.replies)
+        except Exception as error:
+            print(f"{entry['command']} raised {error!r}")
+            failed = True
+        elapsed = time.perf_counter() - started
+        metrics.current.set(None)
+        metrics.record(entry["command"], usage, failed)
+        self.latencies.setdefault(entry["command"], list()).append(elapsed)
+        if failed:
+            self.errors[entry["command"]] = self.errors.get(entry["command"], 0) + 1
+
+    async def replay(self, stream):
+        """ Runs every step of a stream, and returns how long it took """
+        slots = asyncio.Semaphore(self.concurrency)
+        bucket = TokenBucket(self.rate, 1.0) if self.rate > 0 else None
+        pending = set()
+
+        async def run(entry):
+            try:
+                await self.run_step(entry)
+            finally:
+                slots.release()
+
+        started = time.perf_counter()
+        for entry in stream:
+            if entry.get("barrier"):
+                await asyncio.gather(*pending)
+                pending.clear()
+                continue
+            if bucket is not None:
+                await bucket.acquire()
+            await slots.acquire()
+            pending.add(asyncio.ensure_future(run(entry)))
+        await asyncio.gather(*pending)
+        return time.perf_counter() - started
+
+    def report(self, elapsed):
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        lines = [f"{total} commands in {elapsed:.2f}s, {total / elapsed:.1f} commands/s, "
+                 f"{self.harness.direct_messages} direct messages delivered",
+                 "command              count  errors   err%   p50 ms   p95 ms   p99 ms    per s"]
+        for command, latencies in sorted(self.latencies.items()):
+            errors = self.errors.get(command, 0)
+            lines.append(f"{command:<20} {len(latencies):>6} {errors:>7} {errors / len(latencies):>6.1%}"
+                         f" {percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.95) * 1000:>8.1f}"
+                         f" {percentile(latencies, 0.99) * 1000:>8.1f} {len(latencies) / elapsed:>8.1f}")
+        return "\n".join(lines)
+
+
+def burst_stream(guild_id, count):
+    """ Returns a contest in a guild of its own, followed by count members entering it at once """
+    owner = guild_id * GUILD_STRIDE + 1
+    return ([step("contest open", owner, guild_id, "burst"), BARRIER],
+            [step("contest enter", owner + index, guild_id, "burst") for index in range(count)])
+
+
+async def enter_burst(harness, cogs, args, guild_id):
+    """
+    Has args.burst members enter a contest concurrently while sampling the event loop's lag.
+    Returns true if the lag stayed within args.lag_threshold.
+    """
+    opening, entries = burst_stream(guild_id, args.burst)
+    await LoadGenerator(harness, cogs, 1, 0).replay(opening)
+    generator = LoadGenerator(harness, cogs, args.burst, 0)
+
+    sampler = LagSampler(args.lag_interval / 1000)
+    sampler.start()
+    elapsed = await generator.replay(entries)
+    await sampler.stop()
+
+    threshold = args.lag_threshold / 1000
+    print(generator.report(elapsed))
+    print(sampler.report(f"{args.burst} concurrent contest enters", threshold))
+    print()
+    return max(sampler.lags, default=0) <= threshold
+
+
+async def load_test(args, stream):
+    """ Runs the burst and then the stream, and returns the exit status """
+    directory = None
+    url = args.database
+    if url is None:
+        directory = tempfile.TemporaryDirectory()
+        url = "sqlite:///" + os.path.join(directory.name, "loadgen.db")
+    engine = create_engine(url)
+    migrations.upgrade(engine)
+    metrics.instrument_engine(engine)
+    db = Database(engine)
+
+    guild_ids = {entry.get("guild") for entry in stream} - {None}
+    harness = Harness(args.api_latency / 1000)
+    members = MemberResolver(harness)
+    outbox = Outbox(harness, db, Dispatcher(harness))
+    cogs = dict(contest=Contests(harness, db, members), santa=SecretSanta(harness, db, members, outbox))
+    await outbox.on_ready()
+    # The bot is connected to every guild in the stream, and the cogs index them as they
+    # do when it connects, so listings are read from the index
+    for guild_id in guild_ids:
+        harness.get_guild(guild_id)
+    # The burst gets a guild of its own, so its contest and members don't touch the stream's
+    burst_guild = max(guild_ids, default=0) + 1
+    harness.get_guild(burst_guild)
+    for cog in cogs.values():
+        await cog.warm_index()
+    try:
+        within_threshold = True
+        if args.burst > 0:
+            within_threshold = await enter_burst(harness, cogs, args, burst_guild)
+
+        generator = LoadGenerator(harness, cogs, args.concurrency, args.rate)
+        sampler = LagSampler(args.lag_interval / 1000)
+        sampler.start()
+        elapsed = await generator.replay(stream)
+        await sampler.stop()
+        if args.drain > 0:
+            # Give the outbox time to deliver the assignments and relays
+            await asyncio.sleep(args.drain)
+        print(generator.report(elapsed))
+        print(sampler.report("the stream", args.lag_threshold / 1000))
+        print()
+        print(metrics.format_stats())
+        if not within_threshold:
+            print(f"Event loop lag exceeded {args.lag_threshold:.0f}ms during the burst")
+            return 1
+        return 0
+    finally:
+        outbox.cog_unload()
+        db.close()
+        if directory is not None:
+            directory.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.loadgen",
+                                     description="Replay command traffic against the cogs without Discord.")
+    parser.add_argument("--guilds", type=int, default=2, help="guilds in the synthetic stream")
+    parser.add_argument("--users", type=int, default=500, help="members of each guild in the synthetic stream")
+    parser.add_argument("--replay", help="replay this stream instead of a synthetic one")
+    parser.add_argument("--write", help="write the stream to this file and exit")
+    parser.add_argument("--concurrency", type=int, default=50, help="commands in flight at once")
+    parser.add_argument("--rate", type=float, default=0, help="commands started per second, 0 for no limit")
+    parser.add_argument("--api-latency", type=float, default=50, help="milliseconds each Discord call takes")
+    parser.add_argument("--drain", type=float, default=0, help="seconds to let the outbox deliver afterwards")
+    parser.add_argument("--database", help="database URL, defaulting to a temporary SQLite file")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--burst", type=int, default=100,
+                        help="members entering a contest at once while loop lag is measured, 0 to skip")
+    parser.add_argument("--lag-threshold", type=float, default=100,
+                        help="milliseconds of event loop lag the burst may cause before the run fails")
+    parser.add_argument("--lag-interval", type=float, default=10, help="milliseconds between lag samples")
+    args = parser.parse_args()
+
+    stream = read_stream(args.replay) if args.replay else synthetic_stream(args.guilds, args.users, args.seed)
+    if args.write:
+        write_stream(args.write, stream)
+        print(f"Wrote {len(stream)} steps to {args.write}")
+        return
+    sys.exit(asyncio.run(load_test(args, stream)))
+
+
+if __name__ == "__main__":
+    main()
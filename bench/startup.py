@@ -0,0 +1,74 @@
+"""
+Measures how long the bot's modules take to import.
+
+    python -m bench.startup [--top 15] [--save FILE] [--compare FILE]
+
+Each module is imported in a fresh interpreter with `python -X importtime`. The report gives
+the total for each module and the slowest modules it pulled in. The bot logs the rest of its
+startup, through to on_ready, when it connects.
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+from bench.__main__ import DEFAULT_TOLERANCE
+
+# Importing hatchling must stay cheap, as every cluster worker does it; the cogs are loaded as extensions
+MODULES = ["hatchling", "hatch.migrations", "hatch.santa", "hatch.contest", "hatch.outbox", "hatch.metrics"]
+# Runs used for each module, keeping the fastest
+RUNS = 3
+
+
+def import_times(module):
+    """ Returns (total microseconds, {imported module: cumulative microseconds}) for one import """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+    cumulative = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, total, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(total)
+    return cumulative.get(module, 0), cumulative
+
+
+def measure(module):
+    return min((import_times(module) for _ in range(RUNS)), key=lambda times: times[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.startup", description="Measure import times.")
+    parser.add_argument("--top", type=int, default=10, help="slowest imports to list for each module")
+    parser.add_argument("--save", help="write the totals to this file")
+    parser.add_argument("--compare", help="compare the totals with this saved baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    totals = dict()
+    for module in MODULES:
+        total, cumulative = measure(module)
+        totals[module] = total
+        print(f"{module}: {total / 1000:.1f}ms")
+        slowest = sorted(((spent, name) for name, spent in cumulative.items() if name != module), reverse=True)
+        for spent, name in slowest[:args.top]:
+            print(f"    {spent / 1000:>8.1f}ms  {name}")
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(totals, file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        slower = [module for module, total in totals.items()
+                  if module in baseline and total > baseline[module] * (1 + args.tolerance)]
+        for module in slower:
+            print(f"REGRESSION {module}: {baseline[module] / 1000:.1f}ms -> {totals[module] / 1000:.1f}ms")
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
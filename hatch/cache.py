@@ -0,0 +1,212 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+DEFAULT_MAXSIZE = 1024
+DEFAULT_TTL = 300
+
+# Every named cache, so their counters can be reported together
+registry = dict()
+# Every cache that can be invalidated by name, including ones that aren't LRUCaches
+invalidators = dict()
+# Called with (cache name, key) whenever a key is invalidated in this process, so other
+# processes can be told to drop it too
+invalidation_hooks = list()
+
+
+def broadcast(name, key):
+    """ Passes a local invalidation on to the invalidation hooks """
+    for hook in invalidation_hooks:
+        hook(name, key)
+
+
+class LRUCache:
+    """
+    A least-recently-used cache whose entries also expire ttl seconds after they are stored.
+    None is a valid cached value, so lookups for things that don't exist are cached too.
+    Hits and misses are counted so the cache's effectiveness can be reported.
+    """
+    def __init__(self, name, maxsize=DEFAULT_MAXSIZE, ttl=DEFAULT_TTL):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Bumped on every invalidation, so loads which raced with a write are not stored
+        self.version = 0
+        # Loads in progress, so concurrent misses for the same key share one load
+        self.loading = dict()
+        registry[name] = self
+        invalidators[name] = self
+
+    def lookup(self, key):
+        """ Returns a tuple of (found, value) """
+        entry = self.entries.get(key)
+        if entry is not None:
+            value, expires = entry
+            if expires > time.monotonic():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, value
+            del self.entries[key]
+        self.misses += 1
+        return False, None
+
+    def store(self, key, value, version=None):
+        """ Caches a value. If version is given, the value is only stored if nothing was invalidated since """
+        if version is not None and version != self.version:
+            return
+        self.entries[key] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    async def get_or_load(self, key, load):
+        """ Returns the cached value for a key, or awaits load() to fetch and cache it """
+        found, value = self.lookup(key)
+        if found:
+            return value
+
+        pending = self.loading.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        version = self.version
+        pending = asyncio.ensure_future(load())
+        self.loading[key] = pending
+        try:
+            value = await asyncio.shield(pending)
+        finally:
+            del self.loading[key]
+        self.store(key, value, version)
+        return value
+
+    def invalidate(self, key, local=False):
+        """ Drops a key from the cache, and from other processes' copies unless local is true """
+        self.version += 1
+        self.entries.pop(key, None)
+        if not local:
+            broadcast(self.name, key)
+
+    def clear(self):
+        """ Drops every key from the cache """
+        self.version += 1
+        self.entries.clear()
+
+    def stats(self):
+        """ Returns the cache's counters """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "maxsize": self.maxsize,
+        }
+
+
+class GuildIndex:
+    """
+    An in-process index of the open events in each guild, mapping their names to entry counts.
+    Every guild is loaded at once when the bot connects, and commands keep the index current
+    as they change things, so listing what is open needs no query. A guild that isn't loaded
+    is read with one query the first time it is needed.
+
+    A change to a guild that isn't loaded can't be applied, so it stops any load of that guild
+    in progress from being stored, as the load may have read the database from before it.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.guilds = dict()
+        self.hits = 0
+        self.misses = 0
+        # Bumped when every guild is dropped, and for each guild that changed while not loaded
+        self.version = 0
+        self.changes = dict()
+        registry[name] = self
+        invalidators[name] = self
+
+    def snapshot(self):
+        """ Returns the versions to pass to store for a load starting now """
+        return self.version, dict(self.changes)
+
+    def store(self, rows, guild_ids, snapshot):
+        """
+        Indexes (guild_id, name, count) rows for the guilds in guild_ids, which have nothing
+        open if they have no rows. Guilds which changed since the snapshot was taken are skipped.
+        """
+        version, changes = snapshot
+        if version != self.version:
+            return
+        loaded = dict()
+        for guild_id in guild_ids:
+            if guild_id not in self.guilds and self.changes.get(guild_id, 0) == changes.get(guild_id, 0):
+                loaded[guild_id] = dict()
+        for guild_id, name, count in rows:
+            if guild_id in loaded:
+                loaded[guild_id][name] = count
+        self.guilds.update(loaded)
+
+    async def get_or_load(self, guild_id, load):
+        """ Returns a guild's {name: count} index, awaiting load() for its rows if it isn't loaded """
+        events = self.guilds.get(guild_id)
+        if events is not None:
+            self.hits += 1
+            return events
+        self.misses += 1
+        snapshot = self.snapshot()
+        rows = await load()
+        self.store(rows, [guild_id], snapshot)
+        # Read from the rows in case a change raced with the load and they weren't stored
+        return self.guilds.get(guild_id, {name: count for _, name, count in rows})
+
+    def page(self, events, after=None, limit=None):
+        """ Returns up to limit (name, count) pairs of an index in name order, starting after the name after """
+        names = sorted(name for name in events if after is None or name > after)
+        return [(name, events[name]) for name in names[:limit]]
+
+    def changed(self, guild_id):
+        """ Returns a guild's index to be updated in place, or None after noting the change """
+        events = self.guilds.get(guild_id)
+        if events is None:
+            self.changes[guild_id] = self.changes.get(guild_id, 0) + 1
+        return events
+
+    def add(self, guild_id, name, count=0):
+        """ Indexes a newly opened event """
+        events = self.changed(guild_id)
+        if events is not None:
+            events[name] = count
+
+    def discard(self, guild_id, name):
+        """ Drops an event which closed """
+        events = self.changed(guild_id)
+        if events is not None:
+            events.pop(name, None)
+
+    def count(self, guild_id, name, delta):
+        """ Adjusts the entry count of an open event """
+        events = self.changed(guild_id)
+        if events is not None and name in events:
+            events[name] = max(0, events[name] + delta)
+
+    def invalidate(self, guild_id, local=False):
+        """ Drops a guild, to be read again, and other processes' copies unless local is true """
+        self.guilds.pop(guild_id, None)
+        self.changes[guild_id] = self.changes.get(guild_id, 0) + 1
+        if not local:
+            broadcast(self.name, guild_id)
+
+    def clear(self):
+        """ Drops every guild """
+        self.version += 1
+        self.guilds.clear()
+
+    def stats(self):
+        """ Returns the index's counters """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self.guilds),
+            # Every guild served by this process is kept
+            "maxsize": None,
+        }
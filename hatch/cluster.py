@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing
+import signal
+import time
+
+import discord
+
+# Discord lets a bot identify one shard every 5 seconds, so workers start this far apart per shard
+IDENTIFY_INTERVAL = 5
+# Delay before restarting a worker that crashed, doubled each time it crashes again quickly
+RESTART_DELAY = 5
+RESTART_DELAY_MAX = 300
+# A worker that stayed up this long is considered healthy again, in seconds
+STABLE_UPTIME = 600
+SUPERVISE_INTERVAL = 1
+
+
+def shard_ranges(shard_count, processes):
+    """ Splits the shard ids into contiguous ranges, one for each process """
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = list()
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+async def recommended_shard_count(token):
+    """ Asks Discord how many shards the bot should use """
+    http = discord.http.HTTPClient()
+    try:
+        await http.static_login(token, bot=True)
+        shard_count, _ = await http.get_bot_gateway()
+        return shard_count
+    finally:
+        await http.close()
+
+
+class Worker:
+    """
+    This class is one bot process of the cluster, and the shards it owns.
+    """
+    def __init__(self, index, shard_ids):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.process = None
+        self.started = None
+        self.restart_delay = RESTART_DELAY
+        self.restart_at = None
+
+
+class Cluster:
+    """
+    This class runs the bot as several processes, each owning a range of shards, and restarts
+    any that crash.
+
+    target(shard_ids, shard_count, processes) runs one bot process until it logs out. Workers
+    are started far enough apart that their shards don't identify at the same time. A worker
+    that exits cleanly stops the cluster, as it only does so when the bot is shut down.
+    """
+    def __init__(self, target, shard_count, processes):
+        self.target = target
+        self.shard_count = shard_count
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = [Worker(index, shard_ids) for index, shard_ids
+                        in enumerate(shard_ranges(shard_count, processes))]
+        self.stopping = False
+
+    def start(self, worker):
+        worker.process = self.context.Process(
+            target=self.target, args=(worker.shard_ids, self.shard_count, len(self.workers)),
+            name=f"hatch-cluster-{worker.index}")
+        worker.process.start()
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        print(f"Started cluster worker {worker.index} (pid {worker.process.pid}) "
+              f"for shards {worker.shard_ids[0]}-{worker.shard_ids[-1]} of {self.shard_count}")
+
+    def stop(self, *_):
+        self.stopping = True
+
+    def run(self):
+        """ Starts every worker and supervises them until the cluster is stopped """
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for worker in self.workers:
+            if self.stopping:
+                break
+            self.start(worker)
+            time.sleep(IDENTIFY_INTERVAL * len(worker.shard_ids))
+
+        while not self.stopping:
+            for worker in self.workers:
+                self.supervise(worker)
+            time.sleep(SUPERVISE_INTERVAL)
+        self.shutdown()
+
+    def supervise(self, worker):
+        if worker.process is None or worker.process.is_alive():
+            return
+        if worker.restart_at is None:
+            exit_code = worker.process.exitcode
+            if exit_code == 0:
+                print(f"Cluster worker {worker.index} exited, stopping the cluster")
+                self.stopping = True
+                return
+            if time.monotonic() - worker.started > STABLE_UPTIME:
+                worker.restart_delay = RESTART_DELAY
+            print(f"Cluster worker {worker.index} exited with code {exit_code}, "
+                  f"restarting in {worker.restart_delay}s")
+            worker.restart_at = time.monotonic() + worker.restart_delay
+            worker.restart_delay = min(RESTART_DELAY_MAX, worker.restart_delay * 2)
+        elif time.monotonic() >= worker.restart_at:
+            self.start(worker)
+
+    def shutdown(self):
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        for worker in self.workers:
+            if worker.process is not None:
+                worker.process.join()
+        print("Cluster stopped")
+
+
+def run_cluster(target, token, processes, shard_count=None):
+    """ Runs target in processes workers, splitting the shards between them """
+    if shard_count is None:
+        shard_count = asyncio.get_event_loop().run_until_complete(recommended_shard_count(token))
+    Cluster(target, shard_count, processes).run()
@@ -1,20 +1,37 @@
-import os
-from random import shuffle
-from asyncio import wait
+import heapq
+import math
+import random
+import re
+from datetime import datetime
 
 from discord.ext import commands
-from sqlalchemy import BigInteger, Boolean, create_engine, CheckConstraint, Column, Integer, \
-    ForeignKey, ForeignKeyConstraint, String, UniqueConstraint
+from sqlalchemy import and_, BigInteger, bindparam, Boolean, CheckConstraint, Column, DateTime, func, Index, \
+    Integer, ForeignKey, ForeignKeyConstraint, select, String, text
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
+import hatch.paging as paging
 import hatch.util as util
+from hatch.cache import GuildIndex, LRUCache
+from hatch.database import insert_ignore
+from hatch.ingest import BatchIngester
+from hatch.scheduler import format_when, schedule_from
 
 EXCHANGE_NAME_SIZE = 30
 
-def print_rank(winner, context):
-    return f"{winner.win_rank}. {util.get_displayname(winner.user_id, context)}"
+# Reacting with this emoji to a contest's entry message enters the contest
+ENTRY_EMOJI = "\U0001F389"
+# Reaction entries get no reply, so they can wait longer to be written in bigger batches
+REACTION_WINDOW = 1.0
+# Bonus tickets a role may give, on top of the ticket every entry has
+MAX_BONUS_TICKETS = 100
+ROLE_MENTION = re.compile(r"^<@&(\d+)>$")
+# Scheduler actions
+CLOSE_JOB = "contest close"
+DRAW_JOB = "contest draw"
+
+def print_rank(winner, name):
+    return f"{winner.win_rank}. {name}"
 
 Base = declarative_base()
 
@@ -30,8 +47,14 @@ class Contest(Base):
     owner_id = Column(BigInteger, nullable=False)
     open = Column(Boolean, nullable=False)
     num_winners = Column(Integer, nullable=True)
+    # Set when people enter by reacting to a message instead of with a command
+    entry_channel_id = Column(BigInteger, nullable=True)
+    entry_message_id = Column(BigInteger, nullable=True)
 
-    unique_name = UniqueConstraint('guild_id', 'name')
+    __table_args__ = (
+        Index("uq_contest_contest_guild_name", "guild_id", "name", unique=True),
+        Index("ix_contest_contest_open", "guild_id", "open"),
+    )
 
     def __repr__(self):
         return f"<ContestContest(name='{self.name}', guild_id='{self.guild_id}', owner_id='{self.owner_id}', drawn='{not self.open}')>"
@@ -46,24 +69,417 @@ class Entry(Base):
     contest = Column(Integer, ForeignKey("contest_contest.cid"), primary_key=True)
     user_id = Column(BigInteger, primary_key=True)
     win_rank = Column(Integer, nullable=True)
+    # The entry's odds of being drawn are in proportion to its tickets
+    tickets = Column(Integer, nullable=False, default=1, server_default="1")
+
+    __table_args__ = (
+        # Winners are listed and ranked by win_rank within a contest
+        Index("ix_contest_entries_rank", "contest", "win_rank"),
+    )
 
     def __repr__(self):
         return f"<ContestEntry(contest='{self.contest.name}', user_id='{self.user_id}', win_rank='{self.win_rank}''>"
 
 
-# Create the tables needed for the contest
-db_url = os.getenv("DATABASE_URL")
-engine = create_engine(db_url)
-Base.metadata.create_all(engine)
+class Bonus(Base):
+    """
+    This is an SQLAlchemy class representing the table of extra tickets given to members
+    with a role when they enter a contest.
+    """
+    __tablename__ = "contest_bonuses"
+
+    contest = Column(Integer, ForeignKey("contest_contest.cid"), primary_key=True)
+    role_id = Column(BigInteger, primary_key=True)
+    tickets = Column(Integer, nullable=False)
+
+    def __repr__(self):
+        return f"<ContestBonus(contest='{self.contest}', role_id='{self.role_id}', tickets='{self.tickets}')>"
+
+
+class Draw(Base):
+    """
+    This is an SQLAlchemy class representing the table recording each draw of a contest,
+    so a draw that is retried hands back its first result instead of drawing again.
+    """
+    __tablename__ = "contest_draws"
+
+    contest = Column(Integer, ForeignKey("contest_contest.cid"), primary_key=True)
+    # Identifies what asked for the draw, such as the id of the command's message
+    draw_key = Column(String(100), primary_key=True)
+    # The draw ranked its winners after this rank
+    after_rank = Column(Integer, nullable=False)
+    winners = Column(Integer, nullable=False)
+    drawn_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"<ContestDraw(contest='{self.contest}', draw_key='{self.draw_key}', winners='{self.winners}')>"
+
+
+# Outcomes of an attempt to enter a contest
+ENTERED = "entered"
+DUPLICATE = "duplicate"
+NOT_FOUND = "not_found"
+CLOSED = "closed"
+
+
+def find_contest(session, guild_id, contest_name):
+    """ Returns the contest with the given name in a guild, or None """
+    return session.query(Contest) \
+        .filter_by(name=contest_name, guild_id=guild_id) \
+        .one_or_none()
+
+
+def create_contest(session, guild_id, owner_id, contest_name):
+    """
+    Adds a new open contest and returns its id.
+    Raises IntegrityError if the name is already used
+    """
+    contest = Contest(
+        name=contest_name,
+        guild_id=guild_id,
+        owner_id=owner_id,
+        open=True,
+    )
+    session.add(contest)
+    session.flush()
+    return contest.cid
+
+
+def enter_contest(session, cid, entrants):
+    """
+    Registers a batch of (user_id, tickets) entrants for a contest with one lookup and one
+    multi-row insert. Returns the outcome for each entrant, in order.
+    """
+    user_ids = [user_id for user_id, _ in entrants]
+    # Checked again here, as the contest may have closed since the caller looked it up. The
+    # shared lock makes a close wait for entries being written, and entries wait for a close.
+    is_open = session.query(Contest.open).filter_by(cid=cid).with_for_update(read=True).scalar()
+    if is_open is None:
+        return [NOT_FOUND] * len(user_ids)
+    if not is_open:
+        return [CLOSED] * len(user_ids)
+
+    rows = [dict(contest=cid, user_id=user_id, tickets=tickets) for user_id, tickets in entrants]
+    inserted = insert_ignore(session, Entry, rows, ("contest", "user_id"))
+    return util.batch_outcomes(user_ids, [user_id for _, user_id in inserted], ENTERED, DUPLICATE)
+
+
+def get_open_contest_counts(session, guild_id=None):
+    """
+    Returns (guild_id, name, entry count) for the open contests in a guild, or in every guild
+    if guild_id is None, with one grouped query
+    """
+    query = session.query(Contest.guild_id, Contest.name, func.count(Entry.user_id)) \
+        .outerjoin(Entry, Entry.contest == Contest.cid) \
+        .filter(Contest.open == True)
+    if guild_id is not None:
+        query = query.filter(Contest.guild_id == guild_id)
+    return [tuple(row) for row in query.group_by(Contest.cid, Contest.guild_id, Contest.name).all()]
+
+
+def get_entry_ids(session, cid, after=None, limit=None):
+    """ Returns the user ids entered in a contest in order, starting after the user id after """
+    query = session.query(Entry.user_id).filter_by(contest=cid)
+    if after is not None:
+        query = query.filter(Entry.user_id > after)
+    return [entry.user_id for entry in query.order_by(Entry.user_id).limit(limit).all()]
+
+
+def close_contest(session, cid):
+    """ Marks a contest as closed. Returns false if it was already closed """
+    return session.query(Contest).filter_by(cid=cid, open=True).update({Contest.open: False}) > 0
+
+
+def set_entry_message(session, cid, channel_id, message_id):
+    """ Records the message people react to in order to enter a contest """
+    session.query(Contest) \
+        .filter_by(cid=cid) \
+        .update({Contest.entry_channel_id: channel_id, Contest.entry_message_id: message_id})
+
+
+def get_entry_messages(session):
+    """ Returns (cid, guild_id, name, channel_id, message_id) for every open contest entered by reaction """
+    return [tuple(row) for row in
+            session.query(Contest.cid, Contest.guild_id, Contest.name, Contest.entry_channel_id,
+                          Contest.entry_message_id)
+                .filter(Contest.open == True, Contest.entry_message_id.isnot(None))
+                .all()]
+
+
+def set_bonus(session, cid, role_id, tickets):
+    """ Sets the bonus tickets a role gives in a contest, removing the bonus if tickets is 0 """
+    session.query(Bonus).filter_by(contest=cid, role_id=role_id).delete(synchronize_session=False)
+    if tickets > 0:
+        session.add(Bonus(contest=cid, role_id=role_id, tickets=tickets))
+
+
+def get_bonuses(session, cid):
+    """ Returns a dict mapping role ids to the bonus tickets they give in a contest """
+    return {bonus.role_id: bonus.tickets for bonus in
+            session.query(Bonus.role_id, Bonus.tickets).filter_by(contest=cid).all()}
+
+
+def tickets_for(member, bonuses):
+    """ Returns the tickets a member's entry gets: one, plus the bonus of each of their roles """
+    return 1 + sum(bonuses.get(role.id, 0) for role in getattr(member, "roles", ()))
+
+
+def weighted_order(entries, count=None, rng=random):
+    """
+    Draws up to count (user_id, tickets) entries without replacement, each with odds in
+    proportion to its tickets, or puts all of them in drawn order if count is None.
+    Every entry gets the key -ln(u) / tickets for a uniform random u, and the smallest keys
+    win (Efraimidis and Spirakis), so the draw is one pass and a partial sort.
+    """
+    log, uniform = math.log, rng.random
+    # ln(u) / tickets is the negated key, so the largest win. Only the keys and their positions
+    # are sorted, which is much faster than building a tuple for every entry.
+    keys = [log(1.0 - uniform()) / tickets for _, tickets in entries]
+    if count is None:
+        drawn = sorted(range(len(keys)), key=keys.__getitem__, reverse=True)
+    else:
+        drawn = heapq.nlargest(count, range(len(keys)), key=keys.__getitem__)
+    return [entries[index][0] for index in drawn]
+
+
+def sample_entries(session, cid, count, exclude=()):
+    """
+    Draws up to count entries of a contest which have not won yet, or all of them in drawn
+    order if count is None, with odds in proportion to their tickets. Users in exclude are
+    not drawn. Postgres computes the draw keys itself, so only the drawn rows are read.
+    """
+    condition = and_(Entry.contest == cid, Entry.win_rank == None)
+    if len(exclude) > 0:
+        condition = and_(condition, Entry.user_id.notin_(exclude))
+
+    if session.bind.dialect.name == "postgresql":
+        # ln(u) / tickets, largest first, is the same order as -ln(u) / tickets smallest first
+        key = func.ln(1 - func.random()) / Entry.tickets
+        statement = select([Entry.user_id]).where(condition).order_by(key.desc()).limit(count)
+        return [row.user_id for row in session.execute(statement)]
+
+    # Other databases have no logarithm, so the draw keys are computed here
+    entries = session.execute(select([Entry.user_id, Entry.tickets]).where(condition)).fetchall()
+    return weighted_order(entries, count)
+
+
+def record_draw(session, cid, winner_ids, prev_winners):
+    """
+    Ranks newly drawn winners after the previous ones, in time that grows linearly with the winners
+    Returns the (user_id, win_rank) rows of the new winners
+    """
+    ranks = {user_id: rank for rank, user_id in enumerate(winner_ids, prev_winners + 1)}
+    if len(ranks) > 0 and session.bind.dialect.name == "postgresql":
+        # A single UPDATE joining the entries to the winners and their ranks, passed as two arrays
+        session.execute(text(
+            "UPDATE contest_entries SET win_rank = ranked.win_rank"
+            " FROM unnest(CAST(:user_ids AS BIGINT[]), CAST(:ranks AS INTEGER[])) AS ranked (user_id, win_rank)"
+            " WHERE contest_entries.contest = :cid AND contest_entries.user_id = ranked.user_id"),
+            dict(cid=cid, user_ids=list(ranks), ranks=list(ranks.values())))
+    elif len(ranks) > 0:
+        # Other databases update each winner's row by its primary key, in one executemany
+        table = Entry.__table__
+        statement = table.update() \
+            .where(and_(table.c.contest == bindparam("ranked_contest"), table.c.user_id == bindparam("ranked_user"))) \
+            .values(win_rank=bindparam("ranked_rank"))
+        session.execute(statement, [dict(ranked_contest=cid, ranked_user=user_id, ranked_rank=rank)
+                                    for user_id, rank in ranks.items()])
+
+    session.query(Contest).filter_by(cid=cid) \
+        .update({Contest.num_winners: prev_winners + len(winner_ids)}, synchronize_session=False)
+    return [Entry(contest=cid, user_id=user_id, win_rank=rank) for user_id, rank in ranks.items()]
+
+
+def draw_winners(session, cid, count, draw_key):
+    """
+    Draws up to count winners of a contest, or all of its remaining entries if count is None,
+    and ranks them after its previous winners. The contest's row is locked until the draw is
+    committed, so concurrent draws are ranked one after the other. A draw_key that was drawn
+    before gets that draw's result back, without drawing again.
+    Returns (after_rank, number of winners), where the winners are ranked after after_rank,
+    or None if the contest no longer exists.
+    """
+    contest = session.query(Contest).filter_by(cid=cid).with_for_update().one_or_none()
+    if contest is None:
+        return None
+    previous = session.query(Draw).get((cid, draw_key))
+    if previous is not None:
+        return previous.after_rank, previous.winners
+
+    after_rank = contest.num_winners or 0
+    winner_ids = sample_entries(session, cid, count)
+    record_draw(session, cid, winner_ids, after_rank)
+    session.add(Draw(contest=cid, draw_key=draw_key, after_rank=after_rank, winners=len(winner_ids),
+                     drawn_at=datetime.utcnow()))
+    return after_rank, len(winner_ids)
+
+
+def get_guild_entrant_ids(session, guild_id):
+    """ Returns the ids of users with entries in a guild's contests which have not won """
+    return [entry.user_id for entry in
+            session.query(Entry.user_id)
+                .join(Contest, Entry.contest == Contest.cid)
+                .filter(Contest.guild_id == guild_id, Entry.win_rank == None)
+                .distinct()
+                .all()]
+
+
+def remove_departed_entries(session, guild_id, user_ids):
+    """
+    Deletes the entries which have not won of users who left a guild, across all of its contests.
+    Returns the number of entries removed.
+    """
+    contests = session.query(Contest.cid).filter_by(guild_id=guild_id)
+    return session.query(Entry) \
+        .filter(Entry.contest.in_(contests), Entry.user_id.in_(user_ids), Entry.win_rank == None) \
+        .delete(synchronize_session=False)
+
+
+def get_winners(session, cid, after=0, limit=None, last=None):
+    """
+    Returns the (user_id, win_rank) rows of a contest's winners in rank order, starting after the
+    rank after and, if last is given, ending with the rank last
+    """
+    query = session.query(Entry.user_id, Entry.win_rank).filter(Entry.contest == cid, Entry.win_rank > after)
+    if last is not None:
+        query = query.filter(Entry.win_rank <= last)
+    return (query
+            .order_by(Entry.win_rank)
+            .limit(limit)
+            .all())
 
 
 class Contests(commands.cog.Cog):
     """
     This class defines a collection of Discord.py commands for running a contest
     """
-    def __init__(self, bot, db_engine):
+    def __init__(self, bot, db, members, scheduler=None):
         self.bot = bot
-        self.sessionmaker = sessionmaker(bind=db_engine)
+        self.db = db
+        self.members = members
+        self.scheduler = scheduler
+        if scheduler is not None:
+            scheduler.register(CLOSE_JOB, self.run_job)
+            scheduler.register(DRAW_JOB, self.run_job)
+        self.swept = False
+        self.entries = BatchIngester(self.flush_entries)
+        self.reaction_entries = BatchIngester(self.flush_entries, window=REACTION_WINDOW)
+        # Maps the id of each open contest's entry message to the contest's (cid, guild_id, name)
+        self.entry_messages = dict()
+        self.lookups = LRUCache("contests")
+        self.bonuses = LRUCache("contest bonuses")
+        self.open_contests = GuildIndex("open contests")
+        # Closes and draws of the same contest take turns; other contests aren't held up
+        self.locks = util.KeyedLocks()
+
+    async def flush_entries(self, key, entrants):
+        """ Writes a batch of buffered (user_id, tickets) entries, keyed by the contest's (cid, guild_id, name) """
+        cid, guild_id, contest_name = key
+        outcomes = await self.db.run(enter_contest, cid, entrants)
+        self.open_contests.count(guild_id, contest_name, outcomes.count(ENTERED))
+        return outcomes
+
+    async def get_open_contests(self, guild_id):
+        """ Returns the open contests in a guild as {name: entry count}, from the index """
+        return await self.open_contests.get_or_load(
+            guild_id, lambda: self.db.run(get_open_contest_counts, guild_id))
+
+    async def get_contest(self, guild_id, contest_name):
+        """ Returns the contest with a name in a guild, or None. Lookups are cached """
+        return await self.lookups.get_or_load(
+            (guild_id, contest_name), lambda: self.db.run(find_contest, guild_id, contest_name))
+
+    async def get_tickets(self, cid, member):
+        """ Returns the tickets a member's entry in a contest gets. Bonuses are cached """
+        bonuses = await self.bonuses.get_or_load(cid, lambda: self.db.run(get_bonuses, cid))
+        return tickets_for(member, bonuses)
+
+    def forget_contest(self, guild_id, contest_name):
+        """ Drops a contest from the lookup cache after it was changed """
+        self.lookups.invalidate((guild_id, contest_name))
+
+    async def run_job(self, job, context):
+        """ Runs a scheduled close or draw as the owner who scheduled it """
+        if job.action == CLOSE_JOB:
+            await self.close(context, job.target)
+        else:
+            await self.draw(context, job.target, job.argument or "")
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, guild_id, user_id):
+        """ Withdraws a departing member from the guild's contests """
+        removed = await self.db.run(remove_departed_entries, guild_id, [user_id])
+        if removed > 0:
+            # Which contests the entries were in isn't known, so the guild is read again
+            self.open_contests.invalidate(guild_id)
+            print(f"Removed {removed} contest entries of {user_id}, who left guild {guild_id}")
+
+    async def announce_winners(self, context, contest, after=0, last=None):
+        """ Sends the ranked list of a contest's winners, starting after the rank after and ending with the rank last """
+        async def render(winners):
+            names = await self.members.display_names(context.message.guild, [winner.user_id for winner in winners])
+            return [print_rank(winner, name) for winner, name in zip(winners, names)]
+
+        await paging.send_listing(
+            context, "Congrats to the following winners: \n\t",
+            lambda rank, limit: self.db.run(get_winners, contest.cid, rank, limit, last),
+            render, f"There are no winners for {contest.name}",
+            key=lambda winner: winner.win_rank, after=after, separator="\n\t")
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        """ Enters people who react to a contest's entry message, without replying to them """
+        key = self.entry_messages.get(payload.message_id)
+        if key is None or str(payload.emoji) != ENTRY_EMOJI:
+            return
+        if payload.member is None or payload.member.bot:
+            return
+        tickets = await self.get_tickets(key[0], payload.member)
+        await self.reaction_entries.submit(key, (payload.user_id, tickets))
+
+    async def catch_up_reactions(self):
+        """ Tracks the open contests' entry messages, and enters anyone who reacted while the bot was offline """
+        for cid, guild_id, name, channel_id, message_id in await self.db.run(get_entry_messages):
+            self.entry_messages[message_id] = (cid, guild_id, name)
+            user_ids = await util.get_reaction_user_ids(self.bot, channel_id, message_id, ENTRY_EMOJI)
+            if len(user_ids) > 0:
+                # Only users are known here, not their roles, so these entries get no bonus
+                await self.flush_entries((cid, guild_id, name), [(user_id, 1) for user_id in user_ids])
+
+    async def warm_index(self):
+        """ Indexes the open contests of every guild this process serves, with one query """
+        snapshot = self.open_contests.snapshot()
+        rows = await self.db.run(get_open_contest_counts)
+        guild_ids = [guild.id for guild in self.bot.guilds]
+        self.open_contests.store(rows, guild_ids, snapshot)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """
+        Indexes the open contests, picks up reaction entries and withdraws members who left
+        while the bot was offline, once per process
+        """
+        if self.swept:
+            return
+        self.swept = True
+        await self.warm_index()
+        await self.catch_up_reactions()
+
+        async def remove(guild, departed):
+            removed = await self.db.run(remove_departed_entries, guild.id, departed)
+            self.open_contests.invalidate(guild.id)
+            print(f"Removed {removed} contest entries of members who left guild {guild.id}")
+        await self.members.sweep_departed(
+            self.bot.guilds, lambda guild: self.db.run(get_guild_entrant_ids, guild.id), remove)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        """ Indexes a new guild's contests, which are none unless it is rejoining """
+        await self.get_open_contests(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.open_contests.invalidate(guild.id, local=True)
 
     @commands.group()
     async def contest(self, context):
@@ -71,11 +487,15 @@ class Contests(commands.cog.Cog):
         A group of commands to help with running a contest
         """
         if context.invoked_subcommand is None:
-            await context.send("Invalid command. Valid commands are [ close draw enter list open ]")
+            await context.send("Invalid command. Valid commands are [ bonus close draw enter list open schedule ]")
 
     @contest.command()
-    async def open(self, context, name=""):
-        """ Create a contest """
+    async def open(self, context, name="", mode=""):
+        """
+        Create a contest
+        Add "react" to let people enter by reacting to a message instead of with a command.
+        Format: !contest open <contest_name> [react]
+        """
         if not util.is_from_guild(context):
             await util.send(context, "This message only works in a server")
             return
@@ -83,27 +503,34 @@ class Contests(commands.cog.Cog):
             await util.send(context, "You must name your contest event." +
                             "\nExample: `!contest create RT2019`")
             return
+        if mode not in ("", "react"):
+            await util.send(context, "The entry mode must be left out, or be `react`." +
+                            "\nExample: `!contest open RT2019 react`")
+            return
 
-        contest = Contest(
-            name=name,
-            guild_id=context.message.guild.id,
-            owner_id=context.message.author.id,
-            open=True,
-        )
-
-        session = self.sessionmaker()
-        session.add(contest)
+        guild_id = context.message.guild.id
         try:
-            session.commit()
-            await util.send(context, f"The contest {name} has been created and opened." +
-                            f" You may join with the command `!contest enter {name}`")
+            cid = await self.db.run(create_contest, guild_id, context.message.author.id, name)
         except IntegrityError:
-            session.rollback()
             await util.send(context, f"The contest name {name} has already been used. Please try another")
+            return
         except:
-            session.rollback()
             await util.send(context, f"An error occurred trying to create contest {name}")
-        session.close()
+            return
+        finally:
+            self.forget_contest(guild_id, name)
+        self.open_contests.add(guild_id, name)
+
+        if mode == "react":
+            message = await util.post_entry_message(
+                context, f"The contest {name} has been created and opened. React with {ENTRY_EMOJI} to enter!",
+                ENTRY_EMOJI)
+            await self.db.run(set_entry_message, cid, message.channel.id, message.id)
+            self.forget_contest(guild_id, name)
+            self.entry_messages[message.id] = (cid, guild_id, name)
+        else:
+            await util.send(context, f"The contest {name} has been created and opened." +
+                            f" You may join with the command `!contest enter {name}`")
 
     @contest.command()
     async def enter(self, context, contest_name=""):
@@ -121,44 +548,28 @@ class Contests(commands.cog.Cog):
         user_id = context.message.author.id
         guild_id = context.message.guild.id
 
-        session = self.sessionmaker()
-
-        # Verify the contest is created and open for the current guild
-        contest = session.query(Contest) \
-            .filter_by(name=contest_name, guild_id=guild_id) \
-            .one_or_none()
-
-        if contest is None:
-            session.rollback()
-            session.close()
-            await context.send(f"Contest {contest_name} was not found")
+        try:
+            # Unknown and closed contests are turned away from the cache, without a database write
+            contest = await self.get_contest(guild_id, contest_name)
+            if contest is None:
+                outcome = NOT_FOUND
+            elif not contest.open:
+                outcome = CLOSED
+            else:
+                tickets = await self.get_tickets(contest.cid, context.message.author)
+                outcome = await self.entries.submit((contest.cid, guild_id, contest_name), (user_id, tickets))
+        except:
+            await util.send(context, f"There was an unknown error registering {username} for {contest_name}!")
             return
 
-        if not contest.open:
-            session.rollback()
-            session.close()
+        if outcome == NOT_FOUND:
+            await context.send(f"Contest {contest_name} was not found")
+        elif outcome == CLOSED:
             await context.send(f"Contest {contest_name} is closed. Please join the next contest")
-            return
-
-        # Check if the participant has already registered
-        if session.query(Entry) \
-                .filter_by(contest=contest.cid, user_id=user_id) \
-                .count() > 0:
-            session.rollback()
-            session.close()
+        elif outcome == DUPLICATE:
             await util.send(context, "No cheating! You already entered")
-            return
-
-        registration = Entry(contest=contest.cid, user_id=user_id)
-        session.add(registration)
-        try:
-            session.commit()
-            message = f"{username} has joined the contest {contest_name}!"
-        except:
-            session.rollback()
-            message = f"There was an unknown error registering {username} for {contest_name}!"
-        await util.send(context, message)
-        session.close()
+        else:
+            await util.send(context, f"{username} has joined the contest {contest_name}!")
 
     @contest.command()
     async def list(self, context, contest_name=""):
@@ -174,53 +585,35 @@ class Contests(commands.cog.Cog):
 
     async def list_contests(self, context):
         """ List the contests available in the context """
-        # Verify the contest is created for the current guild
         guild_id = context.message.guild.id
-        session = self.sessionmaker()
-        contests = [contest.name for contest in
-                     session.query(Contest)
-                         .filter_by(guild_id=guild_id, open=True)
-                         .all()]
-        session.close()
-
-        if len(contests) == 0:
-            message = "No contests are open for this server." + \
-                      "\n You may create them with the command `!contest create <contest_name>`"
-        else:
-            message = "The available contests are:\n\t" + "\n\t".join(contests) \
-                      + "\n You can view the participants of an contest with the command " \
-                      + "`!contest list <contest_name>`"
-        await util.send(context, message)
+
+        async def fetch_page(name, limit):
+            return self.open_contests.page(await self.get_open_contests(guild_id), name, limit)
+
+        async def render(contests):
+            return [f"{name} ({count} {'entry' if count == 1 else 'entries'})" for name, count in contests]
+
+        await paging.send_listing(
+            context, "The available contests are:\n\t", fetch_page,
+            render, "No contests are open for this server." +
+                    "\n You may create them with the command `!contest create <contest_name>`",
+            key=lambda contest: contest[0], separator="\n\t",
+            footer="\n You can view the participants of an contest with the command `!contest list <contest_name>`")
 
     async def list_entries(self, context, contest_name):
         """ List the entries in the contest """
-        guild_id = context.message.guild.id
-        session = self.sessionmaker()
-
-        # Verify the contest is created for the current guild
-        contest = session.query(Contest) \
-                .filter_by(name=contest_name, guild_id=guild_id) \
-                .one_or_none()
+        contest = await self.get_contest(context.message.guild.id, contest_name)
         if contest is None:
-            session.rollback()
-            session.close()
             await context.send(f"Contest {contest_name} was not found")
             return
+        async def render(entries):
+            # Grab discord display names
+            return await self.members.display_names(context.message.guild, entries)
 
-        entries = session.query(Entry.user_id) \
-            .filter_by(contest=contest.cid) \
-            .all()
-
-        session.close()
-
-        # Grab discord display names
-        usernames = [util.get_displayname(entry.user_id, context) for entry in entries]
-
-        if len(usernames) == 0:
-            message = "There are no entries for " + contest_name
-        else:
-            message = f"The entries for {contest_name} are: " + ", ".join(usernames)
-        await util.send(context, message)
+        await paging.send_listing(
+            context, f"The entries for {contest_name} are: ",
+            lambda user_id, limit: self.db.run(get_entry_ids, contest.cid, user_id, limit),
+            render, "There are no entries for " + contest_name)
 
 
     @contest.command()
@@ -238,32 +631,35 @@ class Contests(commands.cog.Cog):
             return
 
         guild_id = context.message.guild.id
-        session = self.sessionmaker()
-        contest = session.query(Contest) \
-            .filter_by(name=contest_name, guild_id=guild_id) \
-            .one_or_none()
+        contest = await self.get_contest(guild_id, contest_name)
 
         if contest is None:
-            session.close()
             await context.send(f"The contest {contest_name} does not exist.")
             return
 
         if contest.owner_id != context.message.author.id:
-            session.close()
             print("Author: {}, Owner: {}".format(context.message.author.id, contest.owner_id))
-            owner_name = context.message.guild.get_member(contest.owner_id).display_name
+            owner_name = await self.members.display_name(context.message.guild, contest.owner_id)
             await context.send(f"Only the owner of {contest_name} ({owner_name}) may close it.")
             return
 
         if not contest.open:
-            session.close()
             await context.send(f"The contest {contest_name} is already closed.")
             return
 
-        contest.open = False
-        session.commit()
-
-        await context.send(f"The contest {contest_name} has been closed.")
+        async with self.locks.hold(contest.cid):
+            if contest.entry_message_id is not None:
+                # Stop taking reactions, and write any reaction entries still waiting before closing
+                self.entry_messages.pop(contest.entry_message_id, None)
+                await self.reaction_entries.drain()
+            closed = await self.db.run(close_contest, contest.cid)
+            self.forget_contest(guild_id, contest_name)
+            self.open_contests.discard(guild_id, contest_name)
+
+        if closed:
+            await context.send(f"The contest {contest_name} has been closed.")
+        else:
+            await context.send(f"The contest {contest_name} is already closed.")
 
 
     @contest.command()
@@ -283,21 +679,15 @@ class Contests(commands.cog.Cog):
             return
 
         guild_id = context.message.guild.id
-        session = self.sessionmaker()
-
-        contest = session.query(Contest) \
-            .filter_by(name=contest_name, guild_id=guild_id) \
-            .one_or_none()
+        contest = await self.get_contest(guild_id, contest_name)
 
         if contest is None:
-            session.close()
             await context.send(f"The contest {contest_name} does not exist.")
             return
 
         if contest.owner_id != context.message.author.id:
-            session.close()
             print("Author: {}, Owner: {}".format(context.message.author.id, contest.owner_id))
-            owner_name = context.message.guild.get_member(contest.owner_id).display_name
+            owner_name = await self.members.display_name(context.message.guild, contest.owner_id)
             await context.send(f"Only the owner of {contest_name} ({owner_name}) may close it.")
             return
         
@@ -310,6 +700,7 @@ class Contests(commands.cog.Cog):
         else:
             try:
                 num_winners = int(num_winners)
+                all_winners = False
             except:
                 await context.send(f"{num_winners} is not a valid number or 'all'\n\t" + syntax)
                 return
@@ -318,50 +709,128 @@ class Contests(commands.cog.Cog):
             await context.send(f"The number of winners must be greater than 1.\n\t" + syntax)
             return
         
-        if contest.num_winners is not None:
-            prev_winners = contest.num_winners
+        # Entries of users who left the guild are purged as they leave, so every entry is live.
+        # The draw is keyed by the message asking for it, so running it again draws nothing new.
+        count = None if all_winners else num_winners
+        async with self.locks.hold(contest.cid):
+            drawn = await self.db.run(draw_winners, contest.cid, count, str(context.message.id))
+            self.forget_contest(guild_id, contest_name)
+
+        if drawn is None:
+            await context.send(f"The contest {contest_name} does not exist.")
+            return
+        # Only this draw's winners, as another draw may have ranked more since
+        after_rank, winners = drawn
+        await self.announce_winners(context, contest, after_rank, after_rank + winners)
+
+    @contest.command()
+    async def schedule(self, context, contest_name="", action="", *, when=""):
+        """
+        Close a contest, or draw its winners, at a set time in UTC
+        num_winners must be either a positive number, or "all"
+        Format: !contest schedule <contest_name> close <when>
+                !contest schedule <contest_name> draw [num_winners|all] <when>
+        Example: !contest schedule RT2019 draw 3 friday 18:00
+        """
+        syntax = ("You must format the command this way: `!contest schedule contest_name close <when>`"
+                  " or `!contest schedule contest_name draw [num_winners|all] <when>`")
+
+        if not util.is_from_guild(context):
+            await context.send("This command must be run from a server.")
+            return
+
+        if self.scheduler is None:
+            await context.send("Scheduling is not available right now.")
+            return
+
+        if contest_name == "" or action not in ("close", "draw") or when == "":
+            await context.send(syntax)
+            return
+
+        num_winners = None
+        if action == "draw":
+            first, _, rest = when.partition(" ")
+            if first.isdigit() or first.lower() == "all":
+                num_winners, when = first.lower(), rest.strip()
+            if num_winners == "0":
+                await context.send("The number of winners must be greater than 1.\n\t" + syntax)
+                return
+
+        contest = await self.get_contest(context.message.guild.id, contest_name)
+        if contest is None:
+            await context.send(f"The contest {contest_name} does not exist.")
+            return
+
+        if contest.owner_id != context.message.author.id:
+            owner_name = await self.members.display_name(context.message.guild, contest.owner_id)
+            await context.send(f"Only the owner of {contest_name} ({owner_name}) may schedule it.")
+            return
+
+        if action == "close" and not contest.open:
+            await context.send(f"The contest {contest_name} is already closed.")
+            return
+
+        job = await schedule_from(context, self.scheduler, CLOSE_JOB if action == "close" else DRAW_JOB,
+                                  contest_name, num_winners, when)
+        if job is None:
+            return
+        if action == "close":
+            what = "closed"
         else:
-            prev_winners = 0
+            what = f"drawn for {'all' if num_winners == 'all' else num_winners or 1} winner(s)"
+        await context.send(f"The contest {contest_name} will be {what} at {format_when(job.due_at)}."
+                           f" You can cancel this with `!schedule cancel {job.job_id}`")
 
-        # Get entries who are not winners
-        entries = (session.query(Entry)
-                        .filter(Entry.contest == contest.cid, Entry.win_rank == None)
-                        .all())
-        
-        # Remove winners
-        entries = [entry for entry in entries if entry.win_rank is None]
-
-        # Remove entries who have left the guild
-        removed_users = list()
-        for entry in entries:
-            if context.message.guild.get_member(entry.user_id) is None:
-                entries.remove(entry)
-                removed_users.append(util.get_displayname(entry.user_id, context))
-                session.delete(entry)
-
-        if len(removed_users) > 0:
-            await context.send(f"Users who have left the server have been removed from the contest: " +
-                               ", ".join(removed_users))
-        
-        if all_winners or len(entries) < num_winners:
-            num_winners = len(entries)
-        
-        # Randomize order, then pick the top few as winners
-        shuffle(entries)
-        winners = entries[:num_winners]
+    @contest.command()
+    async def bonus(self, context, contest_name="", role="", tickets=""):
+        """
+        Give members with a role extra tickets in a contest, raising their odds of being drawn
+        Use "booster" for the server's boosters, and 0 tickets to remove a bonus.
+        A bonus counts for the entries made after it is set.
+        Format: !contest bonus <contest_name> <@role|role_id|booster> <tickets>
+        """
+        syntax = "You must format the command this way: `!contest bonus contest_name <@role|booster> tickets`"
 
-        for rank, winner in enumerate(winners, prev_winners + 1):
-            winner.win_rank = rank
-        
-        contest.num_winners = prev_winners + num_winners
+        if not util.is_from_guild(context):
+            await context.send("This command must be run from a server.")
+            return
+
+        if contest_name == "" or role == "" or not tickets.isdigit():
+            await context.send(syntax)
+            return
+        tickets = int(tickets)
+        if tickets > MAX_BONUS_TICKETS:
+            await context.send(f"A role may give at most {MAX_BONUS_TICKETS} bonus tickets.")
+            return
+
+        guild = context.message.guild
+        if role.lower() == "booster":
+            found = guild.premium_subscriber_role
+        else:
+            match = ROLE_MENTION.match(role)
+            role_id = match.group(1) if match is not None else role
+            found = guild.get_role(int(role_id)) if role_id.isdigit() else None
+        if found is None:
+            await context.send(f"The role {role} was not found.\n\t" + syntax)
+            return
 
-        # Update the database
-        session.commit()
+        contest = await self.get_contest(guild.id, contest_name)
+        if contest is None:
+            await context.send(f"The contest {contest_name} does not exist.")
+            return
 
-        message = ("Congrats to the following winners: \n\t" +
-                    "\n\t".join([print_rank(winner, context) for winner in winners]))
+        if contest.owner_id != context.message.author.id:
+            owner_name = await self.members.display_name(guild, contest.owner_id)
+            await context.send(f"Only the owner of {contest_name} ({owner_name}) may give bonus tickets.")
+            return
 
-        await context.send(message)
+        await self.db.run(set_bonus, contest.cid, found.id, tickets)
+        self.bonuses.invalidate(contest.cid)
+        if tickets == 0:
+            await context.send(f"Members with {found.name} no longer get bonus tickets in {contest_name}.")
+        else:
+            await context.send(f"Members with {found.name} who enter {contest_name} now get {tickets}"
+                               f" bonus ticket(s).")
 
     @contest.command()
     async def winners(self, context, contest_name=""):
@@ -377,15 +846,10 @@ class Contests(commands.cog.Cog):
             await context.send("You must include an contest name in this command\n\t" + syntax)
             return
 
-        session = self.sessionmaker()
         guild_id = context.message.guild.id
-        session = self.sessionmaker()
-        contest = (session.query(Contest)
-                    .filter_by(name=contest_name, guild_id=guild_id)
-                    .one_or_none())
+        contest = await self.get_contest(guild_id, contest_name)
 
         if contest is None:
-            session.close()
             await context.send(f"The contest {contest_name} does not exist.")
             return
 
@@ -393,12 +857,9 @@ class Contests(commands.cog.Cog):
             await context.send(f"The contest {contest_name} has no winners")
             return
         
-        winners = (session.query(Entry)
-                    .filter(Entry.contest == contest.cid, Entry.win_rank.isnot(None))
-                    .order_by(Entry.win_rank)
-                    .all())
+        await self.announce_winners(context, contest)
 
-        message = ("Congrats to the following winners: \n\t" +
-                    "\n\t".join([print_rank(winner, context) for winner in winners]))
-        
-        await context.send(message)
+
+def setup(bot):
+    """ Loads the cog as a discord.py extension, after hatch.members and hatch.scheduler """
+    bot.add_cog(Contests(bot, bot.db, bot.get_cog("MemberResolver"), bot.get_cog("Scheduler")))
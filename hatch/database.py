@@ -0,0 +1,170 @@
+import asyncio
+import contextvars
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import create_engine, text, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import sessionmaker
+
+# Defaults sized for a hobby Heroku Postgres plan, which caps the number of connections
+DEFAULT_POOL_SIZE = 4
+DEFAULT_MAX_OVERFLOW = 2
+DEFAULT_POOL_RECYCLE = 1800
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_STATEMENT_TIMEOUT_MS = 5000
+DEFAULT_RETRIES = 2
+RETRY_DELAY = 0.2
+# The fewest bound variables a SQLite build allows in one statement
+SQLITE_MAX_VARIABLES = 999
+
+
+def env_int(name, default):
+    """ Reads an integer setting from the environment """
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return int(value)
+
+
+def env_bool(name, default):
+    """ Reads a true/false setting from the environment """
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return value.lower() in ("1", "true", "yes", "on")
+
+
+def create_engine_from_env():
+    """
+    Creates the single SQLAlchemy engine shared by the whole bot.
+    The pool is configured through the DATABASE_POOL_* environment variables.
+    """
+    url = os.getenv("DATABASE_URL")
+    if not url:
+        raise RuntimeError("DATABASE_URL not set")
+
+    options = {
+        "pool_pre_ping": env_bool("DATABASE_POOL_PRE_PING", True),
+        "pool_recycle": env_int("DATABASE_POOL_RECYCLE", DEFAULT_POOL_RECYCLE),
+    }
+    if make_url(url).get_backend_name() != "sqlite":
+        options["pool_size"] = env_int("DATABASE_POOL_SIZE", DEFAULT_POOL_SIZE)
+        options["max_overflow"] = env_int("DATABASE_MAX_OVERFLOW", DEFAULT_MAX_OVERFLOW)
+        options["pool_timeout"] = env_int("DATABASE_POOL_TIMEOUT", DEFAULT_POOL_TIMEOUT)
+    return create_engine(url, **options)
+
+
+def insert_ignore(session, model, rows, keys):
+    """
+    Inserts rows into a model's table in one statement, skipping rows whose keys already exist.
+    keys names the columns of a unique index. Returns the key tuples of the rows that were inserted.
+    """
+    if len(rows) == 0:
+        return []
+    table = model.__table__
+    columns = [table.c[key] for key in keys]
+
+    if session.bind.dialect.name == "postgresql":
+        statement = postgresql.insert(table) \
+            .values(rows) \
+            .on_conflict_do_nothing(index_elements=keys) \
+            .returning(*columns)
+        return [tuple(row) for row in session.execute(statement)]
+
+    # Without ON CONFLICT ... RETURNING, look up which keys already exist in the same transaction,
+    # a chunk at a time so each lookup stays within SQLite's limit on bound variables
+    wanted = list({tuple(row[key] for key in keys) for row in rows})
+    chunk = SQLITE_MAX_VARIABLES // len(keys)
+    existing = set()
+    for start in range(0, len(wanted), chunk):
+        existing.update(tuple(row) for row in
+                        session.query(*columns).filter(tuple_(*columns).in_(wanted[start:start + chunk])).all())
+    new_rows = list()
+    inserted = list()
+    for row in rows:
+        key = tuple(row[key] for key in keys)
+        if key not in existing:
+            existing.add(key)
+            new_rows.append(row)
+            inserted.append(key)
+    if len(new_rows) > 0:
+        session.execute(table.insert(), new_rows)
+    return inserted
+
+
+def is_transient(error):
+    """ Returns true if a database error was caused by a dropped connection """
+    return isinstance(error, DBAPIError) and error.connection_invalidated
+
+
+class Database:
+    """
+    This class owns the SQLAlchemy sessions used by the bot.
+
+    Every unit of database work is handed to a small pool of worker threads, so the
+    discord.py event loop never waits on a Postgres round-trip. Cogs pass a plain function
+    that takes a session; the session is committed when the function returns and rolled
+    back if it raises. Work interrupted by a dropped connection is retried on a new one.
+    """
+    def __init__(self, engine, max_workers=None, statement_timeout=None, retries=None):
+        if max_workers is None:
+            # One worker per pooled connection, so no worker ever waits on the pool
+            max_workers = engine.pool.size() if hasattr(engine.pool, "size") else DEFAULT_POOL_SIZE
+        if statement_timeout is None:
+            statement_timeout = env_int("DATABASE_STATEMENT_TIMEOUT_MS", DEFAULT_STATEMENT_TIMEOUT_MS)
+        if retries is None:
+            retries = env_int("DATABASE_RETRIES", DEFAULT_RETRIES)
+
+        self.engine = engine
+        self.statement_timeout = statement_timeout
+        self.retries = retries
+        self.sessionmaker = sessionmaker(bind=engine, expire_on_commit=False)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="hatch-db")
+
+    def _begin(self, session):
+        """ Applies per-transaction settings to a new session """
+        if self.statement_timeout > 0 and self.engine.dialect.name == "postgresql":
+            # SET LOCAL only lasts for this transaction, so pooled connections are left untouched
+            session.execute(text(f"SET LOCAL statement_timeout = {int(self.statement_timeout)}"))
+
+    def _run_in_session(self, func, args, kwargs):
+        attempt = 0
+        while True:
+            session = self.sessionmaker()
+            try:
+                self._begin(session)
+                result = func(session, *args, **kwargs)
+                session.commit()
+                return result
+            except DBAPIError as error:
+                session.rollback()
+                if not is_transient(error) or attempt >= self.retries:
+                    raise
+                attempt += 1
+                print(f"Database connection lost, retrying ({attempt}/{self.retries})")
+                time.sleep(RETRY_DELAY * attempt)
+            except BaseException:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Runs func(session, *args, **kwargs) on a database worker thread and returns its result.
+        Results should be plain values, as the session is closed before they are returned.
+        The caller's context variables are visible to the work, so it is counted against the caller.
+        """
+        loop = asyncio.get_event_loop()
+        call = functools.partial(contextvars.copy_context().run, self._run_in_session, func, args, kwargs)
+        return await loop.run_in_executor(self.executor, call)
+
+    def close(self):
+        """ Waits for outstanding work and releases the worker threads and connections """
+        self.executor.shutdown(wait=True)
+        self.engine.dispose()
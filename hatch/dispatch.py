@@ -0,0 +1,157 @@
+import asyncio
+import random
+import time
+
+import discord
+
+from hatch.members import fetch_user
+
+# Direct messages being sent at once
+DEFAULT_CONCURRENCY = 8
+# Discord allows about 50 requests a second per bot, and 5 messages every 5 seconds per channel
+GLOBAL_RATE = (45, 1.0)
+ROUTE_RATE = (5, 5.0)
+# Attempts after the first for a message that was rate limited or hit a server error
+DEFAULT_RETRIES = 3
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+# Idle per-route buckets are dropped once there are more than this many
+MAX_ROUTES = 1024
+
+# Reasons a message could not be delivered
+USER_NOT_FOUND = "user not found"
+DMS_CLOSED = "direct messages closed"
+RATE_LIMITED = "rate limited"
+SEND_FAILED = "send failed"
+
+
+class TokenBucket:
+    """
+    This class allows rate requests every per seconds, and makes callers wait for their turn.
+    """
+    def __init__(self, rate, per):
+        self.capacity = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / self.per)
+        self.updated = now
+
+    def is_full(self):
+        self.refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        """ Waits until a request may be made, and takes its token """
+        while True:
+            self.refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.capacity)
+
+
+class DeliveryReport:
+    """
+    This class records which messages of a batch were delivered, and why the others failed.
+    Messages are identified by the key they were given to Dispatcher.fan_out.
+    """
+    def __init__(self):
+        self.delivered = list()
+        self.failed = dict()
+
+    def __len__(self):
+        return len(self.delivered) + len(self.failed)
+
+    def summary(self):
+        """ Returns a short description of the deliveries, for the logs """
+        reasons = dict()
+        for reason in self.failed.values():
+            reasons[reason] = reasons.get(reason, 0) + 1
+        failures = ", ".join(f"{count} {reason}" for reason, count in sorted(reasons.items()))
+        message = f"{len(self.delivered)} of {len(self)} messages delivered"
+        return message + f" ({failures})" if failures else message
+
+
+def retry_after(error):
+    """ Returns how long a rate limited request asked us to wait, or None if it didn't say """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class Dispatcher:
+    """
+    This class sends direct messages in bulk without tripping Discord's rate limits.
+
+    Sends are capped at a fixed concurrency, and each one waits for a token from a global
+    bucket and from a bucket for its DM channel. Rate limited sends and server errors are
+    retried with exponential backoff. Every send's outcome is recorded in a DeliveryReport.
+    """
+    def __init__(self, bot, concurrency=DEFAULT_CONCURRENCY, retries=DEFAULT_RETRIES, processes=1):
+        self.bot = bot
+        self.retries = retries
+        self.slots = asyncio.Semaphore(concurrency)
+        # The global limit is shared by every process of the bot
+        rate, per = GLOBAL_RATE
+        self.global_bucket = TokenBucket(rate / processes, per)
+        self.routes = dict()
+
+    def route(self, user_id):
+        """ Returns the token bucket for the DM channel with a user """
+        bucket = self.routes.get(user_id)
+        if bucket is None:
+            if len(self.routes) >= MAX_ROUTES:
+                self.routes = {key: value for key, value in self.routes.items() if not value.is_full()}
+            bucket = TokenBucket(*ROUTE_RATE)
+            self.routes[user_id] = bucket
+        return bucket
+
+    async def deliver(self, user_id, content):
+        """ Sends a direct message to a user. Returns None if it was delivered, or why it wasn't """
+        async with self.slots:
+            user = await fetch_user(self.bot, user_id)
+            if user is None:
+                return USER_NOT_FOUND
+
+            for attempt in range(self.retries + 1):
+                await self.route(user_id).acquire()
+                await self.global_bucket.acquire()
+                try:
+                    await user.send(content)
+                    return None
+                except discord.Forbidden:
+                    return DMS_CLOSED
+                except discord.NotFound:
+                    return USER_NOT_FOUND
+                except discord.HTTPException as error:
+                    if error.status != 429 and error.status < 500:
+                        return SEND_FAILED
+                    reason = RATE_LIMITED if error.status == 429 else SEND_FAILED
+                    if attempt == self.retries:
+                        return reason
+                    delay = retry_after(error)
+                    if delay is None:
+                        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+                    print(f"Retrying a message to {user_id} in {delay:.1f}s after HTTP {error.status}")
+                    await asyncio.sleep(delay)
+            return SEND_FAILED
+
+    async def fan_out(self, messages):
+        """ Sends (key, user_id, content) direct messages and returns a DeliveryReport """
+        messages = list(messages)
+        report = DeliveryReport()
+        outcomes = await asyncio.gather(*[self.deliver(user_id, content) for _, user_id, content in messages])
+        for (key, _, _), reason in zip(messages, outcomes):
+            if reason is None:
+                report.delivered.append(key)
+            else:
+                report.failed[key] = reason
+        print(report.summary())
+        return report
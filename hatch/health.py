@@ -0,0 +1,163 @@
+import asyncio
+import math
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from discord.ext import commands
+
+from hatch.database import env_int
+
+# How often the event loop is checked, in seconds
+TICK = 0.5
+# Ticks kept for !health, ten minutes' worth
+WINDOW = 1200
+# Lag spikes kept for !health
+SPIKES = 10
+# A tick this late is a spike, and a stack sample is taken of whatever is blocking the loop
+DEFAULT_LAG_THRESHOLD_MS = 250
+# Heartbeat latency above this is logged
+HEARTBEAT_WARNING = 1.0
+# Stack frames kept from a sample
+STACK_DEPTH = 12
+
+
+class Spike:
+    """
+    This class describes one moment the event loop fell behind, and what it was doing.
+    """
+    def __init__(self, lag, commands, stack):
+        self.at = time.time()
+        self.lag = lag
+        self.commands = commands
+        self.stack = stack
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Health(commands.cog.Cog):
+    """
+    This class watches for work that blocks the event loop long enough to delay heartbeats.
+
+    A task measures how late the loop wakes it up, and keeps a rolling window of that lag and
+    of the gateway heartbeat latency. A watchdog thread notices when the loop stops making
+    progress and samples the loop thread's stack while it is still stuck, so the log shows
+    the code that was blocking and the commands that were running.
+    """
+    def __init__(self, bot, threshold_ms=None):
+        if threshold_ms is None:
+            threshold_ms = env_int("LOOP_LAG_THRESHOLD_MS", DEFAULT_LAG_THRESHOLD_MS)
+        self.bot = bot
+        self.threshold = threshold_ms / 1000
+        self.samples = deque(maxlen=WINDOW)
+        self.spikes = deque(maxlen=SPIKES)
+        # Commands in progress, by message id
+        self.running = dict()
+        self.monitor = None
+        self.watchdog = None
+        self.loop_thread = None
+        # When the monitor expects to be woken next, and the stack sampled since it last was
+        self.due = None
+        self.stack = None
+        self.stopped = threading.Event()
+
+    @commands.Cog.listener()
+    async def on_command(self, ctx):
+        self.running[ctx.message.id] = ctx
+
+    @commands.Cog.listener()
+    async def on_command_completion(self, ctx):
+        self.running.pop(ctx.message.id, None)
+
+    @commands.Cog.listener()
+    async def on_command_error(self, ctx, error):
+        self.running.pop(ctx.message.id, None)
+
+    def running_commands(self):
+        # ctx.command moves on to the subcommand once it starts, so this names the deepest one
+        return sorted({ctx.command.qualified_name for ctx in list(self.running.values())
+                       if ctx.command is not None})
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self.monitor is None:
+            self.loop_thread = threading.get_ident()
+            self.monitor = asyncio.ensure_future(self.run())
+            self.watchdog = threading.Thread(target=self.watch, name="hatch-watchdog", daemon=True)
+            self.watchdog.start()
+
+    def cog_unload(self):
+        self.stopped.set()
+        if self.monitor is not None:
+            self.monitor.cancel()
+
+    async def run(self):
+        """ Measures loop lag and heartbeat latency until cancelled """
+        while True:
+            self.due = time.monotonic() + TICK
+            await asyncio.sleep(TICK)
+            lag = max(0.0, time.monotonic() - self.due)
+            latency = self.bot.latency
+            self.samples.append((lag, latency))
+
+            if lag >= self.threshold:
+                stack, self.stack = self.stack, None
+                spike = Spike(lag, self.running_commands(), stack)
+                self.spikes.append(spike)
+                print(f"Event loop lagged {lag * 1000:.0f}ms while running {', '.join(spike.commands) or 'no commands'}")
+            if not math.isnan(latency) and latency > HEARTBEAT_WARNING:
+                print(f"Heartbeat latency is {latency * 1000:.0f}ms")
+
+    def watch(self):
+        """ Samples the loop thread's stack whenever the loop is stuck past the threshold """
+        while not self.stopped.wait(self.threshold / 2):
+            due = self.due
+            if due is None or self.stack is not None:
+                continue
+            stuck = time.monotonic() - due
+            if stuck < self.threshold:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            self.stack = "".join(traceback.format_stack(frame, limit=STACK_DEPTH))
+            print(f"Event loop stuck for {stuck * 1000:.0f}ms in:\n{self.stack}", end="")
+
+    def summary(self):
+        """ Returns the report shown by !health """
+        lags = [lag for lag, _ in self.samples]
+        latencies = [latency for _, latency in self.samples if not math.isnan(latency)]
+        minutes = len(self.samples) * TICK / 60
+        lines = [f"Over the last {minutes:.0f} minutes:",
+                 f"Event loop lag: p50 {percentile(lags, 0.5) * 1000:.0f}ms, "
+                 f"p99 {percentile(lags, 0.99) * 1000:.0f}ms, max {max(lags, default=0) * 1000:.0f}ms",
+                 f"Heartbeat latency: now {self.bot.latency * 1000:.0f}ms, "
+                 f"max {max(latencies, default=0) * 1000:.0f}ms"]
+        if len(self.spikes) == 0:
+            lines.append(f"No lag spikes over {self.threshold * 1000:.0f}ms.")
+        for spike in reversed(self.spikes):
+            ago = int(time.time() - spike.at)
+            where = ""
+            if spike.stack:
+                where = " in " + spike.stack.strip().splitlines()[-2].strip()
+            lines.append(f"{ago}s ago: {spike.lag * 1000:.0f}ms during "
+                         f"{', '.join(spike.commands) or 'no command'}{where}")
+        return "\n".join(lines)
+
+    @commands.command()
+    @commands.is_owner()
+    async def health(self, ctx):
+        """ Show event loop lag, heartbeat latency and recent lag spikes """
+        await ctx.send(self.summary()[:2000])
+
+
+def setup(bot):
+    """ Loads the cog as a discord.py extension """
+    bot.add_cog(Health(bot))
@@ -0,0 +1,68 @@
+import asyncio
+
+# How long the first request for a key waits for others to join its batch, in seconds
+DEFAULT_WINDOW = 0.1
+# A batch is written early once it holds this many requests
+DEFAULT_MAX_BATCH = 500
+
+
+class BatchIngester:
+    """
+    This class coalesces writes that arrive close together.
+
+    Requests are buffered per key, such as a contest, for a short window. Each buffered
+    batch is then handed to a single flush coroutine, flush(key, items), which must return
+    one outcome per item in order. Every caller gets the outcome of its own item.
+    """
+    def __init__(self, flush, window=DEFAULT_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+        self.flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self.pending = dict()
+        self.tasks = set()
+
+    async def submit(self, key, item):
+        """ Adds an item to the batch for a key and waits for its outcome """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+
+        batch = self.pending.get(key)
+        if batch is None:
+            batch = list()
+            self.pending[key] = batch
+            loop.call_later(self.window, self._start_flush, key, batch)
+        batch.append((item, future))
+
+        if len(batch) >= self.max_batch:
+            self._start_flush(key, batch)
+        return await future
+
+    def _start_flush(self, key, batch):
+        # The timer may fire after the batch was already flushed for being full
+        if self.pending.get(key) is not batch:
+            return
+        del self.pending[key]
+        task = asyncio.ensure_future(self._flush(key, batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _flush(self, key, batch):
+        items = [item for item, _ in batch]
+        try:
+            outcomes = await self.flush(key, items)
+        except Exception as error:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for (_, future), outcome in zip(batch, outcomes):
+            if not future.done():
+                future.set_result(outcome)
+
+    async def drain(self):
+        """ Writes every buffered batch now and waits for the writes to finish """
+        for key, batch in list(self.pending.items()):
+            self._start_flush(key, batch)
+        if len(self.tasks) > 0:
+            await asyncio.wait(list(self.tasks))
@@ -0,0 +1,192 @@
+import asyncio
+
+import discord
+from discord.ext import commands
+
+from hatch.cache import LRUCache
+
+# Discord answers member queries for at most 100 user ids at a time
+QUERY_CHUNK = 100
+# Member queries sent at once, to stay well under the gateway's command rate limit
+MAX_CONCURRENT_QUERIES = 4
+DEFAULT_MAXSIZE = 20000
+DEFAULT_TTL = 600
+# Guilds whose members could not all be looked up are swept for departures again this many times
+SWEEP_ATTEMPTS = 3
+SWEEP_RETRY_DELAY = 60
+# Stands in for the name of a user whose member query failed, who may or may not be a member
+UNRESOLVED = object()
+
+
+def unknown_name(user_id):
+    """ Returns the name shown for a user who is not a member of the guild """
+    return f"User {user_id}"
+
+
+def shown_name(user_id, name):
+    """ Returns the name to show for a user resolved to name, which may be None or UNRESOLVED """
+    if name is None or name is UNRESOLVED:
+        return unknown_name(user_id)
+    return name
+
+
+class MemberResolver(commands.cog.Cog):
+    """
+    This class resolves user ids to display names in batches.
+
+    Names are served from a bounded LRU cache, keyed by guild and user. Misses are filled
+    with chunked gateway member queries, so the bot does not have to hold every member of
+    every guild in memory. Users who are not members are cached as None. Users whose query
+    failed are not cached, and are resolved to UNRESOLVED rather than None, so a gateway
+    timeout is never taken to mean someone left.
+
+    It also turns raw GUILD_MEMBER_REMOVE events into raw_member_remove(guild_id, user_id)
+    events, which fire even for members the bot never cached.
+    """
+    def __init__(self, bot):
+        self.bot = bot
+        self.names = LRUCache("members", DEFAULT_MAXSIZE, DEFAULT_TTL)
+        self.queries = asyncio.Semaphore(MAX_CONCURRENT_QUERIES)
+
+    async def query(self, guild, user_ids):
+        """
+        Asks the gateway for up to QUERY_CHUNK members and caches the answers. Returns a dict
+        mapping each user id to their display name, None, or UNRESOLVED if the query failed.
+        """
+        async with self.queries:
+            try:
+                members = await guild.query_members(user_ids=user_ids, limit=len(user_ids), cache=False)
+            except asyncio.TimeoutError:
+                # Leave them uncached, so they are asked for again next time
+                print(f"Timed out querying {len(user_ids)} members of guild {guild.id}")
+                return dict.fromkeys(user_ids, UNRESOLVED)
+        found = {member.id: member.display_name for member in members}
+        names = {user_id: found.get(user_id) for user_id in user_ids}
+        for user_id, name in names.items():
+            self.names.store((guild.id, user_id), name)
+        return names
+
+    async def resolve(self, guild, user_ids):
+        """
+        Returns a dict mapping each user id to their display name in the guild, to None if
+        they are not a member, or to UNRESOLVED if their member query failed.
+        """
+        names = dict()
+        missing = list()
+        for user_id in dict.fromkeys(user_ids):
+            found, name = self.names.lookup((guild.id, user_id))
+            if not found:
+                # Members discord.py happens to have cached cost nothing to look up
+                member = guild.get_member(user_id)
+                if member is None:
+                    missing.append(user_id)
+                    continue
+                name = member.display_name
+                self.names.store((guild.id, user_id), name)
+            names[user_id] = name
+
+        chunks = [missing[start:start + QUERY_CHUNK] for start in range(0, len(missing), QUERY_CHUNK)]
+        for found in await asyncio.gather(*[self.query(guild, chunk) for chunk in chunks]):
+            names.update(found)
+        return names
+
+    async def display_names(self, guild, user_ids):
+        """ Returns the display names of users in order, naming non-members and unresolved users by their id """
+        names = await self.resolve(guild, user_ids)
+        return [shown_name(user_id, names[user_id]) for user_id in user_ids]
+
+    async def display_name(self, guild, user_id):
+        """ Returns the display name of a single user """
+        return (await self.display_names(guild, [user_id]))[0]
+
+    async def display_name_in(self, guild_id, user_id):
+        """
+        Returns the display name of a user in a guild known only by id. A guild on a shard run by
+        another process is not available here, so the member is fetched over HTTP instead.
+        """
+        guild = self.bot.get_guild(guild_id)
+        if guild is not None:
+            return await self.display_name(guild, user_id)
+
+        async def load():
+            try:
+                data = await self.bot.http.get_member(guild_id, user_id)
+            except discord.NotFound:
+                return None
+            return data.get("nick") or data["user"]["username"]
+        try:
+            name = await self.names.get_or_load((guild_id, user_id), load)
+        except discord.HTTPException:
+            name = None
+        return name or unknown_name(user_id)
+
+    async def find_departed(self, guild, user_ids):
+        """
+        Returns (departed, unresolved): the ids of users the gateway confirmed are not members of
+        the guild, and of users whose member query failed, who may still be members.
+        """
+        names = await self.resolve(guild, user_ids)
+        departed = [user_id for user_id in user_ids if names[user_id] is None]
+        unresolved = [user_id for user_id in user_ids if names[user_id] is UNRESOLVED]
+        return departed, unresolved
+
+    async def sweep_departed(self, guilds, load, remove):
+        """
+        For each guild, calls remove(guild, user_ids) with those of the users load(guild) returns
+        who the gateway confirmed have left. A guild where any member query failed is swept again
+        after SWEEP_RETRY_DELAY seconds, up to SWEEP_ATTEMPTS times in all, and the users who
+        could not be looked up are never removed.
+        """
+        pending = list(guilds)
+        for attempt in range(SWEEP_ATTEMPTS):
+            if attempt > 0:
+                await asyncio.sleep(SWEEP_RETRY_DELAY)
+            retry = list()
+            for guild in pending:
+                # The bot may have left the guild while waiting to retry
+                if attempt > 0 and self.bot.get_guild(guild.id) is None:
+                    continue
+                departed, unresolved = await self.find_departed(guild, await load(guild))
+                if len(departed) > 0:
+                    await remove(guild, departed)
+                if len(unresolved) > 0:
+                    retry.append(guild)
+            pending = retry
+            if len(pending) == 0:
+                return
+        print(f"Gave up looking for departed members of guilds {[guild.id for guild in pending]}")
+
+    @commands.Cog.listener()
+    async def on_socket_response(self, message):
+        # discord.py only dispatches on_member_remove for cached members, so watch the raw event
+        if message.get("t") != "GUILD_MEMBER_REMOVE":
+            return
+        data = message["d"]
+        guild_id = int(data["guild_id"])
+        user_id = int(data["user"]["id"])
+        self.names.store((guild_id, user_id), None)
+        self.bot.dispatch("raw_member_remove", guild_id, user_id)
+
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        self.names.store((member.guild.id, member.id), member.display_name)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        self.names.store((after.guild.id, after.id), after.display_name)
+
+
+async def fetch_user(bot, user_id):
+    """ Returns a user who can be sent direct messages, or None if the user can't be found """
+    user = bot.get_user(user_id)
+    if user is None:
+        try:
+            user = await bot.fetch_user(user_id)
+        except discord.HTTPException:
+            return None
+    return user
+
+
+def setup(bot):
+    """ Loads the cog as a discord.py extension """
+    bot.add_cog(MemberResolver(bot))
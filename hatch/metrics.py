@@ -0,0 +1,278 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+
+from discord.ext import commands
+from sqlalchemy import event
+
+import hatch.paging as paging
+
+# Upper bounds of the histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# How often the Prometheus text file is rewritten, in seconds
+EXPORT_INTERVAL = 60
+
+# The usage being recorded for the command running in the current task, if any
+current = contextvars.ContextVar("hatch_command_usage", default=None)
+
+
+class Histogram:
+    """
+    This class counts observations into fixed buckets, as a Prometheus histogram does.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def mean(self):
+        return self.sum / self.count if self.count > 0 else 0
+
+    def quantile(self, q):
+        """ Returns the upper bound of the bucket holding the q quantile, or None past the last bucket """
+        wanted = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return None
+
+    def cumulative(self):
+        """ Returns (le, count) pairs for every bucket, including +Inf """
+        seen = 0
+        pairs = list()
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            seen += count
+            pairs.append((bound, seen))
+        return pairs
+
+
+class Usage:
+    """
+    This class adds up the database and Discord work done while one command runs.
+    Statements run on the database threads, so updates are locked.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.discord_seconds = 0.0
+        self.lock = threading.Lock()
+
+    def add_statement(self, seconds):
+        with self.lock:
+            self.statements += 1
+            self.db_seconds += seconds
+
+    def add_request(self, seconds):
+        with self.lock:
+            self.discord_seconds += seconds
+
+
+class CommandMetrics:
+    """
+    This class holds the histograms recorded for one command.
+    """
+    def __init__(self):
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_seconds = Histogram(LATENCY_BUCKETS)
+        self.discord_seconds = Histogram(LATENCY_BUCKETS)
+        self.total_seconds = Histogram(LATENCY_BUCKETS)
+        self.errors = 0
+
+    def record(self, usage, failed):
+        self.statements.observe(usage.statements)
+        self.db_seconds.observe(usage.db_seconds)
+        self.discord_seconds.observe(usage.discord_seconds)
+        self.total_seconds.observe(time.perf_counter() - usage.started)
+        if failed:
+            self.errors += 1
+
+
+# Metrics by qualified command name
+registry = dict()
+# Seconds spent in each phase of starting the process, in the order they happened
+startup = dict()
+
+
+def record(command_name, usage, failed=False):
+    metrics = registry.get(command_name)
+    if metrics is None:
+        metrics = registry[command_name] = CommandMetrics()
+    metrics.record(usage, failed)
+
+
+def instrument_engine(engine):
+    """ Counts and times the statements an engine runs on behalf of the current command """
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("hatch_started", list()).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["hatch_started"].pop()
+        usage = current.get()
+        if usage is not None:
+            usage.add_statement(time.perf_counter() - started)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(exception_context):
+        started = exception_context.connection.info.get("hatch_started") \
+            if exception_context.connection is not None else None
+        if started:
+            started.pop()
+
+
+def instrument_http(http):
+    """ Times the Discord API requests made on behalf of the current command """
+    request = http.request
+
+    async def timed_request(*args, **kwargs):
+        usage = current.get()
+        if usage is None:
+            return await request(*args, **kwargs)
+        started = time.perf_counter()
+        try:
+            return await request(*args, **kwargs)
+        finally:
+            usage.add_request(time.perf_counter() - started)
+
+    http.request = timed_request
+
+
+def label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus():
+    """ Returns every command's metrics in the Prometheus text exposition format """
+    families = (
+        ("hatch_command_statements", "SQL statements run per command", "statements"),
+        ("hatch_command_db_seconds", "Time spent in SQL statements per command", "db_seconds"),
+        ("hatch_command_discord_seconds", "Time spent in Discord API requests per command", "discord_seconds"),
+        ("hatch_command_seconds", "Total latency per command", "total_seconds"),
+    )
+    lines = list()
+    for name, description, attribute in families:
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for command_name, metrics in sorted(registry.items()):
+            histogram = getattr(metrics, attribute)
+            command = label(command_name)
+            for bound, count in histogram.cumulative():
+                lines.append(f'{name}_bucket{{command="{command}",le="{bound}"}} {count}')
+            lines.append(f'{name}_sum{{command="{command}"}} {histogram.sum}')
+            lines.append(f'{name}_count{{command="{command}"}} {histogram.count}')
+    if startup:
+        lines.append("# HELP hatch_startup_seconds Time spent in each phase of starting the bot")
+        lines.append("# TYPE hatch_startup_seconds gauge")
+        for phase, seconds in startup.items():
+            lines.append(f'hatch_startup_seconds{{phase="{label(phase)}"}} {seconds}')
+    lines.append("# HELP hatch_command_errors_total Commands that raised an error")
+    lines.append("# TYPE hatch_command_errors_total counter")
+    for command_name, metrics in sorted(registry.items()):
+        lines.append(f'hatch_command_errors_total{{command="{label(command_name)}"}} {metrics.errors}')
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path):
+    """ Writes the metrics to a file, replacing it in one step so a scraper never reads half of it """
+    partial = path + ".tmp"
+    with open(partial, "w") as file:
+        file.write(render_prometheus())
+    os.replace(partial, path)
+
+
+def format_stats():
+    """ Returns a table of every command's averages and tail latency, for !stats """
+    lines = list()
+    if startup:
+        lines.append("startup: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in startup.items()))
+    if len(registry) == 0:
+        lines.append("No commands have been run yet.")
+        return "\n".join(lines)
+    lines.append("command            calls  errors  mean ms  p95 ms  sql avg  sql ms  api ms")
+    for command_name, metrics in sorted(registry.items(), key=lambda item: -item[1].total_seconds.sum):
+        p95 = metrics.total_seconds.quantile(0.95)
+        p95 = f"{p95 * 1000:.0f}" if p95 is not None else "slow"
+        lines.append(f"{command_name[:18]:<18} {metrics.total_seconds.count:>6} {metrics.errors:>7}"
+                     f" {metrics.total_seconds.mean() * 1000:>8.1f} {p95:>7}"
+                     f" {metrics.statements.mean():>8.1f} {metrics.db_seconds.mean() * 1000:>7.1f}"
+                     f" {metrics.discord_seconds.mean() * 1000:>7.1f}")
+    return "\n".join(lines)
+
+
+class Metrics(commands.cog.Cog):
+    """
+    This class records how many statements, how much database time, how much Discord API time
+    and how much time overall each command takes.
+
+    Usage is gathered in a context variable set before a command is invoked, which the database
+    threads and the HTTP client add to, and is recorded once the command finishes. The numbers
+    are shown by !stats, and written in Prometheus text format to METRICS_FILE if it is set.
+    """
+    def __init__(self, bot, engine, path=None):
+        self.bot = bot
+        self.path = path if path is not None else os.getenv("METRICS_FILE")
+        self.exporter = None
+        instrument_engine(engine)
+        instrument_http(bot.http)
+        bot.before_invoke(self.before_invoke)
+        bot.after_invoke(self.after_invoke)
+
+    async def before_invoke(self, ctx):
+        # A group's hooks run before its subcommand's, and the usage covers both
+        if current.get() is None:
+            current.set(Usage())
+
+    async def after_invoke(self, ctx):
+        if isinstance(ctx.command, commands.Group) and ctx.invoked_subcommand is not None:
+            return
+        usage = current.get()
+        if usage is None:
+            return
+        current.set(None)
+        record(ctx.command.qualified_name, usage, ctx.command_failed)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        if self.path and self.exporter is None:
+            self.exporter = asyncio.ensure_future(self.export())
+
+    def cog_unload(self):
+        if self.exporter is not None:
+            self.exporter.cancel()
+
+    async def export(self):
+        """ Rewrites the Prometheus text file until cancelled """
+        while True:
+            try:
+                write_prometheus(self.path)
+            except OSError as error:
+                print(f"Could not write metrics to {self.path}: {error!r}")
+            await asyncio.sleep(EXPORT_INTERVAL)
+
+    @commands.command()
+    @commands.is_owner()
+    async def stats(self, ctx):
+        """ Show statement counts and latency for each command """
+        for chunk in paging.split_message(format_stats(), paging.MESSAGE_LIMIT - 8):
+            await ctx.send(f"```\n{chunk}\n```")
+
+
+def setup(bot):
+    """ Loads the cog as a discord.py extension. bot.engine must be set first """
+    bot.add_cog(Metrics(bot, bot.engine))
@@ -0,0 +1,411 @@
+"""
+Versioned schema migrations.
+
+The schema_version table records which migrations have been applied. Each migration runs in
+its own transaction, and only ever uses the table definitions frozen inside it, so it keeps
+working as the models change. A database with none of the bot's tables is created straight
+from the models and marked as up to date.
+
+Run `python -m hatch.migrations [upgrade|status|explain]` to manage the database by hand.
+`explain` exits with an error if any of the bot's hot queries would not use an index.
+"""
+import importlib
+import re
+import sys
+from datetime import datetime
+
+from sqlalchemy import BigInteger, Boolean, CheckConstraint, Column, DateTime, ForeignKey, ForeignKeyConstraint, \
+    func, Index, inspect, Integer, MetaData, select, String, Table, Text, text
+from sqlalchemy.orm import Session
+
+# Modules whose declarative bases make up the current schema. They pull in discord.py, so
+# they are only imported when a new database has to be created from them.
+MODEL_MODULES = ("hatch.santa", "hatch.contest", "hatch.outbox", "hatch.scheduler")
+
+# Tables that exist in every deployed database, so their presence marks a database that
+# predates schema versioning
+LEGACY_TABLES = ("santa_exchanges", "contest_contest")
+
+# Held while migrating, so two processes starting at once don't both migrate
+ADVISORY_LOCK = 0x6861746368
+
+NAME_SIZE = 30
+
+version_metadata = MetaData()
+schema_version = Table(
+    "schema_version", version_metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(100), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+def baseline(connection):
+    """
+    The schema as first deployed, when every cog called create_all at import time.
+    Databases that predate versioning start here, so there is nothing to do.
+    """
+
+
+def rebuild(connection, table, copy):
+    """
+    Replaces a table with a new definition. table is the new definition under a temporary
+    name ending in _new; copy is the INSERT ... SELECT that fills it from the old table.
+    """
+    final_name = table.name[:-len("_new")]
+    indexes = list(table.indexes)
+    table.indexes.clear()
+    table.create(connection)
+    connection.execute(copy)
+    return final_name, indexes
+
+
+def rename_leftovers(connection, final_name):
+    """
+    Postgres keeps the names a rebuilt table's constraints and serial sequence were created
+    with under its _new name, so they are renamed to match a database created from the models.
+    """
+    prefix = final_name + "_new_"
+    constraints = connection.execute(text(
+        "SELECT conname FROM pg_constraint WHERE conrelid = CAST(:table AS regclass)"), table=final_name)
+    for (name,) in constraints.fetchall():
+        if name.startswith(prefix):
+            connection.execute(text(
+                f"ALTER TABLE {final_name} RENAME CONSTRAINT {name} TO {final_name}_{name[len(prefix):]}"))
+    sequences = connection.execute(text("SELECT relname FROM pg_class WHERE relkind = 'S'"))
+    for (name,) in sequences.fetchall():
+        if name.startswith(prefix):
+            connection.execute(text(f"ALTER SEQUENCE {name} RENAME TO {final_name}_{name[len(prefix):]}"))
+
+
+def guild_scoped_keys(connection):
+    """
+    Scopes exchange names to their guild, creates the constraints that were declared but never
+    created, adds the hot-path indexes, and brings in the columns and tables added since the
+    baseline.
+    """
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    metadata = MetaData()
+
+    # Contests: entry message columns, then a real unique name per guild. Duplicate names were
+    # possible before, so all but the newest contest of each name get their id added to it.
+    contest_columns = {column["name"] for column in inspector.get_columns("contest_contest")}
+    for column in ("entry_channel_id", "entry_message_id"):
+        if column not in contest_columns:
+            connection.execute(text(f"ALTER TABLE contest_contest ADD COLUMN {column} BIGINT"))
+    duplicates = connection.execute(text(
+        "SELECT c.cid, c.name FROM contest_contest c WHERE EXISTS ("
+        " SELECT 1 FROM contest_contest d WHERE d.guild_id = c.guild_id AND d.name = c.name AND d.cid > c.cid)"
+    )).fetchall()
+    for cid, name in duplicates:
+        suffix = f"#{cid}"
+        connection.execute(text("UPDATE contest_contest SET name = :name WHERE cid = :cid"),
+                           name=name[:NAME_SIZE - len(suffix)] + suffix, cid=cid)
+    connection.execute(text(
+        "CREATE UNIQUE INDEX uq_contest_contest_guild_name ON contest_contest (guild_id, name)"))
+    connection.execute(text("CREATE INDEX ix_contest_contest_open ON contest_contest (guild_id, open)"))
+    connection.execute(text("CREATE INDEX ix_contest_entries_rank ON contest_entries (contest, win_rank)"))
+
+    # Santa exchanges, registrations and pairings: key everything by (guild_id, name)
+    exchange_columns = {column["name"] for column in inspector.get_columns("santa_exchanges")}
+    entry_columns = "entry_channel_id, entry_message_id" \
+        if "entry_message_id" in exchange_columns else "NULL, NULL"
+
+    exchanges = Table(
+        "santa_exchanges_new", metadata,
+        Column("guild_id", BigInteger, primary_key=True),
+        Column("name", String(NAME_SIZE), primary_key=True),
+        Column("owner_id", BigInteger, nullable=False),
+        Column("is_open", Boolean, nullable=False),
+        Column("entry_channel_id", BigInteger, nullable=True),
+        Column("entry_message_id", BigInteger, nullable=True),
+        Index("ix_santa_exchanges_open", "guild_id", "is_open"),
+    )
+    registrations = Table(
+        "santa_registrations_new", metadata,
+        Column("guild_id", BigInteger, primary_key=True),
+        Column("exchange", String(NAME_SIZE), primary_key=True),
+        Column("user_id", BigInteger, primary_key=True),
+        ForeignKeyConstraint(("guild_id", "exchange"), ("santa_exchanges_new.guild_id", "santa_exchanges_new.name")),
+    )
+    pairings = Table(
+        "santa_pairings_new", metadata,
+        Column("guild_id", BigInteger, primary_key=True),
+        Column("exchange", String(NAME_SIZE), primary_key=True),
+        Column("santa_id", BigInteger, primary_key=True),
+        Column("target_id", BigInteger, nullable=False),
+        CheckConstraint("santa_id != target_id", name="santa_pairings_no_self_match"),
+        ForeignKeyConstraint(("guild_id", "exchange", "santa_id"),
+                             ("santa_registrations_new.guild_id", "santa_registrations_new.exchange",
+                              "santa_registrations_new.user_id")),
+        ForeignKeyConstraint(("guild_id", "exchange", "target_id"),
+                             ("santa_registrations_new.guild_id", "santa_registrations_new.exchange",
+                              "santa_registrations_new.user_id")),
+        Index("ix_santa_pairings_target", "guild_id", "exchange", "target_id"),
+    )
+    rebuilt = [
+        rebuild(connection, exchanges, text(
+            "INSERT INTO santa_exchanges_new (guild_id, name, owner_id, is_open, entry_channel_id, entry_message_id)"
+            f" SELECT guild_id, name, owner_id, is_open, {entry_columns} FROM santa_exchanges")),
+        rebuild(connection, registrations, text(
+            "INSERT INTO santa_registrations_new (guild_id, exchange, user_id)"
+            " SELECT e.guild_id, r.exchange, r.user_id FROM santa_registrations r"
+            " JOIN santa_exchanges e ON e.name = r.exchange")),
+        rebuild(connection, pairings, text(
+            "INSERT INTO santa_pairings_new (guild_id, exchange, santa_id, target_id)"
+            " SELECT e.guild_id, p.exchange, p.santa_id, p.target_id FROM santa_pairings p"
+            " JOIN santa_exchanges e ON e.name = p.exchange WHERE p.santa_id != p.target_id")),
+    ]
+
+    # Prohibitions: the baseline only had the two user ids, which become global prohibitions
+    prohibition_columns = {column["name"] for column in inspector.get_columns("santa_prohibitions")}
+    if "guild_id" not in prohibition_columns:
+        prohibited = Table(
+            "santa_prohibitions_new", metadata,
+            Column("prohibition_id", Integer, primary_key=True),
+            Column("guild_id", BigInteger, nullable=False),
+            Column("exchange", String(NAME_SIZE), nullable=False),
+            Column("first_id", BigInteger, nullable=False),
+            Column("second_id", BigInteger, nullable=False),
+            CheckConstraint("first_id < second_id", name="santa_prohibitions_canonical"),
+            Index("ix_santa_prohibitions_pair", "guild_id", "exchange", "first_id", "second_id", unique=True),
+        )
+        rebuilt.append(rebuild(connection, prohibited, text(
+            "INSERT INTO santa_prohibitions_new (guild_id, exchange, first_id, second_id)"
+            " SELECT DISTINCT 0, '',"
+            " CASE WHEN first_id < second_id THEN first_id ELSE second_id END,"
+            " CASE WHEN first_id < second_id THEN second_id ELSE first_id END"
+            " FROM santa_prohibitions WHERE first_id != second_id")))
+
+    # Children go before the tables they reference
+    for final_name, _ in reversed(rebuilt):
+        connection.execute(text(f"DROP TABLE {final_name}"))
+    for final_name, indexes in rebuilt:
+        connection.execute(text(f"ALTER TABLE {final_name}_new RENAME TO {final_name}"))
+        if connection.dialect.name == "postgresql":
+            rename_leftovers(connection, final_name)
+    for final_name, indexes in rebuilt:
+        for index in indexes:
+            columns = ", ".join(column.name for column in index.columns)
+            unique = "UNIQUE " if index.unique else ""
+            connection.execute(text(f"CREATE {unique}INDEX {index.name} ON {final_name} ({columns})"))
+
+    if "outbox_messages" not in tables:
+        outbox = Table(
+            "outbox_messages", metadata,
+            Column("outbox_id", Integer, primary_key=True),
+            Column("idempotency_key", String(100), nullable=False, unique=True),
+            Column("user_id", BigInteger, nullable=False),
+            Column("content", Text, nullable=False),
+            Column("status", String(10), nullable=False),
+            Column("attempts", Integer, nullable=False),
+            Column("available_at", DateTime, nullable=False),
+            Column("created_at", DateTime, nullable=False),
+            Column("last_error", String(50), nullable=True),
+            Column("batch", String(100), nullable=True),
+            Column("report_channel_id", BigInteger, nullable=True),
+            Column("reply_to", BigInteger, nullable=True),
+            Index("ix_outbox_messages_ready", "status", "available_at"),
+            Index("ix_outbox_messages_batch", "batch", "status"),
+        )
+        outbox.create(connection)
+
+
+def scheduled_jobs(connection):
+    """ Adds the table of jobs run by the scheduler """
+    metadata = MetaData()
+    jobs = Table(
+        "scheduled_jobs", metadata,
+        Column("job_id", Integer, primary_key=True),
+        Column("guild_id", BigInteger, nullable=False),
+        Column("channel_id", BigInteger, nullable=False),
+        Column("owner_id", BigInteger, nullable=False),
+        Column("action", String(NAME_SIZE), nullable=False),
+        Column("target", String(NAME_SIZE), nullable=False),
+        Column("argument", String(NAME_SIZE), nullable=True),
+        Column("due_at", DateTime, nullable=False),
+        Column("attempts", Integer, nullable=False),
+        Column("created_at", DateTime, nullable=False),
+        Index("ix_scheduled_jobs_guild", "guild_id", "due_at"),
+    )
+    jobs.create(connection)
+
+
+def contest_tickets(connection):
+    """ Gives contest entries a number of tickets, and adds the bonus tickets given by roles """
+    connection.execute(text("ALTER TABLE contest_entries ADD COLUMN tickets INTEGER NOT NULL DEFAULT 1"))
+    metadata = MetaData()
+    Table("contest_contest", metadata, Column("cid", Integer, primary_key=True))
+    bonuses = Table(
+        "contest_bonuses", metadata,
+        Column("contest", Integer, ForeignKey("contest_contest.cid"), primary_key=True),
+        Column("role_id", BigInteger, primary_key=True),
+        Column("tickets", Integer, nullable=False),
+    )
+    bonuses.create(connection)
+
+
+def contest_draws(connection):
+    """ Adds the record of each contest draw, which makes retried draws idempotent """
+    metadata = MetaData()
+    Table("contest_contest", metadata, Column("cid", Integer, primary_key=True))
+    draws = Table(
+        "contest_draws", metadata,
+        Column("contest", Integer, ForeignKey("contest_contest.cid"), primary_key=True),
+        Column("draw_key", String(100), primary_key=True),
+        Column("after_rank", Integer, nullable=False),
+        Column("winners", Integer, nullable=False),
+        Column("drawn_at", DateTime, nullable=False),
+    )
+    draws.create(connection)
+
+
+# (version, description, migration), in the order they are applied
+MIGRATIONS = [
+    (1, "baseline", baseline),
+    (2, "guild scoped keys and hot-path indexes", guild_scoped_keys),
+    (3, "scheduled jobs", scheduled_jobs),
+    (4, "contest tickets", contest_tickets),
+    (5, "contest draws", contest_draws),
+]
+HEAD = MIGRATIONS[-1][0]
+
+
+def current_version(connection):
+    """ Returns the latest applied migration, 0 for an empty database, or None if it predates versioning """
+    tables = set(inspect(connection).get_table_names())
+    if "schema_version" not in tables:
+        return None if tables.intersection(LEGACY_TABLES) else 0
+    return connection.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def stamp(connection, version, description):
+    connection.execute(schema_version.insert(), version=version, description=description,
+                       applied_at=datetime.utcnow())
+
+
+def upgrade(engine):
+    """ Brings the database up to the latest schema. Returns the versions that were applied """
+    applied = list()
+    with engine.connect() as connection:
+        postgres = engine.dialect.name == "postgresql"
+        if postgres:
+            connection.execute(text("SELECT pg_advisory_lock(:key)"), key=ADVISORY_LOCK)
+        try:
+            with connection.begin():
+                version = current_version(connection)
+                version_metadata.create_all(connection)
+                if version == 0:
+                    # A new database gets the current schema in one go
+                    for name in MODEL_MODULES:
+                        importlib.import_module(name).Base.metadata.create_all(connection)
+                    stamp(connection, HEAD, "created at the latest schema")
+                    print(f"Created the database schema at version {HEAD}")
+                    return [HEAD]
+                if version is None:
+                    stamp(connection, 1, "baseline")
+                    version = 1
+
+            for number, description, migration in MIGRATIONS:
+                if number <= version:
+                    continue
+                with connection.begin():
+                    print(f"Applying migration {number}: {description}")
+                    migration(connection)
+                    stamp(connection, number, description)
+                applied.append(number)
+        finally:
+            if postgres:
+                connection.execute(text("SELECT pg_advisory_unlock(:key)"), key=ADVISORY_LOCK)
+    return applied
+
+
+def check(engine):
+    """
+    Raises RuntimeError unless the database is at the latest schema. The bot checks rather than
+    migrates, so migrations run once, as a step of their own, before any bot process starts.
+    """
+    with engine.connect() as connection:
+        version = current_version(connection)
+    if version != HEAD:
+        raise RuntimeError(f"The database schema is at version {version}, but version {HEAD} is needed. "
+                           f"Run `python -m hatch.migrations upgrade` first.")
+
+
+def hot_queries(session):
+    """ Returns (name, query) for the queries the bot runs most, with representative arguments """
+    from hatch.contest import Contest, Entry
+    from hatch.santa import Exchange, Pairing, Registrant
+    guild_id, user_id, cid = 1, 2, 3
+    return [
+        ("contest lookup", session.query(Contest).filter_by(guild_id=guild_id, name="x")),
+        ("open contests", session.query(Contest.name).filter_by(guild_id=guild_id, open=True).order_by(Contest.name)),
+        ("contest winners", session.query(Entry.user_id, Entry.win_rank)
+            .filter(Entry.contest == cid, Entry.win_rank > 0).order_by(Entry.win_rank)),
+        ("exchange lookup", session.query(Exchange).filter_by(guild_id=guild_id, name="x")),
+        ("open exchanges", session.query(Exchange.name).filter_by(guild_id=guild_id, is_open=True)),
+        ("registrants", session.query(Registrant.user_id).filter_by(guild_id=guild_id, exchange="x")
+            .order_by(Registrant.user_id)),
+        ("reply to santa", session.query(Pairing).filter_by(guild_id=guild_id, exchange="x", target_id=user_id)),
+    ]
+
+
+def uses_index(plan):
+    """
+    Returns true if a query plan, as the lines SQLite or Postgres explain it with, reads through
+    an index and never scans a whole table
+    """
+    for line in plan:
+        if "Seq Scan" in line or re.match(r"^SCAN \S+$", line.strip()):
+            return False
+    return any("INDEX" in line.upper() or "PRIMARY KEY" in line for line in plan)
+
+
+def explain(engine):
+    """
+    Prints the database's plan for each hot query, and returns the names of the queries whose
+    plan does not use an index
+    """
+    postgres = engine.dialect.name == "postgresql"
+    prefix = "EXPLAIN " if postgres else "EXPLAIN QUERY PLAN "
+    unindexed = list()
+    session = Session(bind=engine)
+    try:
+        if postgres:
+            # Tables small enough to read whole are scanned even when an index would do, so
+            # make scans a last resort to see whether an index can serve the query
+            session.execute(text("SET LOCAL enable_seqscan = off"))
+        for name, query in hot_queries(session):
+            statement = query.statement.compile(dialect=engine.dialect, compile_kwargs={"literal_binds": True})
+            print(f"-- {name}")
+            plan = list()
+            for row in session.execute(text(prefix + str(statement))):
+                print("   ", " ".join(str(value) for value in row))
+                # The last column of either database's plan describes the step
+                plan.append(str(row[-1]))
+            if not uses_index(plan):
+                unindexed.append(name)
+    finally:
+        session.close()
+    return unindexed
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from hatch.database import create_engine_from_env
+    load_dotenv()
+
+    command = sys.argv[1] if len(sys.argv) > 1 else "upgrade"
+    engine = create_engine_from_env()
+    if command == "upgrade":
+        print(f"Applied migrations: {upgrade(engine) or 'none'}")
+    elif command == "status":
+        with engine.connect() as connection:
+            print(f"Schema version {current_version(connection)}, latest is {HEAD}")
+    elif command == "explain":
+        unindexed = explain(engine)
+        if len(unindexed) > 0:
+            sys.exit(f"These queries do not use an index: {', '.join(unindexed)}")
+    else:
+        sys.exit("Usage: python -m hatch.migrations [upgrade|status|explain]")
@@ -0,0 +1,111 @@
+import asyncio
+import json
+import os
+import select
+import socket
+import threading
+
+from sqlalchemy import text
+
+import hatch.cache as cache
+
+# The Postgres channel cache invalidations are sent on
+CHANNEL = "hatch_invalidate"
+# How long the listener waits for a notification before checking whether it should stop, in seconds
+POLL_TIMEOUT = 5
+RECONNECT_DELAY = 5
+
+
+def notify(session, payload):
+    """ Sends a notification when the caller's transaction commits """
+    session.execute(text("SELECT pg_notify(:channel, :payload)"), dict(channel=CHANNEL, payload=payload))
+
+
+class Notifier:
+    """
+    This class keeps the caches of several bot processes consistent through Postgres LISTEN/NOTIFY.
+
+    Every invalidation in this process is sent to the others as a notification naming the cache
+    and key, and every notification from another process invalidates the same key here. A
+    thread holds a dedicated connection listening for notifications. Notifications sent while
+    it was disconnected are lost, so every cache is cleared whenever it connects.
+    """
+    def __init__(self, engine, db):
+        self.engine = engine
+        self.db = db
+        self.origin = f"{socket.gethostname()}:{os.getpid()}"
+        self.loop = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """ Starts sending and receiving invalidations. Only Postgres supports them """
+        if self.engine.dialect.name != "postgresql":
+            print("Cache invalidations are only shared between processes on Postgres")
+            return
+        self.loop = asyncio.get_event_loop()
+        cache.invalidation_hooks.append(self.on_invalidate)
+        self.thread = threading.Thread(target=self.listen, name="hatch-listen", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.on_invalidate in cache.invalidation_hooks:
+            cache.invalidation_hooks.remove(self.on_invalidate)
+
+    def on_invalidate(self, name, key):
+        payload = json.dumps(dict(origin=self.origin, cache=name, key=key))
+        asyncio.ensure_future(self.publish(payload))
+
+    async def publish(self, payload):
+        try:
+            await self.db.run(notify, payload)
+        except Exception as error:
+            print(f"Could not share a cache invalidation: {error!r}")
+
+    def receive(self, payload):
+        """ Applies an invalidation from another process """
+        message = json.loads(payload)
+        if message["origin"] == self.origin:
+            return
+        target = cache.invalidators.get(message["cache"])
+        if target is None:
+            return
+        key = message["key"]
+        # JSON turns tuple keys into lists
+        target.invalidate(tuple(key) if isinstance(key, list) else key, local=True)
+
+    def clear_all(self):
+        for target in list(cache.invalidators.values()):
+            target.clear()
+
+    def listen(self):
+        """ Receives notifications until stopped, reconnecting whenever the connection drops """
+        while not self.stopped.is_set():
+            connection = None
+            try:
+                # A connection of its own, kept out of the pool, as it is held for good
+                connection = self.engine.raw_connection()
+                connection.detach()
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute(f"LISTEN {CHANNEL}")
+                self.loop.call_soon_threadsafe(self.clear_all)
+
+                while not self.stopped.is_set():
+                    readable, _, _ = select.select([dbapi_connection], [], [], POLL_TIMEOUT)
+                    if not readable:
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notification = dbapi_connection.notifies.pop(0)
+                        self.loop.call_soon_threadsafe(self.receive, notification.payload)
+            except Exception as error:
+                print(f"Cache invalidation listener disconnected: {error!r}")
+                self.stopped.wait(RECONNECT_DELAY)
+            finally:
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
@@ -0,0 +1,245 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import discord
+from discord.ext import commands
+from sqlalchemy import BigInteger, Column, DateTime, func, Index, Integer, String, Text
+from sqlalchemy.ext.declarative import declarative_base
+
+import hatch.dispatch as dispatch
+import hatch.paging as paging
+from hatch.database import insert_ignore
+
+# Messages claimed by the worker at a time
+CLAIM_SIZE = 100
+# A claimed message is offered again if it wasn't settled within this long, e.g. after a restart
+LEASE = timedelta(minutes=5)
+# How often the worker looks for messages when nothing wakes it, in seconds
+POLL_INTERVAL = 30
+# Delivery attempts before a message that keeps failing is given up on
+MAX_ATTEMPTS = 5
+RETRY_BASE = timedelta(seconds=30)
+# Delivered and failed messages are deleted after this long
+RETENTION = timedelta(days=7)
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+# Failures that will not go away by trying again
+PERMANENT_FAILURES = (dispatch.DMS_CLOSED, dispatch.USER_NOT_FOUND)
+
+Base = declarative_base()
+
+
+class OutboxMessage(Base):
+    """
+    This is an SQLAlchemy class representing a direct message waiting to be delivered.
+    """
+    __tablename__ = "outbox_messages"
+
+    outbox_id = Column(Integer, primary_key=True)
+    # Unique per message, so writing the same message twice only queues it once
+    idempotency_key = Column(String(100), nullable=False, unique=True)
+    user_id = Column(BigInteger, nullable=False)
+    content = Column(Text, nullable=False)
+    status = Column(String(10), nullable=False, default=PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    available_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    last_error = Column(String(50), nullable=True)
+    # Messages sent together, such as an exchange's assignments, and where to report on them.
+    # Batches are told apart by both, since exchange names are only unique within a guild.
+    batch = Column(String(100), nullable=True)
+    report_channel_id = Column(BigInteger, nullable=True)
+    # Who to tell if this message can't be delivered, such as the sender of a relayed message
+    reply_to = Column(BigInteger, nullable=True)
+
+    __table_args__ = (
+        Index("ix_outbox_messages_ready", "status", "available_at"),
+        Index("ix_outbox_messages_batch", "batch", "status"),
+    )
+
+    def __repr__(self):
+        return f"<OutboxMessage(key='{self.idempotency_key}', user_id='{self.user_id}', status='{self.status}')>"
+
+
+def outbox_message(key, user_id, content, batch=None, report_channel_id=None, reply_to=None):
+    """ Returns an outbox row for enqueue """
+    return dict(idempotency_key=key, user_id=user_id, content=content, status=PENDING, attempts=0,
+                available_at=datetime.utcnow(), created_at=datetime.utcnow(), batch=batch,
+                report_channel_id=report_channel_id, reply_to=reply_to)
+
+
+def enqueue(session, messages):
+    """
+    Queues outbox_message rows for delivery, as part of the caller's transaction.
+    Messages whose idempotency key was already queued are skipped.
+    Returns the number of messages queued.
+    """
+    return len(insert_ignore(session, OutboxMessage, messages, ("idempotency_key",)))
+
+
+def claim(session, limit):
+    """
+    Returns up to limit messages that are ready to send, and leases them so no other worker
+    picks them up until the lease runs out
+    """
+    now = datetime.utcnow()
+    claimed = (session.query(OutboxMessage)
+               .filter(OutboxMessage.status == PENDING, OutboxMessage.available_at <= now)
+               .order_by(OutboxMessage.outbox_id)
+               .limit(limit)
+               .with_for_update(skip_locked=True)
+               .all())
+    if len(claimed) > 0:
+        session.query(OutboxMessage) \
+            .filter(OutboxMessage.outbox_id.in_([message.outbox_id for message in claimed])) \
+            .update({OutboxMessage.available_at: now + LEASE}, synchronize_session=False)
+    return claimed
+
+
+def settle(session, claimed, failures):
+    """
+    Records the outcome of sending claimed messages. failures maps the outbox id of each
+    message that wasn't delivered to the reason why.
+    Returns (batch, report_channel_id, delivered, failed) for every batch this finished, where
+    failed maps user ids to reasons.
+    """
+    now = datetime.utcnow()
+    delivered = [message.outbox_id for message in claimed if message.outbox_id not in failures]
+    if len(delivered) > 0:
+        session.query(OutboxMessage) \
+            .filter(OutboxMessage.outbox_id.in_(delivered)) \
+            .update({OutboxMessage.status: SENT, OutboxMessage.last_error: None}, synchronize_session=False)
+
+    notices = list()
+    for message in claimed:
+        reason = failures.get(message.outbox_id)
+        if reason is None:
+            continue
+        attempts = message.attempts + 1
+        values = {OutboxMessage.attempts: attempts, OutboxMessage.last_error: reason}
+        if reason in PERMANENT_FAILURES or attempts >= MAX_ATTEMPTS:
+            values[OutboxMessage.status] = FAILED
+            if message.reply_to is not None:
+                notices.append(outbox_message(
+                    f"{message.idempotency_key}:failed", message.reply_to,
+                    f"Your message could not be delivered ({reason})."))
+        else:
+            values[OutboxMessage.available_at] = now + RETRY_BASE * 2 ** (attempts - 1)
+        session.query(OutboxMessage).filter_by(outbox_id=message.outbox_id) \
+            .update(values, synchronize_session=False)
+    enqueue(session, notices)
+
+    finished = list()
+    for batch, channel_id in {(message.batch, message.report_channel_id) for message in claimed
+                              if message.batch is not None}:
+        messages = session.query(OutboxMessage).filter_by(batch=batch, report_channel_id=channel_id)
+        pending = messages.filter_by(status=PENDING).with_entities(func.count(OutboxMessage.outbox_id)).scalar()
+        if pending > 0:
+            continue
+        outcomes = messages.with_entities(OutboxMessage.user_id, OutboxMessage.status, OutboxMessage.last_error).all()
+        sent = sum(1 for outcome in outcomes if outcome.status == SENT)
+        failed = {outcome.user_id: outcome.last_error for outcome in outcomes if outcome.status == FAILED}
+        finished.append((batch, channel_id, sent, failed))
+    return finished
+
+
+def purge(session, before):
+    """ Deletes settled messages created before a time """
+    return session.query(OutboxMessage) \
+        .filter(OutboxMessage.status != PENDING, OutboxMessage.created_at < before) \
+        .delete(synchronize_session=False)
+
+
+class Outbox(commands.cog.Cog):
+    """
+    This class delivers queued direct messages in the background.
+
+    Commands write their messages to the outbox table in the same transaction as the change
+    that produced them, then wake the worker. The worker claims ready messages, sends them
+    through the dispatcher and records the outcome, so delivery is at least once and picks
+    up where it left off after a restart.
+    """
+    def __init__(self, bot, db, dispatcher):
+        self.bot = bot
+        self.db = db
+        self.dispatcher = dispatcher
+        self.wakeup = asyncio.Event()
+        self.worker = None
+
+    def wake(self):
+        """ Tells the worker there are new messages to send """
+        self.wakeup.set()
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready fires again after reconnects, but one worker is enough
+        if self.worker is None:
+            self.worker = asyncio.ensure_future(self.run())
+
+    def cog_unload(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+    async def run(self):
+        """ Delivers messages until cancelled """
+        try:
+            purged = await self.db.run(purge, datetime.utcnow() - RETENTION)
+            if purged > 0:
+                print(f"Purged {purged} settled outbox messages")
+        except Exception as error:
+            print(f"Outbox purge failed: {error!r}")
+        while True:
+            self.wakeup.clear()
+            try:
+                sent = await self.deliver_ready()
+            except Exception as error:
+                print(f"Outbox delivery failed: {error!r}")
+                sent = 0
+            if sent == 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def deliver_ready(self):
+        """ Sends one claim of ready messages. Returns how many were claimed """
+        claimed = await self.db.run(claim, CLAIM_SIZE)
+        if len(claimed) == 0:
+            return 0
+        report = await self.dispatcher.fan_out(
+            [(message.outbox_id, message.user_id, message.content) for message in claimed])
+        finished = await self.db.run(settle, claimed, report.failed)
+        for batch, channel_id, sent, failed in finished:
+            await self.report(batch, channel_id, sent, failed)
+        return len(claimed)
+
+    async def report(self, batch, channel_id, sent, failed):
+        """ Tells a batch's channel how its delivery went """
+        print(f"Outbox batch {batch}: {sent} sent, {len(failed)} failed")
+        if channel_id is None:
+            return
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            # The channel may belong to a shard run by another process
+            try:
+                channel = await self.bot.fetch_channel(channel_id)
+            except discord.HTTPException as error:
+                print(f"Could not find the channel to report on outbox batch {batch}: {error!r}")
+                return
+        message = f"PMs for {batch} have been sent to {sent} of {sent + len(failed)} Santas."
+        if len(failed) > 0:
+            message += "\nThese Santas could not be messaged: " + \
+                       ", ".join(f"<@{user_id}> ({reason})" for user_id, reason in failed.items())
+        try:
+            for chunk in paging.split_message(message):
+                await channel.send(chunk, allowed_mentions=discord.AllowedMentions.none())
+        except discord.HTTPException as error:
+            print(f"Could not report on outbox batch {batch}: {error!r}")
+
+
+def setup(bot):
+    """ Loads the cog as a discord.py extension. bot.db and bot.processes must be set first """
+    bot.add_cog(Outbox(bot, bot.db, dispatch.Dispatcher(bot, processes=bot.processes)))
@@ -0,0 +1,144 @@
+import asyncio
+
+import discord
+
+import hatch.util as util
+
+# Rows read from the database for each page of a listing
+PAGE_SIZE = 40
+# Discord rejects messages longer than this
+MESSAGE_LIMIT = 2000
+# Discord rejects embed descriptions longer than this
+DESCRIPTION_LIMIT = 2048
+# How long a paged listing keeps answering its controls, in seconds
+PAGER_TIMEOUT = 300
+PREVIOUS_EMOJI = "\u25C0"
+NEXT_EMOJI = "\u25B6"
+
+
+class Listing:
+    """
+    This class reads a listing from the database one page at a time.
+
+    fetch_page(after, limit) must return up to limit rows that follow the cursor after, in
+    key order, where key(row) gives a row's cursor and None starts from the beginning.
+    render(rows) turns a page of rows into the items shown for them. Only the cursor at the
+    start of each page seen so far is kept, so earlier pages are read again when revisited.
+    """
+    def __init__(self, fetch_page, render, key, after=None, page_size=PAGE_SIZE):
+        self.fetch_page = fetch_page
+        self.render = render
+        self.key = key
+        self.page_size = page_size
+        self.starts = [after]
+
+    async def load(self, index):
+        """ Returns the items on a page, and whether there is a page after it """
+        # One extra row tells whether another page follows
+        rows = await self.fetch_page(self.starts[index], self.page_size + 1)
+        more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if more and index + 1 == len(self.starts):
+            self.starts.append(self.key(rows[-1]))
+        return await self.render(rows), more
+
+
+class Pager:
+    """
+    This class shows a listing as an embed, one page at a time.
+    Whoever asked for the listing can move between pages by reacting to it.
+    """
+    def __init__(self, context, title, listing, separator):
+        self.context = context
+        self.title = title
+        self.listing = listing
+        self.separator = separator
+
+    def embed(self, items, index, more):
+        description = self.separator.join(items)
+        if len(description) > DESCRIPTION_LIMIT:
+            description = description[:DESCRIPTION_LIMIT - 3] + "..."
+        embed = discord.Embed(title=self.title, description=description)
+        footer = f"Page {index + 1}" if more else f"Page {index + 1} (last)"
+        embed.set_footer(text=footer)
+        return embed
+
+    async def run(self, items, more):
+        """ Sends the first page, then turns pages until the controls time out """
+        message = await self.context.send(embed=self.embed(items, 0, more))
+        await message.add_reaction(PREVIOUS_EMOJI)
+        await message.add_reaction(NEXT_EMOJI)
+
+        author_id = self.context.message.author.id
+
+        def is_control(payload):
+            return payload.message_id == message.id and payload.user_id == author_id \
+                and str(payload.emoji) in (PREVIOUS_EMOJI, NEXT_EMOJI)
+
+        index = 0
+        while True:
+            try:
+                payload = await self.context.bot.wait_for("raw_reaction_add", check=is_control,
+                                                          timeout=PAGER_TIMEOUT)
+            except asyncio.TimeoutError:
+                break
+
+            # Take the reaction back off so the same control can be used again
+            try:
+                await message.remove_reaction(payload.emoji, discord.Object(payload.user_id))
+            except discord.HTTPException:
+                pass
+
+            if str(payload.emoji) == NEXT_EMOJI:
+                if not more:
+                    continue
+                index += 1
+            else:
+                if index == 0:
+                    continue
+                index -= 1
+            items, more = await self.listing.load(index)
+            await message.edit(embed=self.embed(items, index, more))
+
+        try:
+            await message.clear_reactions()
+        except discord.HTTPException:
+            pass
+
+
+def split_message(text, limit=MESSAGE_LIMIT):
+    """
+    This function splits text into pieces short enough to send, preferring to break
+    at the end of a line or after a comma.
+    """
+    chunks = list()
+    while len(text) > limit:
+        cut = max(text.rfind("\n", 0, limit), text.rfind(", ", 0, limit - 1) + 1)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip()
+    chunks.append(text)
+    return chunks
+
+
+async def send_listing(context, header, fetch_page, render, empty, key=lambda row: row,
+                       after=None, separator=", ", footer=""):
+    """
+    This function sends a listing read page by page from the database.
+    A listing that fits in one message is sent as text between the header and footer. Anything
+    longer is sent as a paged embed, and each page is only read when someone turns to it.
+    """
+    listing = Listing(fetch_page, render, key, after)
+    items, more = await listing.load(0)
+    if len(items) == 0 and not more:
+        await util.send(context, empty)
+        return
+
+    message = header + separator.join(items) + footer
+    if not more and len(message) <= MESSAGE_LIMIT:
+        await util.send(context, message)
+        return
+
+    title = header.strip().rstrip(":")
+    await Pager(context, title, listing, separator).run(items, more)
@@ -0,0 +1,301 @@
+import random
+
+# Below this many unplaced participants every candidate is considered, so the search is exhaustive
+SCAN_LIMIT = 64
+# Above it, this many random candidates are drawn for each step
+SAMPLE_SIZE = 8
+# Total number of candidate placements tried before the search gives up
+DEFAULT_MAX_STEPS = 100000
+
+
+class PairingError(Exception):
+    """
+    Raised when participants can not be arranged into a single Secret Santa cycle.
+    proven is true when no valid arrangement exists, and false when the search gave up.
+    """
+    def __init__(self, message, proven):
+        super().__init__(message)
+        self.proven = proven
+
+
+def make_circular_pairs(items):
+    """
+    Creates a generator from a list of items, so each item is paired with the item
+    that follows. The last item is paired with the first.
+    """
+    length = len(items)
+    for i in range(length):
+        yield items[i], items[(i + 1) % length]
+
+
+def build_blocked(participants, prohibited):
+    """
+    Builds the prohibition graph for a set of participants.
+    prohibited is an iterable of pairs who may not be matched, in either direction.
+    Returns a dict mapping each participant to the set of participants they may not be paired with.
+    """
+    blocked = {participant: set() for participant in participants}
+    for first, second in prohibited:
+        if first in blocked and second in blocked and first != second:
+            blocked[first].add(second)
+            blocked[second].add(first)
+    return blocked
+
+
+def is_connected(participants, blocked):
+    """ Returns true if every participant can reach every other through allowed pairings """
+    unvisited = set(participants)
+    queue = [unvisited.pop()]
+    while queue:
+        node = queue.pop()
+        # Each unvisited participant is either reached or skipped because of a prohibition,
+        # so the whole walk costs O(participants + prohibitions)
+        reached = [other for other in unvisited if other not in blocked[node]]
+        unvisited.difference_update(reached)
+        queue.extend(reached)
+    return len(unvisited) == 0
+
+
+def check_feasible(participants, blocked):
+    """ Raises a proven PairingError if the participants can not form a cycle """
+    count = len(participants)
+    if count < 2:
+        raise PairingError("There must be at least 2 Santas to make pairs.", proven=True)
+
+    if count == 2:
+        first, second = participants
+        if second in blocked[first]:
+            raise PairingError("The only 2 Santas may not be paired with each other.", proven=True)
+        return
+
+    # Everyone needs both a Santa and a target they are allowed to be paired with
+    for participant in participants:
+        if count - 1 - len(blocked[participant]) < 2:
+            raise PairingError(f"Participant {participant} is prohibited from matching with"
+                               " all but one other Santa.", proven=True)
+
+    if not is_connected(participants, blocked):
+        raise PairingError("The prohibitions split the Santas into groups that can't be paired together.",
+                           proven=True)
+
+
+class _OrderSearch:
+    """
+    A randomized depth-first search for a cyclic order of the constrained participants.
+    At most max_gaps neighbouring participants in the order may be prohibited from each other;
+    each of those gaps is later filled by an unconstrained participant.
+    """
+    def __init__(self, nodes, blocked, max_gaps, rng):
+        self.nodes = nodes
+        self.blocked = blocked
+        self.max_gaps = max_gaps
+        self.rng = rng
+        # Participants who are blocked from at least half the group are always tried first
+        self.hard = [node for node in nodes if 2 * len(blocked[node]) >= len(nodes)]
+
+    def separated(self, first, second):
+        return first == second or second in self.blocked[first]
+
+    def run(self, max_steps):
+        """
+        Returns a tuple of (order, exhaustive). order is None if no order was found.
+        exhaustive is true if every possible order was ruled out.
+        """
+        rng = self.rng
+        blocked = self.blocked
+
+        # Unvisited nodes are kept in a list with a position index, so they can be sampled
+        # and removed or restored in constant time
+        remaining = list(self.nodes)
+        rng.shuffle(remaining)
+        position = {node: index for index, node in enumerate(remaining)}
+        # Number of unvisited nodes each node is prohibited from being next to
+        blocked_unvisited = {node: len(blocked[node]) for node in remaining}
+
+        def visit(node):
+            index = position.pop(node)
+            last = remaining.pop()
+            if last != node:
+                remaining[index] = last
+                position[last] = index
+            for other in blocked[node]:
+                blocked_unvisited[other] -= 1
+            return index
+
+        def unvisit(node, index):
+            if index == len(remaining):
+                remaining.append(node)
+            else:
+                displaced = remaining[index]
+                remaining.append(displaced)
+                position[displaced] = len(remaining) - 1
+                remaining[index] = node
+            position[node] = index
+            for other in blocked[node]:
+                blocked_unvisited[other] += 1
+
+        def candidates(current, gaps):
+            if len(remaining) <= SCAN_LIMIT:
+                pool = list(remaining)
+                exhaustive = True
+            else:
+                pool = {remaining[rng.randrange(len(remaining))] for _ in range(SAMPLE_SIZE)}
+                pool.update(node for node in self.hard if node in position)
+                pool = list(pool)
+                exhaustive = False
+            rng.shuffle(pool)
+            # Warnsdorff's rule: place the participants with the fewest options left first
+            pool.sort(key=lambda node: -blocked_unvisited[node])
+            allowed = [node for node in pool if node not in blocked[current]]
+            if gaps < self.max_gaps:
+                allowed.extend(node for node in pool if node in blocked[current])
+            return allowed, exhaustive
+
+        # The order is cyclic, so it can always start from the most constrained node
+        start = max(remaining, key=lambda node: len(blocked[node]))
+        path = [(start, visit(start), False)]
+        gaps = 0
+        exhaustive = True
+        steps = 0
+
+        options, complete = candidates(start, gaps)
+        exhaustive = exhaustive and complete
+        stack = [[options, 0]]
+
+        while stack:
+            frame = stack[-1]
+            options, index = frame
+            if index >= len(options):
+                stack.pop()
+                if stack:
+                    node, node_index, gap = path.pop()
+                    unvisit(node, node_index)
+                    gaps -= gap
+                continue
+
+            if steps >= max_steps:
+                return None, False
+            steps += 1
+            frame[1] += 1
+
+            node = options[index]
+            gap = node in blocked[path[-1][0]]
+            path.append((node, visit(node), gap))
+            gaps += gap
+
+            if len(remaining) == 0:
+                if gaps + self.separated(node, start) <= self.max_gaps:
+                    return [entry[0] for entry in path], False
+                node, node_index, gap = path.pop()
+                unvisit(node, node_index)
+                gaps -= gap
+                continue
+
+            options, complete = candidates(node, gaps)
+            exhaustive = exhaustive and complete
+            stack.append([options, 0])
+
+        return None, exhaustive
+
+
+def find_pairing(participants, prohibited=(), rng=None, max_steps=DEFAULT_MAX_STEPS):
+    """
+    Arranges participants into a single Secret Santa cycle that respects prohibitions.
+    Returns a list of (Santa, Target) pairings, or raises PairingError.
+
+    Participants without prohibitions can sit anywhere in the cycle, so only the
+    constrained participants are searched. The search is bounded by max_steps; when it
+    runs out PairingError is raised with proven set to false.
+    """
+    if rng is None:
+        rng = random.Random()
+    participants = list(participants)
+    blocked = build_blocked(participants, prohibited)
+    check_feasible(participants, blocked)
+
+    constrained = [participant for participant in participants if blocked[participant]]
+    free = [participant for participant in participants if not blocked[participant]]
+    rng.shuffle(constrained)
+    rng.shuffle(free)
+
+    if len(constrained) == 0:
+        return list(make_circular_pairs(free))
+
+    if len(constrained) <= len(free):
+        # Every constrained participant can be separated by an unconstrained one
+        order = constrained
+    else:
+        search = _OrderSearch(constrained, blocked, len(free), rng)
+        order = None
+        budget = 4 * len(constrained)
+        spent = 0
+        while order is None:
+            # Restart with a fresh random order and a larger budget each time
+            attempt = min(budget, max_steps - spent)
+            if attempt <= 0:
+                raise PairingError("Gave up searching for a valid pairing.", proven=False)
+            order, exhaustive = search.run(attempt)
+            if order is None and exhaustive:
+                raise PairingError("No pairing satisfies the prohibitions.", proven=True)
+            spent += attempt
+            budget *= 2
+
+    # Fill each prohibited gap with an unconstrained participant, then scatter the rest
+    slots = [[] for _ in order]
+    spare = list(free)
+    for index, participant in enumerate(order):
+        following = order[(index + 1) % len(order)]
+        if participant == following or following in blocked[participant]:
+            slots[index].append(spare.pop())
+    for participant in spare:
+        slots[rng.randrange(len(slots))].append(participant)
+
+    cycle = list()
+    for participant, slot in zip(order, slots):
+        cycle.append(participant)
+        cycle.extend(slot)
+    return list(make_circular_pairs(cycle))
+
+
+def find_replacement(targets, removed, is_allowed, rng=None):
+    """
+    Closes the gap left in a Secret Santa cycle when a participant drops out.
+    targets maps every Santa in the cycle to their target, and is_allowed(santa, target) tells
+    whether a pairing respects the prohibitions. Returns a dict mapping the Santas whose
+    targets change to their new targets, or raises PairingError.
+
+    The removed participant's Santa inherits their target when allowed. Otherwise one other
+    participant is moved into the gap, which changes three pairings instead of one.
+    """
+    if rng is None:
+        rng = random.Random()
+    santa = next(giver for giver, receiver in targets.items() if receiver == removed)
+    target = targets[removed]
+    if santa == target:
+        raise PairingError("At least 2 Santas must remain in the exchange.", proven=True)
+    if is_allowed(santa, target):
+        return {santa: target}
+
+    predecessors = {receiver: giver for giver, receiver in targets.items()}
+    candidates = [participant for participant in targets if participant not in (removed, santa, target)]
+    rng.shuffle(candidates)
+    for moved in candidates:
+        before = predecessors[moved]
+        after = targets[moved]
+        if is_allowed(santa, moved) and is_allowed(moved, target) and is_allowed(before, after):
+            return {santa: moved, moved: target, before: after}
+    raise PairingError("No Santa can take over the removed Santa's place without breaking a prohibition.",
+                       proven=len(candidates) == 0)
+
+
+def insertion_point(links, joiner, is_allowed):
+    """
+    Finds where a late joiner can be added to a Secret Santa cycle.
+    links is an iterable of (santa, target) pairings to consider. Returns the first pairing
+    the joiner can be put in the middle of, so santa gives to the joiner and the joiner to
+    target, or None if none of them work.
+    """
+    for santa, target in links:
+        if is_allowed(santa, joiner) and is_allowed(joiner, target):
+            return santa, target
+    return None
@@ -0,0 +1,115 @@
+import csv
+import io
+import re
+
+import hatch.cache as cache
+
+# Guild id used for prohibitions that apply in every guild
+GLOBAL_SCOPE = 0
+# Exchange name used for prohibitions that apply to every exchange in a guild
+ALL_EXCHANGES = ""
+
+MAX_IMPORT_ROWS = 10000
+
+MENTION = re.compile(r"^<@!?(\d+)>$")
+
+
+def canonical(first_id, second_id):
+    """ Returns a prohibited pair in its stored form, with the lower user id first """
+    if first_id < second_id:
+        return first_id, second_id
+    return second_id, first_id
+
+
+def is_prohibited(pairs, first_id, second_id):
+    """ Returns true if two users may not be paired, in either direction """
+    return canonical(first_id, second_id) in pairs
+
+
+def parse_user_id(value):
+    """ Parses a user id or a user mention. Returns None if it is neither """
+    value = value.strip()
+    match = MENTION.match(value)
+    if match is not None:
+        return int(match.group(1))
+    if value.isdigit():
+        return int(value)
+    return None
+
+
+def parse_csv(text, default_exchange=ALL_EXCHANGES):
+    """
+    Parses prohibitions from CSV text, one pair per line: first_user,second_user[,exchange]
+    Users may be ids or mentions. Blank lines, comments and a header line are skipped.
+    Returns a tuple of (prohibitions, bad_lines), where prohibitions are (first, second, exchange).
+    """
+    prohibitions = list()
+    bad_lines = list()
+    for line_number, row in enumerate(csv.reader(io.StringIO(text)), 1):
+        if len(row) == 0 or row[0].strip() == "" or row[0].strip().startswith("#"):
+            continue
+        first = parse_user_id(row[0])
+        second = parse_user_id(row[1]) if len(row) > 1 else None
+        if first is None or second is None or first == second:
+            # The first line may be a header
+            if line_number != 1:
+                bad_lines.append(line_number)
+            continue
+        exchange = row[2].strip() if len(row) > 2 and row[2].strip() != "" else default_exchange
+        prohibitions.append((*canonical(first, second), exchange))
+        if len(prohibitions) >= MAX_IMPORT_ROWS:
+            break
+    return prohibitions, bad_lines
+
+
+class ProhibitionCache:
+    """
+    An in-process cache of the prohibitions that apply in each guild.
+    Each guild maps exchange names to sets of canonical pairs, so checking a pairing is a
+    set lookup. A guild is dropped from the cache whenever its prohibitions are changed.
+    """
+    def __init__(self, name="prohibitions"):
+        self.name = name
+        self.guilds = dict()
+        # Bumped on every invalidation, so loads which raced with a write are not stored
+        self.version = 0
+        cache.invalidators[name] = self
+
+    def get(self, guild_id):
+        """ Returns the cached prohibitions for a guild, or None if they are not cached """
+        return self.guilds.get(guild_id)
+
+    def store(self, guild_id, rows, version):
+        """
+        Caches a guild's prohibitions from (exchange, first_id, second_id) rows.
+        version is the cache version from before the rows were loaded.
+        """
+        scopes = dict()
+        for exchange, first_id, second_id in rows:
+            scopes.setdefault(exchange, set()).add(canonical(first_id, second_id))
+        if version == self.version:
+            self.guilds[guild_id] = scopes
+        return scopes
+
+    def invalidate(self, guild_id, local=False):
+        """
+        Drops a guild's prohibitions, or every guild's for the global scope.
+        Other processes drop theirs too unless local is true.
+        """
+        self.version += 1
+        if guild_id == GLOBAL_SCOPE:
+            self.guilds.clear()
+        else:
+            self.guilds.pop(guild_id, None)
+        if not local:
+            cache.broadcast(self.name, guild_id)
+
+    def clear(self):
+        """ Drops every guild's prohibitions """
+        self.version += 1
+        self.guilds.clear()
+
+
+def pairs_for(scopes, exchange_name):
+    """ Returns the prohibited pairs which apply to an exchange """
+    return scopes.get(ALL_EXCHANGES, set()) | scopes.get(exchange_name, set())
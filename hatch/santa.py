@@ -1,18 +1,38 @@
-import os
-from random import shuffle
-from asyncio import wait
+import functools
+import random
+from asyncio import get_event_loop
 
 from discord.ext import commands
-from sqlalchemy import and_, BigInteger, Boolean, create_engine, CheckConstraint, Column, ForeignKey, \
-    ForeignKeyConstraint, Integer, String
+import discord
+from sqlalchemy import and_, BigInteger, Boolean, CheckConstraint, Column, ForeignKeyConstraint, \
+    func, Index, Integer, String
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 
+import hatch.outbox as outbox
+import hatch.paging as paging
+import hatch.prohibitions as prohibitions
 import hatch.util as util
+from hatch.cache import GuildIndex, LRUCache
+from hatch.database import insert_ignore
+from hatch.ingest import BatchIngester
+from hatch.members import shown_name, UNRESOLVED
+from hatch.pairing import find_pairing, find_replacement, insertion_point, PairingError
+from hatch.scheduler import format_when, schedule_from
 
 EXCHANGE_NAME_SIZE = 30
 
+# Reacting with this emoji to an exchange's entry message joins the exchange
+ENTRY_EMOJI = "\U0001F381"
+# Reaction joins get no reply, so they can wait longer to be written in bigger batches
+REACTION_WINDOW = 1.0
+# Pairings sampled when looking for a place to add a late joiner, before every pairing is tried
+INSERTION_SAMPLE = 32
+# Times a change to a closed exchange's pairings is recalculated after racing with another change
+REPAIR_ATTEMPTS = 3
+# Scheduler action
+CLOSE_JOB = "santa close"
+
 Base = declarative_base()
 
 
@@ -22,10 +42,18 @@ class Exchange(Base):
     """
     __tablename__ = "santa_exchanges"
 
+    # Exchange names only need to be unique within a guild
+    guild_id = Column(BigInteger, primary_key=True)
     name = Column(String(EXCHANGE_NAME_SIZE), primary_key=True)
-    guild_id = Column(BigInteger, nullable=False)
     owner_id = Column(BigInteger, nullable=False)
     is_open = Column(Boolean, nullable=False)
+    # Set when Santas join by reacting to a message instead of with a command
+    entry_channel_id = Column(BigInteger, nullable=True)
+    entry_message_id = Column(BigInteger, nullable=True)
+
+    __table_args__ = (
+        Index("ix_santa_exchanges_open", "guild_id", "is_open"),
+    )
 
     def __repr__(self):
         return "<SantaExchange(name='%s', guild_id='%s', owner_id='%s', is_open='%s')>" % (
@@ -38,13 +66,17 @@ class Registrant(Base):
     """
     __tablename__ = "santa_registrations"
 
-    exchange = Column(String(EXCHANGE_NAME_SIZE), ForeignKey("santa_exchanges.name"),
-                      primary_key=True)
+    guild_id = Column(BigInteger, primary_key=True)
+    exchange = Column(String(EXCHANGE_NAME_SIZE), primary_key=True)
     user_id = Column(BigInteger, primary_key=True)
 
+    __table_args__ = (
+        ForeignKeyConstraint(("guild_id", "exchange"), ("santa_exchanges.guild_id", "santa_exchanges.name")),
+    )
+
     def __repr__(self):
-        return "<SantaRegistrant(exchange='%s', user_id='%s'>" % (
-            self.exchange, self.user_id)
+        return "<SantaRegistrant(guild_id='%s', exchange='%s', user_id='%s'>" % (
+            self.guild_id, self.exchange, self.user_id)
 
 
 class Pairing(Base):
@@ -52,69 +84,492 @@ class Pairing(Base):
     This is an SQLAlchemy class representing the table containing Santa/Target pairings
     """
     __tablename__ = "santa_pairings"
+    guild_id = Column(BigInteger, primary_key=True)
     exchange = Column(String(EXCHANGE_NAME_SIZE), primary_key=True)
     santa_id = Column(BigInteger, primary_key=True)
     target_id = Column(BigInteger, nullable=False)
-    no_self_match = CheckConstraint("santa_id != target_id")
 
     __table_args__ = (
-        ForeignKeyConstraint(("exchange", "santa_id"),
-                             ("santa_registrations.exchange", "santa_registrations.user_id")),
-        ForeignKeyConstraint(("exchange", "target_id"),
-                             ("santa_registrations.exchange", "santa_registrations.user_id")),
+        CheckConstraint("santa_id != target_id", name="santa_pairings_no_self_match"),
+        ForeignKeyConstraint(("guild_id", "exchange", "santa_id"),
+                             ("santa_registrations.guild_id", "santa_registrations.exchange",
+                              "santa_registrations.user_id")),
+        ForeignKeyConstraint(("guild_id", "exchange", "target_id"),
+                             ("santa_registrations.guild_id", "santa_registrations.exchange",
+                              "santa_registrations.user_id")),
+        # Finds a Santa from their target, for replies and when taking a Santa out of the cycle
+        Index("ix_santa_pairings_target", "guild_id", "exchange", "target_id"),
     )
 
     def __repr__(self):
-        return "<SantaPairing(exchange='%s', santa_id='%s', target_id='%s'>" % (
-            self.exchange, self.santa_id, self.target_id)
+        return "<SantaPairing(guild_id='%s', exchange='%s', santa_id='%s', target_id='%s'>" % (
+            self.guild_id, self.exchange, self.santa_id, self.target_id)
 
 class ProhibitedMatches(Base):
     """
-    This is a SQLAlchemy class representing secret santas who are not allowed to be paired
+    This is a SQLAlchemy class representing secret santas who are not allowed to be paired.
+    Each pair is stored once with the lower user id first, and applies in both directions.
+    An empty exchange name applies to every exchange in the guild, and guild 0 to every guild.
     """
     __tablename__ = "santa_prohibitions"
     prohibition_id = Column(Integer, primary_key=True)
+    guild_id = Column(BigInteger, nullable=False, default=prohibitions.GLOBAL_SCOPE)
+    exchange = Column(String(EXCHANGE_NAME_SIZE), nullable=False, default=prohibitions.ALL_EXCHANGES)
     first_id = Column(BigInteger, nullable=False)
     second_id = Column(BigInteger, nullable=False)
 
+    __table_args__ = (
+        CheckConstraint("first_id < second_id", name="santa_prohibitions_canonical"),
+        Index("ix_santa_prohibitions_pair", "guild_id", "exchange", "first_id", "second_id", unique=True),
+    )
+
+    def __repr__(self):
+        return "<SantaProhibition(guild_id='%s', exchange='%s', first_id='%s', second_id='%s'>" % (
+            self.guild_id, self.exchange, self.first_id, self.second_id)
+
+
+
+# Outcomes of an attempt to join an exchange
+JOINED = "joined"
+DUPLICATE = "duplicate"
+NOT_FOUND = "not_found"
+CLOSED = "closed"
+
+def find_exchange(session, guild_id, exchange_name):
+    """ Returns the exchange with a name in a guild, or None """
+    return session.query(Exchange).get((guild_id, exchange_name))
+
+
+def lock_exchange(session, guild_id, exchange_name, shared=False):
+    """
+    Returns an exchange with its row locked until the transaction ends, or None.
+    A shared lock lets registrations be written side by side while keeping a close waiting.
+    """
+    return session.query(Exchange) \
+        .filter_by(guild_id=guild_id, name=exchange_name) \
+        .with_for_update(read=shared) \
+        .one_or_none()
+
+
+def create_exchange(session, guild_id, owner_id, exchange_name):
+    """ Adds a new open exchange. Raises IntegrityError if the name is already taken """
+    session.add(Exchange(
+        name=exchange_name,
+        guild_id=guild_id,
+        owner_id=owner_id,
+        is_open=True,
+    ))
+    session.flush()
+
+
+def join_exchange(session, guild_id, exchange_name, user_ids):
+    """
+    Registers a batch of users for an exchange with one lookup and one multi-row insert.
+    Returns the outcome for each user, in order.
+    """
+    # Verify the exchange is created and open for the current guild, and keep it open until
+    # the registrations are written
+    exchange = lock_exchange(session, guild_id, exchange_name, shared=True)
+    if exchange is None:
+        return [NOT_FOUND] * len(user_ids)
+    if not exchange.is_open:
+        return [CLOSED] * len(user_ids)
+
+    rows = [dict(guild_id=guild_id, exchange=exchange_name, user_id=user_id) for user_id in user_ids]
+    inserted = insert_ignore(session, Registrant, rows, ("guild_id", "exchange", "user_id"))
+    return util.batch_outcomes(user_ids, [user_id for _, _, user_id in inserted], JOINED, DUPLICATE)
 
-# Create the tables needed for Secret Santa
-db_url = os.getenv("DATABASE_URL")
-engine = create_engine(db_url)
-Base.metadata.create_all(engine)
 
+def set_entry_message(session, guild_id, exchange_name, channel_id, message_id):
+    """ Records the message Santas react to in order to join an exchange """
+    session.query(Exchange) \
+        .filter_by(guild_id=guild_id, name=exchange_name) \
+        .update({Exchange.entry_channel_id: channel_id, Exchange.entry_message_id: message_id})
 
-def make_circular_pairs(items):
+
+def get_entry_messages(session):
+    """ Returns (guild_id, name, channel_id, message_id) for every open exchange joined by reaction """
+    return [tuple(row) for row in
+            session.query(Exchange.guild_id, Exchange.name, Exchange.entry_channel_id, Exchange.entry_message_id)
+                .filter(Exchange.is_open == True, Exchange.entry_message_id.isnot(None))
+                .all()]
+
+
+def get_open_exchange_counts(session, guild_id=None):
     """
-    Creates a generator from a list of items, so each item is paired with the item
-    that follows. The last item is paired with the first.
+    Returns (guild_id, name, registrant count) for the open exchanges in a guild, or in every
+    guild if guild_id is None, with one grouped query
     """
-    length = len(items)
-    for i in range(length):
-        yield items[i], items[(i + 1) % length]
+    query = session.query(Exchange.guild_id, Exchange.name, func.count(Registrant.user_id)) \
+        .outerjoin(Registrant, and_(Registrant.guild_id == Exchange.guild_id, Registrant.exchange == Exchange.name)) \
+        .filter(Exchange.is_open == True)
+    if guild_id is not None:
+        query = query.filter(Exchange.guild_id == guild_id)
+    return [tuple(row) for row in query.group_by(Exchange.guild_id, Exchange.name).all()]
+
+
+def get_registrant_ids(session, guild_id, exchange_name, after=None, limit=None):
+    """ Returns the user ids registered for an exchange in order, starting after the user id after """
+    query = session.query(Registrant.user_id).filter_by(guild_id=guild_id, exchange=exchange_name)
+    if after is not None:
+        query = query.filter(Registrant.user_id > after)
+    return [entry.user_id for entry in query.order_by(Registrant.user_id).limit(limit).all()]
 
 
-def match_santa_pairs(participants: list):
-    """ This function returns a list of tuples of (Santa, Target) pairings """
-    shuffle(participants)
-    return list(make_circular_pairs(participants))
+def load_relay(session, exchange_name, user_id, as_santa):
+    """
+    Looks up what is needed to relay a message for a user of a closed exchange.
+    Relays are sent from direct messages, and exchange names are only unique within a guild,
+    so the exchange is the one with the name that the user is registered for.
+    Returns a tuple of (exchange, is_registered, pairing, is_ambiguous). The pairing is the one
+    where the user is the Santa if as_santa is set, or the target otherwise.
+    """
+    exchanges = session.query(Exchange) \
+        .join(Registrant, and_(Registrant.guild_id == Exchange.guild_id, Registrant.exchange == Exchange.name)) \
+        .filter(Exchange.name == exchange_name, Registrant.user_id == user_id) \
+        .limit(2) \
+        .all()
+    if len(exchanges) == 0:
+        return session.query(Exchange).filter_by(name=exchange_name).first(), False, None, False
+    if len(exchanges) > 1:
+        return exchanges[0], True, None, True
+
+    exchange = exchanges[0]
+    if exchange.is_open:
+        return exchange, True, None, False
+    pairings = session.query(Pairing).filter_by(guild_id=exchange.guild_id, exchange=exchange_name)
+    if as_santa:
+        pairing = pairings.filter_by(santa_id=user_id).one_or_none()
+    else:
+        pairing = pairings.filter_by(target_id=user_id).one_or_none()
+    return exchange, True, pairing, False
+
+
+def get_guild_registrant_ids(session, guild_id):
+    """ Returns the ids of users registered for a guild's open exchanges """
+    exchanges = session.query(Exchange.name).filter_by(guild_id=guild_id, is_open=True)
+    return [entry.user_id for entry in
+            session.query(Registrant.user_id)
+                .filter(Registrant.guild_id == guild_id, Registrant.exchange.in_(exchanges))
+                .distinct()
+                .all()]
+
+
+def remove_departed_registrants(session, guild_id, user_ids):
+    """
+    Withdraws users who left a guild from all of its open exchanges.
+    Returns the number of registrations removed.
+    """
+    exchanges = session.query(Exchange.name).filter_by(guild_id=guild_id, is_open=True)
+    return session.query(Registrant) \
+        .filter(Registrant.guild_id == guild_id, Registrant.exchange.in_(exchanges),
+                Registrant.user_id.in_(user_ids)) \
+        .delete(synchronize_session=False)
+
+
+def load_guild_prohibitions(session, guild_id):
+    """ Returns the (exchange, first_id, second_id) rows of every prohibition that applies in a guild """
+    return [tuple(row) for row in
+            session.query(ProhibitedMatches.exchange, ProhibitedMatches.first_id, ProhibitedMatches.second_id)
+                .filter(ProhibitedMatches.guild_id.in_((guild_id, prohibitions.GLOBAL_SCOPE)))
+                .all()]
+
+
+def add_prohibitions(session, guild_id, rows):
+    """
+    Stores (first_id, second_id, exchange) prohibitions for a guild, skipping ones that already exist.
+    Returns the number of prohibitions added.
+    """
+    values = list()
+    for first_id, second_id, exchange in rows:
+        first_id, second_id = prohibitions.canonical(first_id, second_id)
+        values.append(dict(guild_id=guild_id, exchange=exchange, first_id=first_id, second_id=second_id))
+    return len(insert_ignore(session, ProhibitedMatches, values,
+                             ("guild_id", "exchange", "first_id", "second_id")))
+
+
+def remove_prohibition(session, guild_id, exchange, first_id, second_id):
+    """ Deletes a prohibition and returns true if it existed """
+    first_id, second_id = prohibitions.canonical(first_id, second_id)
+    return session.query(ProhibitedMatches) \
+        .filter_by(guild_id=guild_id, exchange=exchange, first_id=first_id, second_id=second_id) \
+        .delete(synchronize_session=False) > 0
+
+
+class RegistrationsChanged(Exception):
+    """ Raised when Santas joined or left an exchange between pairing it and closing it """
+
+
+def record_pairs(session, guild_id, exchange_name, matches, assignments=(), considered=None):
+    """
+    Closes an exchange, stores its pairings and queues the assignment messages.
+    The exchange's row is locked first, so only one close gets through. Returns false if the
+    exchange was already closed. If considered is given, it holds every registrant the
+    pairing was made from, and RegistrationsChanged is raised if anyone else has joined or
+    a paired Santa has left since.
+    """
+    exchange = lock_exchange(session, guild_id, exchange_name)
+    if exchange is None or not exchange.is_open:
+        return False
+    if considered is not None:
+        registered = set(get_registrant_ids(session, guild_id, exchange_name))
+        paired = {santa for santa, _ in matches}
+        if not registered.issubset(considered) or not paired.issubset(registered):
+            raise RegistrationsChanged()
+
+    exchange.is_open = False
+    session.add_all([Pairing(
+            guild_id=guild_id,
+            exchange=exchange_name,
+            santa_id=santa,
+            target_id=target,
+        ) for santa, target in matches
+    ])
+    outbox.enqueue(session, assignments)
+    return True
+
+
+class CycleChanged(Exception):
+    """ Raised when an exchange's pairings changed between planning a repair and applying it """
+
+
+class AlreadyRegistered(Exception):
+    """ Raised when a Santa being added to a closed exchange is already registered in it """
+
+
+def get_pairing_around(session, guild_id, exchange_name, user_id):
+    """
+    Returns (santa, target) for a Santa in a closed exchange: who gives to them and who they give to.
+    Returns None if they aren't paired.
+    """
+    pairings = session.query(Pairing).filter_by(guild_id=guild_id, exchange=exchange_name)
+    giver = pairings.filter_by(target_id=user_id).with_entities(Pairing.santa_id).one_or_none()
+    receiver = pairings.filter_by(santa_id=user_id).with_entities(Pairing.target_id).one_or_none()
+    if giver is None or receiver is None:
+        return None
+    return giver.santa_id, receiver.target_id
+
+
+def load_pairs(session, guild_id, exchange_name):
+    """ Returns a dict mapping every Santa in an exchange to their target """
+    return dict(session.query(Pairing.santa_id, Pairing.target_id)
+                .filter_by(guild_id=guild_id, exchange=exchange_name)
+                .all())
+
+
+def sample_pairs(session, guild_id, exchange_name, count):
+    """ Returns up to count random (santa, target) pairings of an exchange """
+    return [tuple(row) for row in
+            session.query(Pairing.santa_id, Pairing.target_id)
+                .filter_by(guild_id=guild_id, exchange=exchange_name)
+                .order_by(func.random())
+                .limit(count)
+                .all()]
+
+
+def repair_cycle(session, guild_id, exchange_name, changes, messages, removed=None, joiner=None):
+    """
+    Updates only the pairings that change when a Santa leaves or joins a closed exchange, and
+    queues the messages telling the affected Santas.
+    changes maps each Santa whose target changes to (old target, new target). Raises
+    CycleChanged if any of them no longer has the old target, or AlreadyRegistered if the
+    joiner is already registered, so nothing is written.
+    """
+    if joiner is not None:
+        if session.query(Registrant).get((guild_id, exchange_name, joiner)) is not None:
+            raise AlreadyRegistered()
+        session.add(Registrant(guild_id=guild_id, exchange=exchange_name, user_id=joiner))
+        try:
+            session.flush()
+        except IntegrityError:
+            # Registered by another process since the check above
+            raise AlreadyRegistered()
+
+    for santa, (old_target, new_target) in changes.items():
+        if santa == joiner:
+            session.add(Pairing(guild_id=guild_id, exchange=exchange_name, santa_id=joiner, target_id=new_target))
+            continue
+        updated = session.query(Pairing) \
+            .filter_by(guild_id=guild_id, exchange=exchange_name, santa_id=santa, target_id=old_target) \
+            .update({Pairing.target_id: new_target}, synchronize_session=False)
+        if updated != 1:
+            raise CycleChanged()
+
+    if removed is not None:
+        session.flush()
+        session.query(Pairing).filter_by(guild_id=guild_id, exchange=exchange_name, santa_id=removed) \
+            .delete(synchronize_session=False)
+        session.query(Registrant).filter_by(guild_id=guild_id, exchange=exchange_name, user_id=removed) \
+            .delete(synchronize_session=False)
+    outbox.enqueue(session, messages)
+
+
+def withdraw(session, guild_id, exchange_name, user_id):
+    """ Removes a Santa from an open exchange. Returns true if they were registered """
+    exchange = lock_exchange(session, guild_id, exchange_name, shared=True)
+    if exchange is None or not exchange.is_open:
+        return False
+    return session.query(Registrant) \
+        .filter_by(guild_id=guild_id, exchange=exchange_name, user_id=user_id) \
+        .delete(synchronize_session=False) > 0
+
+
+def assignment_message(exchange_name, target_name):
+    """ Returns the message telling a Santa who they have been assigned """
+    return (f"Congratulations Santa! You've been assigned {target_name} for {exchange_name}"
+            f"\n\nPlease **reply to this message** using the following commands to message your target."
+            f"\n\t> To send a message to your target, use `!santa message {exchange_name} Your message`"
+            f"\n\t> To send a reply to your santa, use `!santa reply {exchange_name} Your message`"
+            "\n\nIt may be worth setting yourself to invisible while communicating with your target to "
+            "help keep your identity secret.")
+
+
+def reassignment_message(exchange_name, target_name):
+    """ Returns the message telling a Santa their target has changed """
+    return (f"Your assignment for {exchange_name} has changed. You've now been assigned {target_name}."
+            "\n\nPlease send your gift to them instead of your previous target.")
 
 
 class SecretSanta(commands.cog.Cog):
     """
     This class defines a collection of Discord.py commands for running a secret santa.
     """
-    def __init__(self, bot, db_engine):
+    def __init__(self, bot, db, members, outbox, scheduler=None):
         self.bot = bot
-        self.sessionmaker = sessionmaker(bind=db_engine)
-
-    def get_registrants_ids(self, exchange):
-        session = self.sessionmaker()
-        registrants = (session.query(Registrant)
-                       .filter_by(exchange=exchange)
-                       .all())
-        session.close()
-        return [entry.user_id for entry in registrants]
+        self.db = db
+        self.members = members
+        self.outbox = outbox
+        self.scheduler = scheduler
+        if scheduler is not None:
+            scheduler.register(CLOSE_JOB, self.run_job)
+        self.prohibitions = prohibitions.ProhibitionCache()
+        self.swept = False
+        self.registrations = BatchIngester(self.flush_registrations)
+        self.reaction_registrations = BatchIngester(self.flush_registrations, window=REACTION_WINDOW)
+        # Maps the id of each open exchange's entry message to the exchange's (guild_id, name)
+        self.entry_messages = dict()
+        self.lookups = LRUCache("exchanges")
+        self.open_exchanges = GuildIndex("open exchanges")
+        # Changes to the pairings of the same exchange take turns; other exchanges aren't held up
+        self.locks = util.KeyedLocks()
+
+    async def flush_registrations(self, key, user_ids):
+        """ Writes a batch of buffered registrations """
+        guild_id, exchange_name = key
+        outcomes = await self.db.run(join_exchange, guild_id, exchange_name, user_ids)
+        self.open_exchanges.count(guild_id, exchange_name, outcomes.count(JOINED))
+        return outcomes
+
+    async def get_open_exchanges(self, guild_id):
+        """ Returns the open exchanges in a guild as {name: registrant count}, from the index """
+        return await self.open_exchanges.get_or_load(
+            guild_id, lambda: self.db.run(get_open_exchange_counts, guild_id))
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, guild_id, user_id):
+        """ Withdraws a departing member from the guild's open exchanges """
+        removed = await self.db.run(remove_departed_registrants, guild_id, [user_id])
+        if removed > 0:
+            # Which exchanges the registrations were in isn't known, so the guild is read again
+            self.open_exchanges.invalidate(guild_id)
+            print(f"Removed {removed} santa registrations of {user_id}, who left guild {guild_id}")
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        """ Registers Santas who react to an exchange's entry message, without replying to them """
+        key = self.entry_messages.get(payload.message_id)
+        if key is None or str(payload.emoji) != ENTRY_EMOJI:
+            return
+        if payload.member is None or payload.member.bot:
+            return
+        await self.reaction_registrations.submit(key, payload.user_id)
+
+    async def catch_up_reactions(self):
+        """ Tracks the open exchanges' entry messages, and registers anyone who reacted while the bot was offline """
+        for guild_id, name, channel_id, message_id in await self.db.run(get_entry_messages):
+            self.entry_messages[message_id] = (guild_id, name)
+            user_ids = await util.get_reaction_user_ids(self.bot, channel_id, message_id, ENTRY_EMOJI)
+            if len(user_ids) > 0:
+                await self.flush_registrations((guild_id, name), user_ids)
+
+    async def warm_index(self):
+        """ Indexes the open exchanges of every guild this process serves, with one query """
+        snapshot = self.open_exchanges.snapshot()
+        rows = await self.db.run(get_open_exchange_counts)
+        guild_ids = [guild.id for guild in self.bot.guilds]
+        self.open_exchanges.store(rows, guild_ids, snapshot)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        """
+        Indexes the open exchanges, picks up reaction joins and withdraws members who left
+        while the bot was offline, once per process
+        """
+        if self.swept:
+            return
+        self.swept = True
+        await self.warm_index()
+        await self.catch_up_reactions()
+
+        async def remove(guild, departed):
+            removed = await self.db.run(remove_departed_registrants, guild.id, departed)
+            self.open_exchanges.invalidate(guild.id)
+            print(f"Removed {removed} santa registrations of members who left guild {guild.id}")
+        await self.members.sweep_departed(
+            self.bot.guilds, lambda guild: self.db.run(get_guild_registrant_ids, guild.id), remove)
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild):
+        """ Indexes a new guild's exchanges, which are none unless it is rejoining """
+        await self.get_open_exchanges(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self.open_exchanges.invalidate(guild.id, local=True)
+
+    async def get_exchange(self, guild_id, exchange_name):
+        """ Returns the exchange with a name in a guild, or None. Lookups are cached """
+        return await self.lookups.get_or_load(
+            (guild_id, exchange_name), lambda: self.db.run(find_exchange, guild_id, exchange_name))
+
+    def forget_exchange(self, guild_id, exchange_name):
+        """ Drops an exchange from the lookup cache after it was changed """
+        self.lookups.invalidate((guild_id, exchange_name))
+
+    async def run_job(self, job, context):
+        """ Runs a scheduled close as the owner who scheduled it """
+        await self.close(context, job.target)
+
+    async def get_registrants_ids(self, guild_id, exchange_name):
+        return await self.db.run(get_registrant_ids, guild_id, exchange_name)
+
+    async def get_prohibited_pairs(self, guild_id, exchange_name):
+        """ Returns the set of prohibited pairs for an exchange, loading the guild's prohibitions if needed """
+        scopes = self.prohibitions.get(guild_id)
+        if scopes is None:
+            version = self.prohibitions.version
+            rows = await self.db.run(load_guild_prohibitions, guild_id)
+            scopes = self.prohibitions.store(guild_id, rows, version)
+        return prohibitions.pairs_for(scopes, exchange_name)
+
+    async def check_prohibition_access(self, ctx, exchange_name):
+        """
+        Checks that the author may manage prohibitions for an exchange, or for the whole guild
+        if no exchange is named. Tells the author and returns false if they may not.
+        """
+        if ctx.message.author.guild_permissions.manage_guild:
+            return True
+        if exchange_name == prohibitions.ALL_EXCHANGES:
+            await ctx.send("Only server managers may add prohibitions for every exchange.")
+            return False
+        exchange = await self.get_exchange(ctx.message.guild.id, exchange_name)
+        if exchange is None:
+            await ctx.send(f"Exchange {exchange_name} was not found")
+            return False
+        if exchange.owner_id != ctx.message.author.id:
+            await ctx.send(f"Only the owner of {exchange_name} or a server manager may change its prohibitions.")
+            return False
+        return True
 
     @commands.group()
     async def santa(self, ctx):
@@ -122,11 +577,16 @@ class SecretSanta(commands.cog.Cog):
         A group of commands to help with running a secret santa
         """
         if ctx.invoked_subcommand is None:
-            await ctx.send("Invalid santa command. Valid commands are [ create join list ]")
+            await ctx.send("Invalid santa command. Valid commands are "
+                           "[ add close create import join list prohibit remove schedule unprohibit ]")
 
     @santa.command()
-    async def create(self, ctx, name=""):
-        """ Create a secret santa """
+    async def create(self, ctx, name="", mode=""):
+        """
+        Create a secret santa
+        Add "react" to let Santas join by reacting to a message instead of with a command.
+        Format: !santa create <exchange_name> [react]
+        """
         if not util.is_from_guild(ctx):
             await util.send(ctx, "This message only works in a server")
             return
@@ -134,27 +594,34 @@ class SecretSanta(commands.cog.Cog):
             await util.send(ctx, "You must name your secret santa event." +
                             "\nExample: `!santa create RT2019`")
             return
+        if mode not in ("", "react"):
+            await util.send(ctx, "The entry mode must be left out, or be `react`." +
+                            "\nExample: `!santa create RT2019 react`")
+            return
 
-        exchange = Exchange(
-            name=name,
-            guild_id=ctx.message.guild.id,
-            owner_id=ctx.message.author.id,
-            is_open=True,
-        )
-
-        session = self.sessionmaker()
-        session.add(exchange)
+        guild_id = ctx.message.guild.id
         try:
-            session.commit()
-            await util.send(ctx, f"The Secret Santa exchange {name} has been created and opened." +
-                            f" Santas may join with the command `!santa join {name}`")
+            await self.db.run(create_exchange, guild_id, ctx.message.author.id, name)
         except IntegrityError:
-            session.rollback()
             await util.send(ctx, f"The exchange name {name} has already been taken. Please try another")
+            return
         except:
-            session.rollback()
             await util.send(ctx, f"An error occurred trying to create exchange {name}")
-        session.close()
+            return
+        finally:
+            self.forget_exchange(guild_id, name)
+        self.open_exchanges.add(guild_id, name)
+
+        if mode == "react":
+            message = await util.post_entry_message(
+                ctx, f"The Secret Santa exchange {name} has been created and opened. "
+                     f"React with {ENTRY_EMOJI} to join!", ENTRY_EMOJI)
+            await self.db.run(set_entry_message, guild_id, name, message.channel.id, message.id)
+            self.forget_exchange(guild_id, name)
+            self.entry_messages[message.id] = (guild_id, name)
+        else:
+            await util.send(ctx, f"The Secret Santa exchange {name} has been created and opened." +
+                            f" Santas may join with the command `!santa join {name}`")
 
     @santa.command()
     async def join(self, ctx, exchange_name=""):
@@ -172,44 +639,27 @@ class SecretSanta(commands.cog.Cog):
         user_id = ctx.message.author.id
         guild_id = ctx.message.guild.id
 
-        session = self.sessionmaker()
-
-        # Verify the exchange is created and open for the current guild
-        exchange = session.query(Exchange) \
-            .filter_by(name=exchange_name, guild_id=guild_id) \
-            .one_or_none()
-
-        if exchange is None:
-            session.rollback()
-            session.close()
-            await ctx.send(f"Secret Santa exchange {exchange_name} was not found")
+        try:
+            # Unknown and closed exchanges are turned away from the cache, without a database write
+            exchange = await self.get_exchange(guild_id, exchange_name)
+            if exchange is None:
+                outcome = NOT_FOUND
+            elif not exchange.is_open:
+                outcome = CLOSED
+            else:
+                outcome = await self.registrations.submit((guild_id, exchange_name), user_id)
+        except:
+            await util.send(ctx, f"There was an unknown error registering {username} for {exchange_name}!")
             return
 
-        if not exchange.is_open:
-            session.close()
+        if outcome == NOT_FOUND:
+            await ctx.send(f"Secret Santa exchange {exchange_name} was not found")
+        elif outcome == CLOSED:
             await ctx.send(f"Secret Santa exchange {exchange_name} is closed. Please join the next exchange")
-            return
-
-        # Check if the participant has already registered
-        if session.query(Registrant) \
-                .filter_by(exchange=exchange_name, user_id=user_id) \
-                .count() > 0:
-            session.rollback()
-            session.close()
+        elif outcome == DUPLICATE:
             await util.send(ctx, "Silly goose, you are already registered")
-            return
-
-        registration = Registrant(exchange=exchange_name, user_id=user_id)
-        session.add(registration)
-        try:
-            session.commit()
-            message = f"{username} has joined the secret santa {exchange_name}!"
-            await util.send(ctx, message)
-        except:
-            session.rollback()
-            message = f"There was an unknown error registering {username} for {exchange_name}!"
-            await util.send(ctx, message)
-        session.close()
+        else:
+            await util.send(ctx, f"{username} has joined the secret santa {exchange_name}!")
     
     @santa.command()
     async def list(self, ctx, exchange_name=""):
@@ -225,57 +675,153 @@ class SecretSanta(commands.cog.Cog):
 
     async def list_exchanges(self, ctx):
         """ List the exchanges available in the context """
-        # Verify the exchange is created for the current guild
         guild_id = ctx.message.guild.id
-        session = self.sessionmaker()
-        exchanges = [exchange.name for exchange in
-                     session.query(Exchange)
-                         .filter_by(guild_id=guild_id, is_open=True)
-                         .all()]
-        session.close()
-
-        if len(exchanges) == 0:
-            message = "No Secret Santa exchanges are open for this server." + \
-                      "\n You may create them with the command `!santa create <exchange_name>`"
-        else:
-            message = "The available Secret Santa exchanges are:\n\t" + "\n\t".join(exchanges) \
-                      + "\n You can view the participants of an exchange with the command " \
-                      + "`!santa list <exchange_name>`"
-        await util.send(ctx, message)
+
+        async def fetch_page(name, limit):
+            return self.open_exchanges.page(await self.get_open_exchanges(guild_id), name, limit)
+
+        async def render(exchanges):
+            return [f"{name} ({count} {'Santa' if count == 1 else 'Santas'})" for name, count in exchanges]
+
+        await paging.send_listing(
+            ctx, "The available Secret Santa exchanges are:\n\t", fetch_page,
+            render, "No Secret Santa exchanges are open for this server." +
+                    "\n You may create them with the command `!santa create <exchange_name>`",
+            key=lambda exchange: exchange[0], separator="\n\t",
+            footer="\n You can view the participants of an exchange with the command `!santa list <exchange_name>`")
 
     async def list_participants(self, ctx, exchange_name):
         """ List the participants in the exchange """
         guild_id = ctx.message.guild.id
-        session = self.sessionmaker()
 
         # Verify the exchange is created for the current guild
-        if session.query(Exchange) \
-                .filter_by(name=exchange_name, guild_id=guild_id) \
-                .one_or_none() is None:
-            session.rollback()
-            session.close()
+        if await self.get_exchange(guild_id, exchange_name) is None:
             await ctx.send(f"Exchange {exchange_name} was not found")
             return
 
-        santas = session.query(Registrant.user_id) \
-            .filter_by(exchange=exchange_name) \
-            .all()
+        async def render(santas):
+            # Grab discord display names
+            names = await self.members.resolve(ctx.message.guild, santas)
+            return [shown_name(santa, names[santa]) for santa in santas if names[santa] is not None]
+
+        await paging.send_listing(
+            ctx, f"The registered Santas for {exchange_name} are: ",
+            lambda user_id, limit: self.db.run(get_registrant_ids, guild_id, exchange_name, user_id, limit),
+            render, "There are no registered Santas for " + exchange_name)
 
-        session.close()
+    @santa.command()
+    async def prohibit(self, ctx, first: discord.Member, second: discord.Member, exchange_name=""):
+        """
+        Prevent two Santas from being paired with each other
+        Without an exchange name, the prohibition applies to every exchange in the server.
+        Format: !santa prohibit @first @second [exchange_name]
+        """
+        if not util.is_from_guild(ctx):
+            await util.send(ctx, "This message only works in a server")
+            return
+        if first.id == second.id:
+            await ctx.send("A Santa can never be paired with themselves.")
+            return
+        if not await self.check_prohibition_access(ctx, exchange_name):
+            return
 
-        # Grab discord display names
-        santas = [ctx.message.guild.get_member(santa.user_id) for santa in santas]
-        santa_names = list()
-        for santa in santas:
-            if santa is not None:
-                santa_names.append(santa.display_name)
+        guild_id = ctx.message.guild.id
+        added = await self.db.run(add_prohibitions, guild_id, [(first.id, second.id, exchange_name)])
+        self.prohibitions.invalidate(guild_id)
 
-        if len(santa_names) == 0:
-            message = "There are no registered Santas for " + exchange_name
+        scope = f"in {exchange_name}" if exchange_name else "in any exchange"
+        if added:
+            await util.send(ctx, f"{first.display_name} and {second.display_name} will not be paired {scope}.")
         else:
-            message = f"The registered Santas for {exchange_name} are: " + ", ".join(santa_names)
+            await util.send(ctx, f"{first.display_name} and {second.display_name} are already prohibited {scope}.")
+
+    @santa.command()
+    async def unprohibit(self, ctx, first: discord.Member, second: discord.Member, exchange_name=""):
+        """
+        Allow two Santas to be paired with each other again
+        Format: !santa unprohibit @first @second [exchange_name]
+        """
+        if not util.is_from_guild(ctx):
+            await util.send(ctx, "This message only works in a server")
+            return
+        if not await self.check_prohibition_access(ctx, exchange_name):
+            return
+
+        guild_id = ctx.message.guild.id
+        removed = await self.db.run(remove_prohibition, guild_id, exchange_name, first.id, second.id)
+        self.prohibitions.invalidate(guild_id)
+
+        if removed:
+            await util.send(ctx, f"{first.display_name} and {second.display_name} may be paired again.")
+        else:
+            await util.send(ctx, f"{first.display_name} and {second.display_name} were not prohibited.")
+
+    @santa.command(name="import")
+    async def import_prohibitions(self, ctx, exchange_name=""):
+        """
+        Add prohibitions in bulk from an attached CSV file
+        Each line holds two users, as ids or mentions, and optionally an exchange name.
+        Format: !santa import [exchange_name] with the CSV file attached
+        """
+        if not util.is_from_guild(ctx):
+            await util.send(ctx, "This message only works in a server")
+            return
+        if len(ctx.message.attachments) == 0:
+            await ctx.send("Attach a CSV file with one `first_user,second_user[,exchange]` pair per line.")
+            return
+
+        try:
+            text = (await ctx.message.attachments[0].read()).decode("utf-8-sig")
+        except (discord.HTTPException, UnicodeDecodeError):
+            await ctx.send("The attached file could not be read as text.")
+            return
+        rows, bad_lines = prohibitions.parse_csv(text, exchange_name)
+
+        # Every exchange named in the file needs the same access as a single prohibition
+        for scope in sorted({exchange for _, _, exchange in rows}):
+            if not await self.check_prohibition_access(ctx, scope):
+                return
+
+        guild_id = ctx.message.guild.id
+        added = await self.db.run(add_prohibitions, guild_id, rows)
+        self.prohibitions.invalidate(guild_id)
+
+        message = f"Imported {added} new prohibitions ({len(rows) - added} already existed)."
+        if len(bad_lines) > 0:
+            message += " Skipped unreadable lines: " + ", ".join(str(line) for line in bad_lines[:20])
         await util.send(ctx, message)
 
+    async def check_relay(self, context, exchange, as_santa):
+        """
+        Loads the exchange and pairing needed to relay a message, telling the user if it can't be done.
+        Returns a tuple of (exchange, pairing), or None if the message can not be relayed.
+        """
+        user_id = context.message.author.id
+        current_exchange, registered, pairing, ambiguous = await self.db.run(load_relay, exchange, user_id, as_santa)
+
+        if current_exchange is None:
+            await context.send(f"The exchange {exchange} does not exist.")
+            return None
+
+        if ambiguous:
+            await context.send(f"You are registered for more than one exchange named {exchange}. "
+                               "Please ask an organizer to pass your message on.")
+            return None
+
+        if current_exchange.is_open:
+            await context.send(f"The exchange {exchange} is still open, targets have not been drawn yet.")
+            return None
+
+        if not registered:
+            await context.send("You are not registered for this secret santa exchange")
+            return None
+
+        if pairing is None:
+            await context.send("There was an error retrieving your target")
+            return None
+
+        return current_exchange, pairing
+
     @santa.command()
     async def message(self, context, exchange="", *, santa_message=""):
         """
@@ -298,46 +844,22 @@ class SecretSanta(commands.cog.Cog):
                                f"\n\tYou must use the format: !santa message {exchange} <message>")
             return
 
-        session = self.sessionmaker()
-
-        user_id = context.message.author.id
-
-        current_exchange = session.query(Exchange).filter_by(name=exchange).one_or_none()
-        if current_exchange is None:
-            session.close()
-            await context.send(f"The exchange {exchange} does not exist.")
-            return
-
-        if current_exchange.is_open:
-            session.close()
-            await context.send(f"The exchange {exchange} is still open, targets have not been drawn yet.")
-            return
-
-        if session.query(Registrant).filter_by(exchange=exchange, user_id=user_id).one_or_none() is None:
-            session.close()
-            await context.send("You are not registered for this secret santa exchange")
+        relay = await self.check_relay(context, exchange, as_santa=True)
+        if relay is None:
             return
+        current_exchange, pairing = relay
 
-        pairing = session.query(Pairing).filter_by(exchange=exchange, santa_id=user_id).one_or_none()
-        session.close()
-
-        if pairing is None:
-            await context.send("There was an error retrieving your target")
-
-        target = self.bot.get_guild(current_exchange.guild_id).get_member(pairing.target_id)
-
-        awaits = list()
         message = (f"Your Secret Santa from {exchange} sends you a message.\n\n" +
                    "> " + "\n> ".join(santa_message.splitlines()) +  # Put each line into a quote
                    f"\n\nReply using `!santa reply {exchange} Your message here`")
 
-        awaits.append(target.send(message))
-
-        notice = f"Your message has been forwarded to {target.display_name}."
-
-        awaits.append(context.send(notice))
+        relay = outbox.outbox_message(f"relay:{context.message.id}", pairing.target_id, message,
+                                      reply_to=context.message.author.id)
+        await self.db.run(outbox.enqueue, [relay])
+        self.outbox.wake()
 
-        await wait(awaits)
+        target_name = await self.members.display_name_in(current_exchange.guild_id, pairing.target_id)
+        await context.send(f"Your message has been forwarded to {target_name}.")
 
     @santa.command()
     async def reply(self, context, exchange="", *, target_message=""):
@@ -361,48 +883,24 @@ class SecretSanta(commands.cog.Cog):
                                f"\n\tYou can use the format: !santa reply {exchange} <message>")
             return
 
-        session = self.sessionmaker()
-
-        user_id = context.message.author.id
-
-        current_exchange = session.query(Exchange).filter_by(name=exchange).one_or_none()
-        if current_exchange is None:
-            session.close()
-            await context.send(f"The exchange {exchange} does not exist.")
-            return
-
-        if current_exchange.is_open:
-            session.close()
-            await context.send(f"The exchange {exchange} is still open, targets have not been drawn yet.")
+        relay = await self.check_relay(context, exchange, as_santa=False)
+        if relay is None:
             return
+        current_exchange, pairing = relay
 
-        if session.query(Registrant).filter_by(exchange=exchange, user_id=user_id).one_or_none() is None:
-            session.close()
-            await context.send("You are not registered for this secret santa exchange")
-            return
-
-        pairing = session.query(Pairing).filter_by(exchange=exchange, target_id=user_id).one_or_none()
-        session.close()
-
-        if pairing is None:
-            await context.send("There was an error retrieving your target")
-
-        target = self.bot.get_user(pairing.santa_id)
-        santa = context.bot.get_guild(current_exchange.guild_id).get_member(user_id).display_name
-
-        awaits = list()
+        user_id = context.message.author.id
+        santa = await self.members.display_name_in(current_exchange.guild_id, user_id)
 
         message = (f"Your target ({santa}) from the Secret Santa exchange {exchange} sends you a message.\n\n" +
                    "> " + "\n> ".join(target_message.splitlines()) + # Put each line into a quote
                    f"Reply using `!santa message {exchange} Your message here`\n\n")
 
-        awaits.append(target.send(message))
+        relay = outbox.outbox_message(f"relay:{context.message.id}", pairing.santa_id, message,
+                                      reply_to=user_id)
+        await self.db.run(outbox.enqueue, [relay])
+        self.outbox.wake()
 
-        notice = "Your message has been forwarded to your santa."
-
-        awaits.append(context.send(notice))
-
-        await wait(awaits)
+        await context.send("Your message has been forwarded to your santa.")
 
     @santa.command()
     async def close(self, context, exchange_name=""):
@@ -418,107 +916,309 @@ class SecretSanta(commands.cog.Cog):
                                "\n\tYou must format the command this way: `!santa close <exchange_name>`")
             return
 
-        session = self.sessionmaker()
-        exchange = session.query(Exchange).filter_by(name=exchange_name).one_or_none()
+        guild_id = context.message.guild.id
+        exchange = await self.get_exchange(guild_id, exchange_name)
 
         if exchange is None:
-            session.close()
             await context.send(f"The exchange {exchange_name} does not exist.")
             return
 
         if exchange.owner_id != context.message.author.id:
-            session.close()
             print("Author: {}, Owner: {}".format(context.message.author.id, exchange.owner_id))
-            owner_name = context.message.guild.get_member(exchange.owner_id).display_name
+            owner_name = await self.members.display_name(context.message.guild, exchange.owner_id)
             await context.send(f"Only the owner of {exchange_name} ({owner_name}) may close it.")
             return
 
         if not exchange.is_open:
-            session.close()
             await context.send(f"The exchange {exchange_name} is already closed.")
             return
 
-        # Get participants
-        participants = [part.user_id for part in
-                        session.query(Registrant.user_id)
-                            .filter_by(exchange=exchange_name)
-                            .all()]
-
-        # Remove participants who have left the guild
-        removed_users = list()
-        for participant in participants:
-            if context.message.guild.get_member(participant) is None:
-                participants.remove(participant)
-                user = context.bot.get_user(participant)
-                if user is None:
-                    removed_users.append(f"Unknown participant {participant}")
-                else:
-                    removed_users.append(user.name + "#" + user.id)
-
-        if len(removed_users) > 0:
-            await context.send(f"Users who have left the server have been removed from the exchange: " +
-                               ", ".join(removed_users))
-
-        if len(participants) < 2:
-            session.close()
-            await context.send(f"There must be at least 2 Santas in {exchange_name} for it to close.")
-            return
-
-        # Prevent prohibited pairs
-        tries = 0
-        matches = list()
-        while True:
-            tries = tries + 1
-            matches = match_santa_pairs(participants)
-
-            # Check to see if the match is prohibited
-            prohibited = False
-            pairs = matches + [(b, a) for a, b in matches]
-            for pair in pairs:
-                if session.query(ProhibitedMatches).filter(
-                    ProhibitedMatches.first_id==pair[0],
-                    ProhibitedMatches.second_id==pair[1]
-                ).count() > 0:
-                    prohibited = True
-                    break
+        async with self.locks.hold((guild_id, exchange_name)):
+            await self.pair_and_close(context, guild_id, exchange_name)
+
+    async def pair_and_close(self, context, guild_id, exchange_name):
+        """
+        Pairs an exchange's Santas and closes it, pairing them again if any joined or left
+        in the meantime. The caller holds the exchange's lock.
+        """
+        # Another close may have finished while this one waited for the lock
+        exchange = await self.get_exchange(guild_id, exchange_name)
+        if exchange is None or not exchange.is_open:
+            await context.send(f"The exchange {exchange_name} is already closed.")
+            return
 
-            if not prohibited:
-                break 
+        if exchange.entry_message_id is not None:
+            # Write any reaction joins still waiting before pairing
+            await self.reaction_registrations.drain()
+
+        for attempt in range(REPAIR_ATTEMPTS):
+            # Get participants. Those who left the guild were withdrawn as they left.
+            participants = await self.get_registrants_ids(guild_id, exchange_name)
+            considered = set(participants)
+
+            # Resolve every name for the assignment messages in one batch. Anyone the gateway says
+            # is not a member any more is left out of the pairing, but a failed lookup says nothing
+            # about membership, so the exchange stays open rather than pairing without them.
+            names = await self.members.resolve(context.message.guild, participants)
+            if any(names[participant] is UNRESOLVED for participant in participants):
+                await context.send(f"Unable to look up every Santa in {exchange_name} right now, so it is still open. "
+                                   "Please try again.")
+                return
+            participants = [participant for participant in participants if names[participant] is not None]
 
-            # Break out if we are stuck in a loop
-            if prohibited and tries > 100:
-                session.close()
-                message = f"Unable to make pairs for {exchange_name}. Please add more people and try again."
+            if len(participants) < 2:
+                await context.send(f"There must be at least 2 Santas in {exchange_name} for it to close.")
+                return
+
+            # Prevent prohibited pairs
+            prohibited = await self.get_prohibited_pairs(exchange.guild_id, exchange_name)
+            try:
+                # The search is CPU bound, so keep it off the event loop
+                matches = await get_event_loop().run_in_executor(
+                    None, functools.partial(find_pairing, participants, prohibited))
+            except PairingError as error:
+                if error.proven:
+                    message = f"No valid pairs exist for {exchange_name}. {error}"
+                else:
+                    message = f"Unable to make pairs for {exchange_name}. Please add more people and try again."
                 await context.send(message)
                 return
 
+            # Alert Santas as to their targets
+            channel_id = context.message.channel.id
+            assignments = list()
+            for santa, target in matches:
+                message = assignment_message(exchange_name, names[target])
+                assignments.append(outbox.outbox_message(f"assign:{guild_id}:{exchange_name}:{santa}", santa, message,
+                                                         batch=exchange_name, report_channel_id=channel_id))
+
+            # Update the database. The assignments are queued in the same transaction, so they are
+            # delivered even if the bot restarts before sending them all.
+            try:
+                closed = await self.db.run(record_pairs, guild_id, exchange_name, matches, assignments, considered)
+                break
+            except RegistrationsChanged:
+                continue
+        else:
+            await context.send(f"Santas kept joining or leaving {exchange_name}. Please try again.")
+            return
+
+        self.forget_exchange(guild_id, exchange_name)
+        self.open_exchanges.discard(guild_id, exchange_name)
+        self.entry_messages.pop(exchange.entry_message_id, None)
+        if not closed:
+            await context.send(f"The exchange {exchange_name} is already closed.")
+            return
+        self.outbox.wake()
+
+        await context.send(f"The Secret Santa exchange {exchange_name} has been closed and PMs are being sent to Santas."
+                           "\nA report will be posted here once they have all been delivered.")
+
+    @santa.command()
+    async def schedule(self, ctx, exchange_name="", *, when=""):
+        """
+        Close an exchange and match Santas at a set time in UTC
+        Format: !santa schedule <exchange_name> <when>
+        Example: !santa schedule RT2019 friday 18:00
+        """
+        if not util.is_from_guild(ctx):
+            await ctx.send("This command must be run from a server.")
+            return
+
+        if self.scheduler is None:
+            await ctx.send("Scheduling is not available right now.")
+            return
+
+        if exchange_name == "" or when == "":
+            await ctx.send("You must format the command this way: `!santa schedule <exchange_name> <when>`")
+            return
+
+        exchange = await self.get_exchange(ctx.message.guild.id, exchange_name)
+        if exchange is None:
+            await ctx.send(f"The exchange {exchange_name} does not exist.")
+            return
+
+        if exchange.owner_id != ctx.message.author.id:
+            owner_name = await self.members.display_name(ctx.message.guild, exchange.owner_id)
+            await ctx.send(f"Only the owner of {exchange_name} ({owner_name}) may schedule it.")
+            return
+
+        if not exchange.is_open:
+            await ctx.send(f"The exchange {exchange_name} is already closed.")
+            return
+
+        job = await schedule_from(ctx, self.scheduler, CLOSE_JOB, exchange_name, None, when)
+        if job is not None:
+            await ctx.send(f"The Secret Santa exchange {exchange_name} will be closed at {format_when(job.due_at)}."
+                           f" You can cancel this with `!schedule cancel {job.job_id}`")
+
+    async def get_pairing_check(self, guild_id, exchange_name):
+        """ Returns a function telling whether a pairing in an exchange respects its prohibitions """
+        prohibited = await self.get_prohibited_pairs(guild_id, exchange_name)
+        return lambda santa, target: santa != target and not prohibitions.is_prohibited(prohibited, santa, target)
+
+    async def plan_removal(self, guild_id, exchange_name, user_id, is_allowed):
+        """ Returns a dict of the Santas whose targets change when a Santa leaves, or None if they aren't paired """
+        around = await self.db.run(get_pairing_around, guild_id, exchange_name, user_id)
+        if around is None:
+            return None
+        santa, target = around
+        if santa != target and is_allowed(santa, target):
+            # The usual case: the Santa's Santa inherits their target, and only one pairing is read
+            return {santa: (user_id, target)}
+        targets = await self.db.run(load_pairs, guild_id, exchange_name)
+        new_targets = find_replacement(targets, user_id, is_allowed)
+        return {santa: (targets[santa], target) for santa, target in new_targets.items()}
+
+    async def plan_insertion(self, guild_id, exchange_name, user_id, is_allowed):
+        """ Returns the (santa, target) pairing a late joiner can be put in the middle of """
+        links = await self.db.run(sample_pairs, guild_id, exchange_name, INSERTION_SAMPLE)
+        link = insertion_point(links, user_id, is_allowed)
+        if link is None and len(links) == INSERTION_SAMPLE:
+            links = list((await self.db.run(load_pairs, guild_id, exchange_name)).items())
+            random.shuffle(links)
+            link = insertion_point(links, user_id, is_allowed)
+        if link is None:
+            raise PairingError("Every place in the exchange would break a prohibition.", proven=True)
+        return link
+
+    @santa.command()
+    async def remove(self, context, user="", exchange_name=""):
+        """
+        Remove a Santa from an exchange. After it has closed, only their Santa's assignment changes.
+        Santas may remove themselves; the owner may remove anyone.
+        Format: !santa remove <@user|user_id> <exchange_name>
+        """
+        if not util.is_from_guild(context):
+            await context.send("This command must be run from a server.")
+            return
+
+        user_id = prohibitions.parse_user_id(user)
+        if user_id is None or exchange_name == "":
+            await context.send("You must format the command this way: `!santa remove <@user> <exchange_name>`")
+            return
+
+        guild = context.message.guild
+        exchange = await self.get_exchange(guild.id, exchange_name)
+        if exchange is None:
+            await context.send(f"The exchange {exchange_name} does not exist.")
+            return
+
+        author_id = context.message.author.id
+        if author_id not in (exchange.owner_id, user_id):
+            owner_name = await self.members.display_name(guild, exchange.owner_id)
+            await context.send(f"Only the owner of {exchange_name} ({owner_name}) may remove other Santas.")
+            return
+
+        user_name = await self.members.display_name(guild, user_id)
+        if exchange.is_open:
+            if await self.db.run(withdraw, guild.id, exchange_name, user_id):
+                self.open_exchanges.count(guild.id, exchange_name, -1)
+                await util.send(context, f"{user_name} has left the secret santa {exchange_name}.")
+            else:
+                await context.send(f"{user_name} is not registered for {exchange_name}.")
+            return
+
+        async with self.locks.hold((guild.id, exchange_name)):
+            is_allowed = await self.get_pairing_check(guild.id, exchange_name)
+            for attempt in range(REPAIR_ATTEMPTS):
+                try:
+                    changes = await self.plan_removal(guild.id, exchange_name, user_id, is_allowed)
+                except PairingError as error:
+                    await context.send(f"{user_name} can't be removed from {exchange_name}. {error}")
+                    return
+                if changes is None:
+                    await context.send(f"{user_name} is not a Santa in {exchange_name}.")
+                    return
+
+                names = dict(zip(changes, await self.members.display_names(
+                    guild, [new_target for _, new_target in changes.values()])))
+                key = f"remove:{guild.id}:{exchange_name}:{user_id}:{context.message.id}"
+                messages = [outbox.outbox_message(f"{key}:{santa}", santa, reassignment_message(exchange_name, names[santa]))
+                            for santa in changes]
+                messages.append(outbox.outbox_message(
+                    f"{key}:removed", user_id, f"You have been removed from the Secret Santa exchange {exchange_name}."
+                                               "\nPlease don't send a gift to your previous target."))
+                try:
+                    await self.db.run(repair_cycle, guild.id, exchange_name, changes, messages, removed=user_id)
+                    break
+                except CycleChanged:
+                    continue
+            else:
+                await context.send(f"The pairings of {exchange_name} kept changing. Please try again.")
+                return
+
+        self.outbox.wake()
+        await util.send(context, f"{user_name} has been removed from {exchange_name}, "
+                                 f"and {len(changes)} Santa(s) have been sent new assignments.")
 
-        pairings = [Pairing(
-                exchange=exchange_name,
-                santa_id=match[0],
-                target_id=match[1],
-            ) for match in matches
-        ]
+    @santa.command()
+    async def add(self, context, member: discord.Member, exchange_name=""):
+        """
+        Add a late Santa to an exchange after it has closed, without changing anyone else's target.
+        Format: !santa add @member <exchange_name>
+        """
+        if not util.is_from_guild(context):
+            await context.send("This command must be run from a server.")
+            return
 
-        # Update the database
-        exchange.is_open = False
-        session.add_all(pairings)
-        session.commit()
+        if exchange_name == "":
+            await context.send("You must format the command this way: `!santa add @member <exchange_name>`")
+            return
 
-        # Alert Santas as to their targets
-        awaits = list()
-        for santa, target in matches:
-            target_name = context.message.guild.get_member(target).display_name
-            message = (f"Congratulations Santa! You've been assigned {target_name} for {exchange_name}"
-                       f"\n\nPlease **reply to this message** using the following commands to message your target."
-                       f"\n\t> To send a message to your target, use `!santa message {exchange_name} Your message`"
-                       f"\n\t> To send a reply to your santa, use `!santa reply {exchange_name} Your message`"
-                       "\n\nIt may be worth setting yourself to invisible while communicating with your target to "
-                       "help keep your identity secret.")
-            awaits.append(context.bot.get_user(santa).send(message))
+        guild = context.message.guild
+        exchange = await self.get_exchange(guild.id, exchange_name)
+        if exchange is None:
+            await context.send(f"The exchange {exchange_name} does not exist.")
+            return
+
+        if exchange.owner_id != context.message.author.id:
+            owner_name = await self.members.display_name(guild, exchange.owner_id)
+            await context.send(f"Only the owner of {exchange_name} ({owner_name}) may add Santas after it has closed.")
+            return
+
+        if exchange.is_open:
+            await context.send(f"{exchange_name} is still open, so {member.display_name} can join it with "
+                               f"`!santa join {exchange_name}`")
+            return
+
+        async with self.locks.hold((guild.id, exchange_name)):
+            is_allowed = await self.get_pairing_check(guild.id, exchange_name)
+            for attempt in range(REPAIR_ATTEMPTS):
+                if await self.db.run(get_pairing_around, guild.id, exchange_name, member.id) is not None:
+                    await context.send(f"{member.display_name} is already a Santa in {exchange_name}.")
+                    return
+                try:
+                    santa, target = await self.plan_insertion(guild.id, exchange_name, member.id, is_allowed)
+                except PairingError as error:
+                    await context.send(f"{member.display_name} can't be added to {exchange_name}. {error}")
+                    return
+
+                changes = {santa: (target, member.id), member.id: (None, target)}
+                target_name = await self.members.display_name(guild, target)
+                key = f"add:{guild.id}:{exchange_name}:{member.id}:{context.message.id}"
+                messages = [
+                    outbox.outbox_message(f"{key}:{santa}", santa, reassignment_message(exchange_name, member.display_name)),
+                    outbox.outbox_message(f"{key}:{member.id}", member.id, assignment_message(exchange_name, target_name)),
+                ]
+                try:
+                    await self.db.run(repair_cycle, guild.id, exchange_name, changes, messages, joiner=member.id)
+                    break
+                except CycleChanged:
+                    continue
+                except AlreadyRegistered:
+                    await context.send(f"{member.display_name} is already registered in {exchange_name}.")
+                    return
+            else:
+                await context.send(f"The pairings of {exchange_name} kept changing. Please try again.")
+                return
 
-        message = f"The Secret Santa exchange {exchange_name} has been closed and PMs have been sent to Santas.\n"
+        self.outbox.wake()
+        await util.send(context, f"{member.display_name} has joined {exchange_name}, "
+                                 "and they and one other Santa have been sent new assignments.")
 
-        awaits.append(context.send(message))
 
-        await wait(awaits)
+def setup(bot):
+    """ Loads the cog as a discord.py extension, after hatch.members, hatch.outbox and hatch.scheduler """
+    bot.add_cog(SecretSanta(bot, bot.db, bot.get_cog("MemberResolver"), bot.get_cog("Outbox"),
+                            bot.get_cog("Scheduler")))
@@ -0,0 +1,409 @@
+import asyncio
+import heapq
+import re
+from datetime import datetime, timedelta
+
+import discord
+from discord.ext import commands
+from sqlalchemy import BigInteger, Column, DateTime, Index, Integer, String
+from sqlalchemy.ext.declarative import declarative_base
+
+import hatch.paging as paging
+import hatch.util as util
+
+NAME_SIZE = 30
+
+# Jobs are run as soon as they are due; the worker never sleeps longer than this, so a change
+# to the system clock is noticed, in seconds
+MAX_SLEEP = 60
+# A job being run is not run again until this long after it was claimed, e.g. after a restart
+LEASE = timedelta(minutes=5)
+# Runs of a job that keeps failing before it is given up on
+MAX_ATTEMPTS = 3
+RETRY_BASE = timedelta(seconds=30)
+# Limits on what a guild may schedule
+MAX_GUILD_JOBS = 100
+MAX_HORIZON = timedelta(days=366)
+
+WEEKDAYS = ("monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday")
+DURATION = re.compile(r"^in (\d+) ?(m|mins?|minutes?|h|hours?|d|days?)$")
+DURATION_UNITS = {"m": timedelta(minutes=1), "h": timedelta(hours=1), "d": timedelta(days=1)}
+CLOCK = re.compile(r"^(\d{1,2}):(\d{2})$")
+
+Base = declarative_base()
+
+
+class ScheduledJob(Base):
+    """
+    This is an SQLAlchemy class representing an operation an owner asked to be run later,
+    such as closing a contest.
+    """
+    __tablename__ = "scheduled_jobs"
+
+    job_id = Column(Integer, primary_key=True)
+    guild_id = Column(BigInteger, nullable=False)
+    # Where the job's messages are sent, and who it runs as
+    channel_id = Column(BigInteger, nullable=False)
+    owner_id = Column(BigInteger, nullable=False)
+    # A registered action, such as "contest close", its target's name and an optional argument
+    action = Column(String(NAME_SIZE), nullable=False)
+    target = Column(String(NAME_SIZE), nullable=False)
+    argument = Column(String(NAME_SIZE), nullable=True)
+    # When the job is next run, in UTC. Pushed back by the lease while the job runs.
+    due_at = Column(DateTime, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_scheduled_jobs_guild", "guild_id", "due_at"),
+    )
+
+    def __repr__(self):
+        return f"<ScheduledJob(job_id='{self.job_id}', action='{self.action}', target='{self.target}', due_at='{self.due_at}')>"
+
+
+def parse_when(text, now):
+    """
+    Parses when a job should run, in UTC: "in 90m", "in 2 hours", "in 3d", "18:00",
+    "today 18:00", "tomorrow 18:00", "friday 18:00", "friday at 18:00" or "2020-12-24 18:00".
+    A time of day without a date is its next occurrence. Returns None if it can't be parsed.
+    """
+    words = [word for word in text.lower().split() if word != "at"]
+    text = " ".join(words)
+
+    match = DURATION.match(text)
+    if match is not None:
+        return now + int(match.group(1)) * DURATION_UNITS[match.group(2)[0]]
+
+    if len(words) == 2 and re.match(r"^\d{4}-\d{2}-\d{2}$", words[0]):
+        try:
+            return datetime.strptime(text, "%Y-%m-%d %H:%M")
+        except ValueError:
+            return None
+
+    if len(words) not in (1, 2):
+        return None
+    match = CLOCK.match(words[-1])
+    if match is None or int(match.group(1)) > 23 or int(match.group(2)) > 59:
+        return None
+    today = now.replace(hour=int(match.group(1)), minute=int(match.group(2)), second=0, microsecond=0)
+    if len(words) == 1:
+        return today if today > now else today + timedelta(days=1)
+    if words[0] == "today":
+        return today
+    if words[0] == "tomorrow":
+        return today + timedelta(days=1)
+    if words[0] in WEEKDAYS:
+        days = (WEEKDAYS.index(words[0]) - now.weekday()) % 7
+        if days == 0 and today <= now:
+            days = 7
+        return today + timedelta(days=days)
+    return None
+
+
+def format_when(due_at):
+    """ Returns a UTC time as a Discord timestamp, which every reader sees in their own time zone """
+    timestamp = int((due_at - datetime(1970, 1, 1)).total_seconds())
+    return f"<t:{timestamp}:F>"
+
+
+def add_job(session, guild_id, channel_id, owner_id, action, target, argument, due_at):
+    """
+    Stores a new job and returns it, or returns None if the guild already has as many
+    jobs as it may
+    """
+    pending = session.query(ScheduledJob).filter_by(guild_id=guild_id).count()
+    if pending >= MAX_GUILD_JOBS:
+        return None
+    job = ScheduledJob(guild_id=guild_id, channel_id=channel_id, owner_id=owner_id, action=action,
+                       target=target, argument=argument, due_at=due_at, attempts=0,
+                       created_at=datetime.utcnow())
+    session.add(job)
+    session.flush()
+    return job
+
+
+def load_jobs(session):
+    """ Returns every pending job """
+    return session.query(ScheduledJob).all()
+
+
+def claim_job(session, job_id, due_at):
+    """
+    Leases a job which is due to be run. Returns false if it was cancelled, or was changed
+    or claimed by another process since it was read.
+    """
+    return session.query(ScheduledJob) \
+        .filter_by(job_id=job_id, due_at=due_at) \
+        .update({ScheduledJob.due_at: datetime.utcnow() + LEASE,
+                 ScheduledJob.attempts: ScheduledJob.attempts + 1},
+                synchronize_session=False) > 0
+
+
+def retry_job(session, job_id, due_at):
+    """ Puts a job which failed back in line """
+    session.query(ScheduledJob).filter_by(job_id=job_id) \
+        .update({ScheduledJob.due_at: due_at}, synchronize_session=False)
+
+
+def remove_job(session, job_id, guild_id=None):
+    """ Deletes a job, if it is in guild_id when that is given. Returns true if it existed """
+    query = session.query(ScheduledJob).filter_by(job_id=job_id)
+    if guild_id is not None:
+        query = query.filter_by(guild_id=guild_id)
+    return query.delete(synchronize_session=False) > 0
+
+
+class JobMessage:
+    """
+    This class stands in for the message of a command run by a job.
+    """
+    def __init__(self, guild, channel, author, job_id):
+        # Jobs have no message of their own, so the job id keys anything sent from them
+        self.id = f"job{job_id}"
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+
+
+class JobContext:
+    """
+    This class stands in for a command context when a job runs, so the command it schedules
+    can be run as if its owner had typed it in the channel it was scheduled from.
+    """
+    def __init__(self, bot, guild, channel, owner, job_id):
+        self.bot = bot
+        self.channel = channel
+        self.message = JobMessage(guild, channel, owner, job_id)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+class Scheduler(commands.cog.Cog):
+    """
+    This class runs scheduled jobs, such as closing a contest at a set time.
+
+    Jobs are stored in the database and held in memory in a min-heap ordered by due time.
+    One task sleeps until the earliest job is due, or until a new job is due sooner, then runs
+    everything that is due. Every pending job is read back when the bot starts, so jobs
+    survive restarts. Each process only runs the jobs of the guilds on its shards.
+
+    Other cogs register a handler for each action they schedule; handler(job, context) is
+    awaited with a JobContext for the job's channel.
+    """
+    def __init__(self, bot, db):
+        self.bot = bot
+        self.db = db
+        self.handlers = dict()
+        # (due_at, job_id) pairs. Cancelled and rescheduled jobs leave stale pairs behind,
+        # which are skipped when they come up, rather than being searched for.
+        self.heap = list()
+        self.jobs = dict()
+        self.wakeup = asyncio.Event()
+        self.worker = None
+
+    def register(self, action, handler):
+        """ Sets the coroutine function run for jobs with an action """
+        self.handlers[action] = handler
+
+    def owns(self, guild_id):
+        """ Returns true if the guild is on one of this process's shards """
+        shard_ids = getattr(self.bot, "shard_ids", None)
+        if shard_ids is None:
+            return True
+        return (guild_id >> 22) % self.bot.shard_count in shard_ids
+
+    def push(self, job):
+        """ Queues a job to be run at its due time """
+        self.jobs[job.job_id] = job
+        heapq.heappush(self.heap, (job.due_at, job.job_id))
+        if self.heap[0][1] == job.job_id:
+            # The worker is sleeping until a later job
+            self.wakeup.set()
+
+    async def submit(self, guild_id, channel_id, owner_id, action, target, argument, due_at):
+        """ Stores and queues a job. Returns it, or None if the guild has too many jobs """
+        job = await self.db.run(add_job, guild_id, channel_id, owner_id, action, target, argument, due_at)
+        if job is not None:
+            self.push(job)
+        return job
+
+    async def drop(self, job_id, guild_id):
+        """ Cancels a guild's job. Returns true if it was pending """
+        removed = await self.db.run(remove_job, job_id, guild_id)
+        self.jobs.pop(job_id, None)
+        return removed
+
+    def guild_jobs(self, guild_id):
+        """ Returns a guild's pending jobs in the order they are due """
+        return sorted((job for job in self.jobs.values() if job.guild_id == guild_id),
+                      key=lambda job: (job.due_at, job.job_id))
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready fires again after reconnects, but the jobs are only read once
+        if self.worker is None:
+            self.worker = asyncio.ensure_future(self.run())
+
+    def cog_unload(self):
+        if self.worker is not None:
+            self.worker.cancel()
+
+    async def run(self):
+        """ Reads the pending jobs, then runs jobs as they fall due until cancelled """
+        jobs = [job for job in await self.db.run(load_jobs)
+                if self.owns(job.guild_id) and job.job_id not in self.jobs]
+        for job in jobs:
+            self.jobs[job.job_id] = job
+        # One heapify rather than a push per job, as there may be tens of thousands
+        self.heap.extend((job.due_at, job.job_id) for job in jobs)
+        heapq.heapify(self.heap)
+        print(f"Scheduled {len(jobs)} pending jobs")
+
+        while True:
+            self.wakeup.clear()
+            now = datetime.utcnow()
+            while len(self.heap) > 0 and self.heap[0][0] <= now:
+                due_at, job_id = heapq.heappop(self.heap)
+                job = self.jobs.get(job_id)
+                if job is None or job.due_at != due_at:
+                    continue
+                del self.jobs[job_id]
+                # Jobs run side by side, so a slow one doesn't hold up the rest
+                asyncio.ensure_future(self.fire(job))
+
+            timeout = MAX_SLEEP
+            if len(self.heap) > 0:
+                timeout = min(MAX_SLEEP, (self.heap[0][0] - now).total_seconds())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def fire(self, job):
+        """ Runs a job, retrying it later if it fails """
+        try:
+            if not await self.db.run(claim_job, job.job_id, job.due_at):
+                return
+            job.attempts += 1
+            context = await self.job_context(job)
+            if context is None:
+                print(f"Dropping job {job.job_id}, as its guild or channel is gone")
+                await self.db.run(remove_job, job.job_id)
+                return
+            handler = self.handlers.get(job.action)
+            if handler is None:
+                raise RuntimeError(f"No handler for {job.action}")
+            await handler(job, context)
+            await self.db.run(remove_job, job.job_id)
+        except Exception as error:
+            print(f"Job {job.job_id} ({job.action} {job.target}) failed: {error!r}")
+            await self.retry(job)
+
+    async def retry(self, job):
+        try:
+            if job.attempts >= MAX_ATTEMPTS:
+                await self.db.run(remove_job, job.job_id)
+                channel = self.bot.get_channel(job.channel_id)
+                if channel is not None:
+                    await channel.send(f"The scheduled {job.action} of {job.target} failed, and was cancelled.")
+                return
+            job.due_at = datetime.utcnow() + RETRY_BASE * 2 ** (job.attempts - 1)
+            await self.db.run(retry_job, job.job_id, job.due_at)
+            self.push(job)
+        except Exception as error:
+            # The lease runs out and the job is read again on the next restart
+            print(f"Could not reschedule job {job.job_id}: {error!r}")
+
+    async def job_context(self, job):
+        """ Returns the context a job runs in, or None if its guild or channel is gone """
+        guild = self.bot.get_guild(job.guild_id)
+        if guild is None:
+            return None
+        channel = guild.get_channel(job.channel_id)
+        if channel is None:
+            return None
+        owner = guild.get_member(job.owner_id) or discord.Object(id=job.owner_id)
+        return JobContext(self.bot, guild, channel, owner, job.job_id)
+
+    @commands.group()
+    async def schedule(self, context):
+        """
+        A group of commands to see and cancel scheduled jobs
+        Jobs are scheduled with `!contest schedule` and `!santa schedule`
+        """
+        if context.invoked_subcommand is None:
+            await context.send("Invalid command. Valid commands are [ cancel list ]")
+
+    @schedule.command(name="list")
+    async def list_jobs(self, context):
+        """ List this server's scheduled jobs """
+        if not util.is_from_guild(context):
+            await util.send(context, "This message only works in a server")
+            return
+        jobs = self.guild_jobs(context.message.guild.id)
+        if len(jobs) == 0:
+            await context.send("Nothing is scheduled for this server.")
+            return
+        lines = [f"`{job.job_id}` {job.action} {job.target}{' ' + job.argument if job.argument else ''}"
+                 f" at {format_when(job.due_at)}, by <@{job.owner_id}>" for job in jobs]
+        for chunk in paging.split_message("Scheduled jobs:\n" + "\n".join(lines)):
+            await context.send(chunk, allowed_mentions=discord.AllowedMentions.none())
+
+    @schedule.command()
+    async def cancel(self, context, job_id=""):
+        """
+        Cancel a scheduled job. Its owner and server managers may cancel it.
+        Format: !schedule cancel <job_id>
+        """
+        if not util.is_from_guild(context):
+            await util.send(context, "This message only works in a server")
+            return
+        if not job_id.isdigit():
+            await context.send("You must format the command this way: `!schedule cancel <job_id>`")
+            return
+        guild_id = context.message.guild.id
+        job = self.jobs.get(int(job_id))
+        if job is None or job.guild_id != guild_id:
+            await context.send(f"There is no scheduled job {job_id}.")
+            return
+        author = context.message.author
+        if author.id != job.owner_id and not author.guild_permissions.manage_guild:
+            await context.send("Only whoever scheduled a job, or a server manager, may cancel it.")
+            return
+        if await self.drop(job.job_id, guild_id):
+            await context.send(f"The scheduled {job.action} of {job.target} has been cancelled.")
+        else:
+            await context.send(f"There is no scheduled job {job_id}.")
+
+
+async def schedule_from(context, scheduler, action, target, argument, when):
+    """
+    Schedules a job from a command and tells the author when it will run.
+    Returns the job, or None after telling the author why it wasn't scheduled.
+    """
+    now = datetime.utcnow()
+    due_at = parse_when(when, now)
+    if due_at is None:
+        await context.send(f"I couldn't understand when `{when}` is. Times are in UTC, such as"
+                           " `friday 18:00`, `2020-12-24 18:00` or `in 2 hours`.")
+        return None
+    if due_at <= now:
+        await context.send(f"{format_when(due_at)} has already passed.")
+        return None
+    if due_at - now > MAX_HORIZON:
+        await context.send("Jobs may only be scheduled up to a year ahead.")
+        return None
+    job = await scheduler.submit(context.message.guild.id, context.message.channel.id,
+                                   context.message.author.id, action, target, argument, due_at)
+    if job is None:
+        await context.send(f"This server already has {MAX_GUILD_JOBS} scheduled jobs."
+                           " Cancel some with `!schedule cancel <job_id>` first.")
+        return None
+    return job
+
+
+def setup(bot):
+    """ Loads the cog as a discord.py extension. bot.db must be set first """
+    bot.add_cog(Scheduler(bot, bot.db))
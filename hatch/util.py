@@ -1,3 +1,9 @@
+import asyncio
+import contextlib
+
+import discord
+
+
 async def send(context, message):
     '''
     This function prints a message to stdout and sends it to the context
@@ -20,12 +26,71 @@ def is_from_dm(context):
     return context.message.guild is None
 
 
-def get_displayname(id, context):
+def batch_outcomes(user_ids, inserted, added, duplicate):
     """
-    This function gets the printable username of a user
+    This function gives the outcome for each user of a batch insert: added if their row
+    was inserted, or duplicate otherwise. A user repeated within the batch is added once.
     """
-    user = context.message.guild.get_member(id)
-    if user is None:
-        return f"User {id}"
-    else:
-        return user.display_name
+    inserted = set(inserted)
+    outcomes = list()
+    for user_id in user_ids:
+        if user_id in inserted:
+            inserted.discard(user_id)
+            outcomes.append(added)
+        else:
+            outcomes.append(duplicate)
+    return outcomes
+
+
+async def post_entry_message(context, message, emoji):
+    '''
+    This function sends a message people can react to in order to join something,
+    and adds the first reaction so it is easy to click
+    '''
+    print(message)
+    posted = await context.send(message)
+    await posted.add_reaction(emoji)
+    return posted
+
+
+async def get_reaction_user_ids(bot, channel_id, message_id, emoji):
+    """
+    This function returns the ids of the users, other than bots, who reacted to a message with an emoji.
+    It returns an empty list if the message can no longer be found.
+    """
+    channel = bot.get_channel(channel_id)
+    if channel is None:
+        return []
+    try:
+        message = await channel.fetch_message(message_id)
+    except discord.HTTPException:
+        return []
+    for reaction in message.reactions:
+        if str(reaction.emoji) == emoji:
+            return [user.id async for user in reaction.users() if not user.bot]
+    return []
+
+
+class KeyedLocks:
+    """
+    This class hands out an asyncio lock per key, such as a contest, so work on one key waits
+    for other work on the same key but never for work on any other key. A key's lock is
+    dropped once nobody holds it or waits for it.
+    """
+    def __init__(self):
+        # Maps each key in use to [lock, holders and waiters]
+        self.locks = dict()
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
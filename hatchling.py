@@ -1,13 +1,13 @@
 #!/bin/python
+import time
+
+# Taken before anything else is imported, so the startup phases add up to the whole boot
+STARTED = time.perf_counter()
+
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
-import discord.ext.commands.bot
-from sqlalchemy import create_engine
-from hatch.santa import SecretSanta
-from hatch.contest import Contests
-
 bot_authors = [
     "mtvjr",
 ]
@@ -17,29 +17,88 @@ bot_source = "https://www.github.com/mtvjr/hatchling"
 bot_name = "Hatchling"
 bot_version = "0.2.2"
 
-if __name__ == "__main__":
-    if not os.getenv("DISCORD_TOKEN"):
-        raise RuntimeError("DISCORD_TOKEN not set")
+# Loaded in order; santa and contest use the members, outbox and scheduler cogs
+EXTENSIONS = [
+    "hatch.metrics",
+    "hatch.health",
+    "hatch.members",
+    "hatch.outbox",
+    "hatch.scheduler",
+    "hatch.santa",
+    "hatch.contest",
+]
+
+
+def prepare_database():
+    """
+    Checks the schema once, before any bot process starts. MIGRATE_ON_START upgrades it
+    instead, for development; deployments run `python -m hatch.migrations upgrade` as a release step.
+    """
+    import hatch.migrations
+    from hatch.database import create_engine_from_env, env_bool
+
+    engine = create_engine_from_env()
+    try:
+        if env_bool("MIGRATE_ON_START", False):
+            hatch.migrations.upgrade(engine)
+        else:
+            hatch.migrations.check(engine)
+    finally:
+        engine.dispose()
 
-    token = os.getenv("DISCORD_TOKEN")
 
-    if not os.getenv("DATABASE_URL"):
-        raise RuntimeError("DATABASE_URL not set")
+def run_bot(shard_ids=None, shard_count=None, processes=1):
+    """
+    Runs the bot until it logs out. In a cluster each process runs the shards in shard_ids;
+    otherwise every shard is run here, as many as Discord recommends unless shard_count is given.
+    """
+    started = time.perf_counter()
+    import discord.ext.commands
+    import hatch.cache
+    import hatch.metrics
+    from hatch.database import create_engine_from_env, Database
+    from hatch.notify import Notifier
+    imported = time.perf_counter()
 
-    url = os.getenv("DATABASE_URL")
+    token = os.getenv("DISCORD_TOKEN")
 
-    engine = create_engine(url)
+    # A single engine, and so a single connection pool, is shared by every cog
+    engine = create_engine_from_env()
+    db = Database(engine)
+    if processes > 1:
+        # Cogs cache lookups in memory, so every process must hear about the others' writes
+        Notifier(engine, db).start()
 
+    # The members intent is needed to query members by id and to hear about departures, but
+    # member lists are not downloaded or kept; names are resolved on demand instead
     intents = discord.Intents.default()
     intents.members = True
+    member_cache_flags = discord.MemberCacheFlags.none()
+
+    bot = discord.ext.commands.AutoShardedBot('!', description=bot_description, intents=intents,
+                                              member_cache_flags=member_cache_flags, chunk_guilds_at_startup=False,
+                                              shard_ids=shard_ids, shard_count=shard_count)
+    # Shared with the extensions' setup functions
+    bot.engine = engine
+    bot.db = db
+    bot.processes = processes
+    for extension in EXTENSIONS:
+        bot.load_extension(extension)
+    loaded = time.perf_counter()
 
-    bot = discord.ext.commands.Bot('!', description=bot_description, intents=intents)
-    bot.add_cog(SecretSanta(bot, engine))
-    bot.add_cog(Contests(bot, engine))
+    hatch.metrics.startup["boot"] = started - STARTED
+    hatch.metrics.startup["imports"] = imported - started
+    hatch.metrics.startup["extensions"] = loaded - imported
 
     @bot.event
     async def on_ready():
-        print(f'{bot_name} has escaped from his shell')
+        if "connect" not in hatch.metrics.startup:
+            ready = time.perf_counter()
+            hatch.metrics.startup["connect"] = ready - loaded
+            hatch.metrics.startup["total"] = ready - STARTED
+            print("Startup took " + ", ".join(f"{phase} {seconds:.2f}s"
+                                              for phase, seconds in hatch.metrics.startup.items()))
+        print(f'{bot_name} has escaped from his shell with shards {sorted(bot.shards)}')
 
     @bot.command()
     async def source(ctx):
@@ -53,5 +112,30 @@ if __name__ == "__main__":
     async def version(ctx):
         await ctx.send(f"I am on version {bot_version}.")
 
+    @bot.command()
+    @discord.ext.commands.is_owner()
+    async def cache(ctx):
+        """ Show the hit and miss counters of the lookup caches """
+        lines = [f"{name}: {stats['hits']} hits, {stats['misses']} misses, {stats['size']}"
+                 f"{'' if stats['maxsize'] is None else '/' + str(stats['maxsize'])} cached"
+                 for name, stats in ((name, cache.stats()) for name, cache in hatch.cache.registry.items())]
+        await ctx.send("\n".join(lines) or "No caches are in use.")
+
     print(f"Hatching {bot_name}")
     bot.run(token)
+
+
+if __name__ == "__main__":
+    if not os.getenv("DISCORD_TOKEN"):
+        raise RuntimeError("DISCORD_TOKEN not set")
+
+    from hatch.database import env_int
+    prepare_database()
+
+    processes = env_int("CLUSTER_PROCESSES", 1)
+    shard_count = env_int("SHARD_COUNT", None)
+    if processes > 1:
+        from hatch.cluster import run_cluster
+        run_cluster(run_bot, os.getenv("DISCORD_TOKEN"), processes, shard_count)
+    else:
+        run_bot(shard_count=shard_count)